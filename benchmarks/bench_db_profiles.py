@@ -0,0 +1,76 @@
+"""
+Compares the throughput of concurrent record ingestion on the database profiles of tierion.db.ENGINE_PROFILES, each
+thread creating records one by one in its own session as concurrent REST requests do
+
+Run from the repository root: python -m benchmarks.bench_db_profiles [threads [records_per_thread]]
+Set TIERION_BENCH_POSTGRES_URL, e.g. postgresql://tierion@localhost/tierion_bench, to include the PostgreSQL profile,
+its tables are dropped and recreated.
+"""
+import os
+import sys
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from threading import Lock
+
+from sqlalchemy.orm import sessionmaker
+
+from tierion import db, accounts, datastore, record
+
+
+def ingest(session_factory, lock, account_id, datastore_id, count):
+    session = session_factory()
+    failed = 0
+    try:
+        for i in range(count):
+            with lock:
+                try:
+                    if record.create_record(session, account_id, datastore_id, {"n": i}) is None:
+                        failed += 1
+                except Exception:
+                    session.rollback()
+                    failed += 1
+    finally:
+        session.close()
+    return failed
+
+
+def run(connection_string, profile, threads, count):
+    engine = db.create_db_engine(connection_string, profile=profile)
+    db.Base.metadata.drop_all(engine)
+    db.Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    # sqlite3 connections can't be used by several threads at once, so with one connection shared by all threads
+    # they have to take turns
+    lock = Lock() if db.get_engine_options(connection_string, profile)["pool_class"] == "static" else nullcontext()
+
+    session = session_factory()
+    user = accounts.create_account(session, "bench", "bench@example.com", "bench user", "secret")
+    account_id, datastore_id = user.id, datastore.create_datastore(session, user.id, "benchDS", "bench").id
+    session.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        failed = sum(executor.map(lambda _: ingest(session_factory, lock, account_id, datastore_id, count), range(threads)))
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return (threads * count - failed) / elapsed, failed
+
+
+def main(threads, count):
+    print("{:>14} {:>8} {:>12} {:>8}".format("profile", "threads", "records/s", "failed"))
+    with TemporaryDirectory() as directory:
+        targets = [(profile, "sqlite:///" + os.path.join(directory, "{}.db".format(profile)))
+                   for profile in ["sqlite-legacy", "sqlite"]]
+        if "TIERION_BENCH_POSTGRES_URL" in os.environ:
+            targets.append(("postgresql", os.environ["TIERION_BENCH_POSTGRES_URL"]))
+
+        for profile, connection_string in targets:
+            throughput, failed = run(connection_string, profile, threads, count)
+            print("{:>14} {:>8} {:>12.1f} {:>8}".format(profile, threads, throughput, failed))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 8, args[1] if len(args) > 1 else 250)
@@ -0,0 +1,55 @@
+"""
+Compares the throughput of serializing and hashing batches of record payloads across payload sizes: json.dumps as
+records were hashed before, canonical_json hashed inline and canonical_json hashed by tierion.canonical.PayloadHasher
+
+Run from the repository root: python -m benchmarks.bench_hashing [payload_bytes ...]
+"""
+import hashlib
+import json
+import sys
+import time
+from uuid import uuid4
+
+from tierion.canonical import canonical_json, PayloadHasher
+
+
+def make_payloads(size, count):
+    fields = max(1, size // 48)
+    return [{uuid4().hex: uuid4().hex for _ in range(fields)} for _ in range(count)]
+
+
+def inline_path(payloads):
+    return [hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest() for data in payloads]
+
+
+def canonical_path(payloads):
+    return [hashlib.sha256(canonical_json(data).encode("utf-8")).hexdigest() for data in payloads]
+
+
+def hasher_path(hasher, payloads):
+    return hasher.hash_many(canonical_json(data) for data in payloads)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main(sizes, total_bytes=64 * 1024 * 1024):
+    hasher = PayloadHasher()
+    print("{:>12} {:>8} {:>16} {:>16} {:>16}".format("payload[B]", "count", "json.dumps[MB/s]", "canonical[MB/s]",
+                                                       "hasher[MB/s]"))
+    for size in sizes:
+        count = max(4, total_bytes // size)
+        payloads = make_payloads(size, count)
+        megabytes = sum(len(canonical_json(data)) for data in payloads) / 1e6
+        assert canonical_path(payloads) == hasher_path(hasher, payloads)
+        print("{:>12} {:>8} {:>16.1f} {:>16.1f} {:>16.1f}".format(
+            size, count, megabytes / timed(inline_path, payloads), megabytes / timed(canonical_path, payloads),
+            megabytes / timed(hasher_path, hasher, payloads)))
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [1024, 65536, 1024 * 1024, 8 * 1024 * 1024])
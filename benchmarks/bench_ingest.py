@@ -0,0 +1,58 @@
+"""
+Compares creating records one by one through POST /api/v1/records against POST /api/v1/records/batch
+
+Run from the repository root: python -m benchmarks.bench_ingest [record_count ...]
+"""
+import json
+import sys
+import time
+
+from flask import Flask
+
+import flask_rest
+from tierion import db, accounts, datastore
+
+
+def setup_api():
+    engine = db.init("sqlite:///:memory:", False)
+    db.Base.metadata.drop_all(bind=engine)
+    db.Base.metadata.create_all(bind=engine)
+    session = db.create_session()
+    user = accounts.create_account(session, "bench", "bench@example.com", "bench user", "secret")
+    ds = datastore.create_datastore(session, user.id, "benchDS", "bench")
+
+    app = Flask(__name__)
+    flask_rest.setup(app, session)
+    return app.test_client(), {"X-Username": user.email, "X-Api-Key": user.apiKey}, ds.id
+
+
+def single_path(client, headers, datastore_id, items):
+    for item in items:
+        payload = dict(item, datastoreId=datastore_id)
+        assert client.post("/api/v1/records", headers=headers, json=payload).status_code == 200
+
+
+def batch_path(client, headers, datastore_id, items, batch_size=10000):
+    for i in range(0, len(items), batch_size):
+        res = client.post("/api/v1/records/batch", headers=headers,
+                          json={"datastoreId": datastore_id, "records": items[i:i + batch_size]})
+        assert res.status_code == 200 and json.loads(res.get_data(as_text=True))["errors"] == []
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    print("{:>10} {:>12} {:>12} {:>8}".format("records", "single[s]", "batch[s]", "speedup"))
+    for size in sizes:
+        items = [{"name": "record {}".format(i), "n": i} for i in range(size)]
+        single_time = timed(single_path, *setup_api(), items)
+        batch_time = timed(batch_path, *setup_api(), items)
+        print("{:>10} {:>12.4f} {:>12.4f} {:>7.1f}x".format(size, single_time, batch_time, single_time / batch_time))
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,46 @@
+"""
+Compares building a merkle tree and all leaf proofs with merkletools against tierion.merkle.MerkleTree
+
+Run from the repository root: python -m benchmarks.bench_merkle [leaf_count ...]
+"""
+import hashlib
+import sys
+import time
+from uuid import uuid4
+
+import merkletools
+
+from tierion.merkle import MerkleTree
+
+
+def merkletools_path(leaves):
+    mt = merkletools.MerkleTools()
+    for leaf in leaves:
+        mt.add_leaf(leaf)
+    mt.make_tree()
+    return mt.get_merkle_root(), [mt.get_proof(i) for i in range(len(leaves))]
+
+
+def merkle_tree_path(leaves):
+    tree = MerkleTree.from_hex(leaves)
+    return tree.get_merkle_root(), tree.get_proofs()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main(sizes):
+    print("{:>10} {:>14} {:>14} {:>8}".format("leaves", "merkletools[s]", "MerkleTree[s]", "speedup"))
+    for size in sizes:
+        leaves = [hashlib.sha256(uuid4().bytes).hexdigest() for _ in range(size)]
+        mt_time, mt_result = timed(merkletools_path, leaves)
+        tree_time, tree_result = timed(merkle_tree_path, leaves)
+        assert mt_result == tree_result, "MerkleTree result differs from merkletools for {} leaves".format(size)
+        print("{:>10} {:>14.4f} {:>14.4f} {:>7.1f}x".format(size, mt_time, tree_time, mt_time / tree_time))
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [100, 1000, 10000, 100000])
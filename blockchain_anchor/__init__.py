@@ -1,29 +1,36 @@
 import logging
 
 import blockchain_anchor.backends
+from blockchain_anchor.strategies import AnchoringStrategy, AllAnchorStrategy, AnyAnchorStrategy, QuorumAnchorStrategy
 
 
 class Anchoring:
     _pending_anchorings = {}
 
-    def __init__(self, strategies, default_strategy=None):
+    def __init__(self, backends, strategies, default_strategy=None, late_anchor_callback=None):
+        """
+        :param backends: dict of anchor type -> BlockchainIntegration
+        :param strategies: dict of name -> AnchoringStrategy
+        :param default_strategy: name of the strategy used when anchor is called without one
+        :param late_anchor_callback: a function of the form (hex_data, anchor type, transaction id) -> None called for
+                                     transactions sent but not returned by anchor, see AnchoringStrategy.anchor
+        """
+        self._backends = backends
         self._strategies = strategies
+        self._late_anchor_callback = late_anchor_callback
         self._default_strategy = self._strategies[default_strategy] if default_strategy is not None else None
         if self._default_strategy is None:
             logging.warning("No default strategy specified")
 
     def anchor(self, hex_data, strategy_name=None):
-        pass
-        # strategy = self._default_strategy if strategy_name is None else self._strategies[strategy_name]
-        # assert isinstance(strategy, AnchoringStrategy)
-        #
-        # if hex_data not in self._pending_anchorings:
-        #     self._pending_anchorings[hex_data] = strategy.get_name()
-        #     strategy.embed(hex_data)
-        #     return True
-        # else:
-        #     logging.warning("Ignoring anchoring attempt for data %s as it's already pending anchoring", hex_data)
-        #     return False
+        """
+        Anchors hex_data into the registered backends according to a strategy
+        :return: list of (anchor type, transaction id) tuples or None if the strategy's requirements weren't met
+        """
+        strategy = self._default_strategy if strategy_name is None else self._strategies[strategy_name]
+        assert isinstance(strategy, AnchoringStrategy)
+
+        return strategy.anchor(hex_data, self._backends, self._late_anchor_callback)
 
     def confirm(self, hex_data):
         if hex_data not in self._pending_anchorings:
@@ -39,15 +46,19 @@ class Anchoring:
         return None
 
 
-def init_anchor(config: dict, default_strategy: str = None) -> Anchoring:
+def init_anchor(config: dict, default_strategy: str = None, late_anchor_callback=None) -> Anchoring:
+    """
+    :param config: dict with "backends" mapping name -> (cls, anchor type, constructor args) and optionally
+                   "strategies" mapping name -> AnchoringStrategy, "all" and "any" are available by default
+    :param late_anchor_callback: see Anchoring
+    """
     _integrations = {}
-    # _strategies = {}
+    _strategies = {"all": AllAnchorStrategy(), "any": AnyAnchorStrategy()}
 
     for name, (cls, anchor_type, args) in config["backends"].items():
-        _integrations[name] = (cls(**args), anchor_type)
-        _integrations[name].set_name(name)
+        _integrations[anchor_type] = cls(**args)
+        _integrations[anchor_type].set_name(name)
 
-    # for name, cls in config["strategies"].items():
-    #     _strategies[name] = cls(_integrations)
+    _strategies.update(config.get("strategies", {}))
 
-    return Anchoring(default_strategy)
+    return Anchoring(_integrations, _strategies, default_strategy, late_anchor_callback)
@@ -29,6 +29,22 @@ class BlockchainIntegration:
         """
         logging.info("%s: Confirming transaction %s got embedded", self._name, tx_hash)
 
+    def confirm_many(self, tx_hashes):
+        """
+        Confirms several transactions at once, implementations should override this to look them up in one round trip
+
+        :param tx_hashes: list of hash strings as returned by the method anchor on the same object
+        :return: dict of tx_hash -> the result of confirm for that transaction
+        """
+        return {tx_hash: self.confirm(tx_hash) for tx_hash in tx_hashes}
+
+    def get_block_height(self):
+        """
+        :return: the height of the current tip of the chain or None if unknown, in which case transactions are
+                 confirmed without waiting for a new block
+        """
+        return None
+
     def get_name(self):
         return self._name
 
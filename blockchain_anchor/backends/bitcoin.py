@@ -133,6 +133,22 @@ class BitcoinService:
         """
         pass
 
+    def get_transaction_receipts(self, transaction_ids):
+        """
+        gets the receipts for several previously submitted transactions, services supporting it override this to fetch
+        them in one request
+        :param transaction_ids: list of tx ids
+        :return: dict of tx id -> the receipt data or None on error
+        """
+        return {tx_id: self.get_transaction_receipt(tx_id) for tx_id in transaction_ids}
+
+    def get_block_count(self):
+        """
+        queries the height of the most recent block
+        :return: the block height or None on error
+        """
+        pass
+
 
 class BitcoinIntegration(BlockchainIntegration):
     _op_count = 0
@@ -187,6 +203,19 @@ class BitcoinIntegration(BlockchainIntegration):
             return receipt['blockhash']
         return None
 
+    def confirm_many(self, tx_hashes):
+        tx_ids = {tx_hash: tx_hash if tx_hash.startswith("0x") else "0x{}".format(tx_hash) for tx_hash in tx_hashes}
+        receipts = self._service.get_transaction_receipts(list(tx_ids.values()))
+
+        confirmations = {}
+        for tx_hash, tx_id in tx_ids.items():
+            receipt = receipts.get(tx_id)
+            confirmations[tx_hash] = receipt['blockhash'] if receipt is not None and 'blockhash' in receipt else None
+        return confirmations
+
+    def get_block_height(self):
+        return self._service.get_block_count()
+
     def _sign_transaction(self, raw_unsigned_transaction, inputs, outputs):
         workaround = True  # TODO: Set this to false if signing offline is done
         if callable(self._privkey):
@@ -230,6 +259,42 @@ class BitcoindService(BitcoinService):
 
         return self._send_post_request(data)
 
+    def get_transaction_receipts(self, transaction_ids):
+        # one JSON-RPC batch request instead of a request per transaction
+        batch = []
+        for tx_id in transaction_ids:
+            data = self._base_data.copy()
+            data["method"] = "gettransaction"
+            data["params"] = [tx_id]
+            data["id"] = self._op_count
+            self._op_count += 1
+            batch.append(data)
+
+        receipts = {tx_id: None for tx_id in transaction_ids}
+        if len(batch) == 0:
+            return receipts
+
+        ids = {data["id"]: tx_id for data, tx_id in zip(batch, transaction_ids)}
+        responses = self._send_post_request(batch)
+        for response in responses if responses is not None else []:
+            if response.get("id") not in ids:
+                continue
+            if response.get("error") is not None:
+                logging.error("Failed getting transaction %s: %s", ids[response["id"]], response["error"])
+            else:
+                receipts[ids[response["id"]]] = response.get("result")
+        return receipts
+
+    def get_block_count(self):
+        data = self._base_data.copy()
+
+        data["method"] = "getblockcount"
+        data["params"] = []
+        data["id"] = self._op_count
+        self._op_count += 1
+
+        return self._send_post_request(data)
+
     def send_raw_transaction(self, transaction_hex):
         data = self._base_data.copy()
 
@@ -254,9 +319,23 @@ class BitcoindService(BitcoinService):
         return "http://{}:{}".format(self._host, self._port)
 
     def _send_post_request(self, payload):
-        res = requests.post(self.get_server_url(), json.dumps(payload), auth=(self._user, self._secret), timeout=2.5)
-        if res.status_code == 200:
-            res_json = res.json()
+        """
+        :param payload: a JSON-RPC request or a list of them to be sent as batch
+        :return: the result of the request, the list of responses for a batch or None on error
+        """
+        try:
+            res = requests.post(self.get_server_url(), json.dumps(payload), auth=(self._user, self._secret),
+                                timeout=2.5)
+            res_json = res.json() if res.status_code == 200 else None
+        except (requests.RequestException, ValueError) as err:
+            logging.error("Request to %s failed: %s", self.get_server_url(), err)
+            return None
+        if res_json is not None:
+            if isinstance(payload, list):
+                if isinstance(res_json, list):
+                    return res_json
+                logging.error("Batch request to %s failed: %s", self.get_server_url(), res_json)
+                return None
             if "result" in res_json:
                 return res_json["result"]
             if "error" in res_json:
@@ -33,10 +33,29 @@ class EthereumService:
         """
         pass
 
+    def get_transaction_receipts(self, transaction_ids):
+        """
+        gets the receipts for several previously submitted transactions, services supporting it override this to fetch
+        them in one request
+        :param transaction_ids: list of tx ids of the form '0x...'
+        :return: dict of tx id -> the receipt data or None on error
+        """
+        return {tx_id: self.get_transaction_receipt(tx_id) for tx_id in transaction_ids}
+
+    def get_block_number(self):
+        """
+        queries the number of the most recent block
+        :return: the block number or None on error
+        """
+        pass
+
 
 class Web3EthereumService(EthereumService):
-    def __init__(self, web3_http_uri):
+    def __init__(self, web3_http_uri, timeout=10):
         self._web3 = Web3(HTTPProvider(web3_http_uri))
+        self._uri = web3_http_uri
+        self._timeout = timeout
+        self._session = requests.Session()
 
     def get_transaction_receipt(self, transaction_id):
         try:
@@ -46,6 +65,41 @@ class Web3EthereumService(EthereumService):
             receipt = None
         return receipt
 
+    def get_transaction_receipts(self, transaction_ids):
+        # one JSON-RPC batch request instead of a request per transaction
+        batch = [{"jsonrpc": "2.0", "method": "eth_getTransactionReceipt", "params": [tx_id], "id": i}
+                 for i, tx_id in enumerate(transaction_ids)]
+        receipts = {tx_id: None for tx_id in transaction_ids}
+        if len(batch) == 0:
+            return receipts
+
+        try:
+            res = self._session.post(self._uri, json=batch, timeout=self._timeout)
+            responses = res.json() if res.status_code == 200 else None
+        except (requests.RequestException, ValueError) as err:
+            logging.error("Failed getting transaction receipts: %s", err)
+            return receipts
+        if not isinstance(responses, list):
+            logging.error("Failed getting transaction receipts: %s", responses if responses is not None else res.text)
+            return receipts
+
+        for response in responses:
+            i = response.get("id")
+            if not isinstance(i, int) or not 0 <= i < len(transaction_ids):
+                continue
+            if response.get("error") is not None:
+                logging.error("Failed getting transaction receipt for %s: %s", transaction_ids[i], response["error"])
+            else:
+                receipts[transaction_ids[i]] = response.get("result")
+        return receipts
+
+    def get_block_number(self):
+        try:
+            return self._web3.eth.blockNumber
+        except (ValueError, requests.RequestException) as err:
+            logging.error("Failed getting block number: %s", err)
+            return None
+
     def get_transaction_count(self, account):
         try:
             tx_count = self._web3.eth.getTransactionCount(account)
@@ -102,6 +156,18 @@ class EtherscanService(EthereumService):
         else:
             return None
 
+    def get_block_number(self):
+        params = {"module": "proxy",
+                  "action": "eth_blockNumber",
+                  "apikey": self._api_key}
+        res = requests.get(self._url, params=params)
+        if res.status_code == 200:
+            if "error" in res.json():
+                return None
+            return int(res.json()["result"], 16)
+        else:
+            return None
+
     def send_raw_transaction(self, transaction_hex):
         params = {"module": "proxy",
                   "action": "eth_sendRawTransaction",
@@ -161,5 +227,19 @@ class EthereumIntegration(BlockchainIntegration):
         if receipt is not None:
             return receipt['blockHash'][2:]  # Remove 0x prefix to have a hex hash only
 
+    def confirm_many(self, tx_hashes):
+        tx_ids = {tx_hash: tx_hash if tx_hash.startswith("0x") else "0x{}".format(tx_hash) for tx_hash in tx_hashes}
+        receipts = self._service.get_transaction_receipts(list(tx_ids.values()))
+
+        confirmations = {}
+        for tx_hash, tx_id in tx_ids.items():
+            receipt = receipts.get(tx_id)
+            block_hash = receipt.get('blockHash') if receipt is not None else None  # None while pending
+            confirmations[tx_hash] = block_hash[2:] if block_hash is not None else None
+        return confirmations
+
+    def get_block_height(self):
+        return self._service.get_block_number()
+
     def get_name(self):
         return super().get_name()
@@ -1,9 +1,11 @@
 import hashlib
+import json
 import logging
-from unittest import TestCase
+from unittest import TestCase, mock
 from uuid import uuid4
 
 import base58
+import requests
 
 from blockchain_anchor.backends.bitcoin import BitcoinIntegration, BitcoindService, make_raw_transaction, \
     build_pay_to_pubkey_hash_script, build_op_return_script, wif_to_private_key
@@ -59,3 +61,48 @@ class TestBitcoinIntegration(TestCase):
 
         print(make_raw_transaction([utxo1], [output1, output2]))
         print(wanted_raw_transaction.hex())
+
+
+def _rpc_response(status_code=200, body=None):
+    response = mock.Mock(status_code=status_code, text=json.dumps(body))
+    response.json.return_value = body
+    return response
+
+
+class TestBitcoindBatchRequests(TestCase):
+    def setUp(self):
+        self.svc = BitcoindService("localhost", 18332, "bitcoinrpc", "secret")
+        self.btc = BitcoinIntegration("privkey", "mmEXEzUGcMmmiLsfxxM8gB8TQSTkuR1drf", self.svc)
+
+    def answer(self, results):
+        # answers a batch in reverse order with the result results maps the tx id to, an exception becomes an error
+        def post(url, data, **kwargs):
+            responses = []
+            for request in reversed(json.loads(data)):
+                result = results[request["params"][0]]
+                if isinstance(result, Exception):
+                    responses.append({"id": request["id"], "result": None, "error": {"message": str(result)}})
+                else:
+                    responses.append({"id": request["id"], "result": result, "error": None})
+            return _rpc_response(body=responses)
+        return post
+
+    def test_responses_are_mapped_back_to_transactions(self):
+        results = {"0xa": {"blockhash": "00ab"}, "0xb": {"confirmations": 0}, "0xc": ValueError("Invalid tx id")}
+        with mock.patch("blockchain_anchor.backends.bitcoin.requests.post", side_effect=self.answer(results)) as post:
+            confirmations = self.btc.confirm_many(["a", "0xb", "c"])
+
+        assert post.call_count == 1
+        assert [request["method"] for request in json.loads(post.call_args[0][1])] == ["gettransaction"] * 3
+        assert confirmations == {"a": "00ab", "0xb": None, "c": None}
+
+    def test_failed_batch_leaves_transactions_unconfirmed(self):
+        for response in [_rpc_response(500, {"error": "boom"}), _rpc_response(body={"result": None, "error": "boom"}),
+                         requests.ConnectionError("refused")]:
+            with mock.patch("blockchain_anchor.backends.bitcoin.requests.post", side_effect=[response]):
+                assert self.svc.get_transaction_receipts(["0xa", "0xb"]) == {"0xa": None, "0xb": None}
+
+    def test_empty_batch_isnt_sent(self):
+        with mock.patch("blockchain_anchor.backends.bitcoin.requests.post") as post:
+            assert self.btc.confirm_many([]) == {}
+        assert post.call_count == 0
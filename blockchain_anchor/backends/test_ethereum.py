@@ -1,11 +1,13 @@
 import hashlib
+import json
 from time import sleep
-from unittest import TestCase
+from unittest import TestCase, mock
 from uuid import uuid4
 
+import requests
 from ethereum import utils
 
-from blockchain_anchor.backends.ethereum import EthereumIntegration, EtherscanService
+from blockchain_anchor.backends.ethereum import EthereumIntegration, EtherscanService, Web3EthereumService
 
 
 class TestEthereum(TestCase):
@@ -49,3 +51,49 @@ class TestEthereum(TestCase):
     #     eth = EthereumIntegration("TestEth", sign_cb)
     #     eth.anchor(test_merkle_root)
     #     assert called is True
+
+
+def _rpc_response(status_code=200, body=None):
+    response = mock.Mock(status_code=status_code, text=json.dumps(body))
+    response.json.return_value = body
+    return response
+
+
+class TestWeb3BatchRequests(TestCase):
+    def setUp(self):
+        self.svc = Web3EthereumService("http://127.0.0.1:8545")
+        with mock.patch.object(self.svc, "get_transaction_count", return_value=0):
+            self.eth = EthereumIntegration("privkey", "0x49D331C1990bD4DfD9DdDE27ce889f3C11671C0c", self.svc)
+
+    def answer(self, results):
+        # answers a batch in reverse order with the result results maps the tx id to, an exception becomes an error
+        def post(url, **kwargs):
+            responses = []
+            for request in reversed(kwargs["json"]):
+                result = results[request["params"][0]]
+                if isinstance(result, Exception):
+                    responses.append({"jsonrpc": "2.0", "id": request["id"], "error": {"message": str(result)}})
+                else:
+                    responses.append({"jsonrpc": "2.0", "id": request["id"], "result": result})
+            return _rpc_response(body=responses)
+        return post
+
+    def test_responses_are_mapped_back_to_transactions(self):
+        results = {"0xa": {"blockHash": "0x00ab"}, "0xb": None, "0xc": ValueError("unknown transaction")}
+        with mock.patch.object(self.svc._session, "post", side_effect=self.answer(results)) as post:
+            confirmations = self.eth.confirm_many(["a", "0xb", "c"])
+
+        assert post.call_count == 1
+        assert [r["method"] for r in post.call_args[1]["json"]] == ["eth_getTransactionReceipt"] * 3
+        assert confirmations == {"a": "00ab", "0xb": None, "c": None}
+
+    def test_failed_batch_leaves_transactions_unconfirmed(self):
+        for response in [_rpc_response(502, None), _rpc_response(body={"jsonrpc": "2.0", "error": {"code": -32600}}),
+                         requests.ConnectionError("refused")]:
+            with mock.patch.object(self.svc._session, "post", side_effect=[response]):
+                assert self.eth.confirm_many(["0xa", "0xb"]) == {"0xa": None, "0xb": None}
+
+    def test_empty_batch_isnt_sent(self):
+        with mock.patch.object(self.svc._session, "post") as post:
+            assert self.eth.confirm_many([]) == {}
+        assert post.call_count == 0
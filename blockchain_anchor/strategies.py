@@ -1,14 +1,129 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
 
 
 class AnchoringStrategy:
-    def __init__(self, name: str, description: str):
+    # backend -> the future of its running anchoring, shared by all strategies so a backend never anchors twice at
+    # once, which would e.g. clash over the nonce of an Ethereum account
+    _running = {}
+    _running_lock = Lock()
+
+    def __init__(self, name: str, description: str, timeout=None, timeouts=None, max_workers=8):
+        """
+        :param name: name the strategy is registered under
+        :param description: human readable description of the strategy
+        :param timeout: default number of seconds to wait for a backend, None waits until it returns
+        :param timeouts: optional dict of anchor type -> number of seconds overriding timeout for single backends
+        :param max_workers: the maximum number of backends anchoring at the same time
+        """
         logging.debug("Initialising AnchoringStrategy")
         self._name = name
         self._description = description
-
-    def anchor(self, hex_data, backends):
-        pass
+        self._timeout = timeout
+        self._timeouts = timeouts if timeouts is not None else {}
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="anchor-{}".format(name))
+
+    def get_required(self, backend_count):
+        """
+        :param backend_count: the number of backends anchoring
+        :return: the number of backends that have to succeed for the anchoring to succeed
+        """
+        return backend_count
+
+    def anchor(self, hex_data, backends, late_anchor_callback=None):
+        """
+        Anchors hex_data into all backends in parallel and returns as soon as enough of them succeeded, see
+        get_required. Backends that time out keep running in the background. A backend still anchoring an earlier
+        call is skipped and counts as failed.
+
+        :param hex_data: hex string to be anchored without leading 0x
+        :param backends: dict of anchor type -> BlockchainIntegration, e.g. {"ETHData": eth}
+        :param late_anchor_callback: a function of the form (hex_data, anchor type, transaction id) -> None called for
+                                     every transaction that isn't part of the returned anchors although it was sent:
+                                     those of backends finishing after anchor returned and, if too few backends
+                                     succeeded, those of the ones that did
+        :return: list of (anchor type, transaction id) tuples in the order of backends or None if too few succeeded
+        """
+        if len(backends) == 0:
+            logging.error("%s: No backends to anchor %s into", self._name, hex_data)
+            return None
+
+        required = self.get_required(len(backends))
+        start = time.time()
+        pending = {}
+        with self._running_lock:
+            for anchor_type, backend in backends.items():
+                running = self._running.get(backend)
+                if running is not None and not running.done():
+                    logging.warning("%s: %s is still anchoring an earlier merkle root, skipping it for %s",
+                                    self._name, anchor_type, hex_data)
+                    continue
+                timeout = self._timeouts.get(anchor_type, self._timeout)
+                future = self._executor.submit(backend.anchor, hex_data)
+                self._running[backend] = future
+                pending[future] = (anchor_type, None if timeout is None else start + timeout)
+
+        tx_ids = {}
+        late = {}
+        while len(tx_ids) < required <= len(tx_ids) + len(pending):
+            deadlines = [deadline for _, deadline in pending.values() if deadline is not None]
+            wait_timeout = max(0, min(deadlines) - time.time()) if len(deadlines) > 0 else None
+            done, _ = wait(pending, wait_timeout, FIRST_COMPLETED)
+
+            for future in done:
+                anchor_type, _ = pending.pop(future)
+                tx_id = self._get_tx_id(anchor_type, future)
+                if tx_id is not None:
+                    tx_ids[anchor_type] = tx_id
+
+            now = time.time()
+            for future, (anchor_type, deadline) in list(pending.items()):
+                if deadline is not None and deadline <= now:
+                    logging.warning("%s: Anchoring %s into %s timed out", self._name, hex_data, anchor_type)
+                    late[future] = anchor_type
+                    del pending[future]
+        late.update((future, anchor_type) for future, (anchor_type, _) in pending.items())
+
+        if len(tx_ids) < required:
+            logging.error("%s: Anchoring %s succeeded in %d of the required %d backends", self._name, hex_data,
+                          len(tx_ids), required)
+            for anchor_type, tx_id in tx_ids.items():
+                self._report_late(hex_data, anchor_type, tx_id, late_anchor_callback)
+            tx_ids = None
+
+        for future, anchor_type in late.items():
+            future.add_done_callback(
+                lambda f, anchor_type=anchor_type: self._report_late(hex_data, anchor_type,
+                                                                     self._get_tx_id(anchor_type, f),
+                                                                     late_anchor_callback))
+        if tx_ids is None:
+            return None
+
+        logging.debug("%s: Anchored %s into %s after %.3fs", self._name, hex_data, list(tx_ids), time.time() - start)
+        return [(anchor_type, tx_ids[anchor_type]) for anchor_type in backends if anchor_type in tx_ids]
+
+    def _report_late(self, hex_data, anchor_type, tx_id, late_anchor_callback):
+        if tx_id is None:
+            return
+        logging.warning("%s: %s anchored %s into transaction %s which isn't part of the anchoring result",
+                        self._name, anchor_type, hex_data, tx_id)
+        if late_anchor_callback is not None:
+            try:
+                late_anchor_callback(hex_data, anchor_type, tx_id)
+            except Exception:
+                logging.exception("%s: Reporting transaction %s failed", self._name, tx_id)
+
+    def _get_tx_id(self, anchor_type, future):
+        try:
+            tx_id = future.result()
+        except Exception:
+            logging.exception("%s: Anchoring into %s failed", self._name, anchor_type)
+            return None
+        if tx_id is None:
+            logging.warning("%s: Anchoring into %s returned no transaction id", self._name, anchor_type)
+        return tx_id
 
     def confirm(self, hex_data):
         pass
@@ -24,31 +139,28 @@ class AnchoringStrategy:
 
 
 class AllAnchorStrategy(AnchoringStrategy):
-    def __init__(self):
-        super().__init__("all", "This strategy anchors the document to all registered integrations")
-
-    def embed(self, hex_data):
-        pass
-
-    def confirm(self, hex_data):
-        pass
+    def __init__(self, timeout=None, timeouts=None):
+        super().__init__("all", "This strategy anchors the document to all registered integrations", timeout, timeouts)
 
 
 class AnyAnchorStrategy(AnchoringStrategy):
-    def get_name(self):
-        return super().get_name()
-
-    def anchor(self, hex_data, backends):
-        super().anchor(hex_data, backends)
-
-    def describe(self):
-        return super().describe()
-
-    def __init__(self, name: str, description: str):
-        super().__init__(name, description)
-
-    def get_description(self):
-        return super().get_description()
-
-    def confirm(self, hex_data):
-        super().confirm(hex_data)
+    def __init__(self, timeout=None, timeouts=None):
+        super().__init__("any", "This strategy anchors the document to the first registered integration to succeed",
+                         timeout, timeouts)
+
+    def get_required(self, backend_count):
+        return 1
+
+
+class QuorumAnchorStrategy(AnchoringStrategy):
+    def __init__(self, required, timeout=None, timeouts=None):
+        """
+        :param required: the number of integrations that have to succeed, capped at the number of integrations
+        """
+        super().__init__("{}-of-n".format(required),
+                         "This strategy anchors the document to the first {} registered integrations to succeed"
+                         .format(required), timeout, timeouts)
+        self._required = required
+
+    def get_required(self, backend_count):
+        return min(self._required, backend_count)
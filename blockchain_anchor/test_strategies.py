@@ -0,0 +1,107 @@
+import time
+from unittest import TestCase
+
+from blockchain_anchor import Anchoring
+from blockchain_anchor.backends import BlockchainIntegration
+from blockchain_anchor.strategies import AllAnchorStrategy, AnyAnchorStrategy, QuorumAnchorStrategy
+
+
+class FakeIntegration(BlockchainIntegration):
+    def __init__(self, name, delay=0.0, tx_id="0xfakeId", error=None):
+        super().__init__(name)
+        self._delay = delay
+        self._tx_id = tx_id
+        self._error = error
+        self.calls = 0
+
+    def anchor(self, hex_data):
+        self.calls += 1
+        time.sleep(self._delay)
+        if self._error is not None:
+            raise self._error
+        return "{}-{}".format(self._tx_id, hex_data)
+
+
+class TestStrategies(TestCase):
+    def test_all_anchors_in_parallel(self):
+        backends = {"ETHData": FakeIntegration("Ethereum", 0.2), "BTCOpReturn": FakeIntegration("Bitcoin", 0.2)}
+
+        start = time.time()
+        anchors = AllAnchorStrategy().anchor("abcd", backends)
+        assert time.time() - start < 0.35
+        assert anchors == [("ETHData", "0xfakeId-abcd"), ("BTCOpReturn", "0xfakeId-abcd")]
+
+    def test_all_fails_if_one_backend_fails(self):
+        backends = {"ETHData": FakeIntegration("Ethereum"), "BTCOpReturn": FakeIntegration("Bitcoin", error=IOError())}
+        assert AllAnchorStrategy().anchor("abcd", backends) is None
+
+    def test_any_returns_on_first_success(self):
+        backends = {"ETHData": FakeIntegration("Ethereum", 1.0), "BTCOpReturn": FakeIntegration("Bitcoin", 0.01)}
+
+        start = time.time()
+        anchors = AnyAnchorStrategy().anchor("abcd", backends)
+        assert time.time() - start < 0.5
+        assert anchors == [("BTCOpReturn", "0xfakeId-abcd")]
+
+    def test_any_survives_failing_backend(self):
+        backends = {"ETHData": FakeIntegration("Ethereum", error=ValueError("node down")),
+                    "BTCOpReturn": FakeIntegration("Bitcoin", 0.05)}
+        assert AnyAnchorStrategy().anchor("abcd", backends) == [("BTCOpReturn", "0xfakeId-abcd")]
+
+    def test_quorum_waits_for_k_backends(self):
+        backends = {"A": FakeIntegration("A", 0.01), "B": FakeIntegration("B", 1.0), "C": FakeIntegration("C", 0.05)}
+
+        start = time.time()
+        anchors = QuorumAnchorStrategy(2).anchor("abcd", backends)
+        assert time.time() - start < 0.5
+        assert anchors == [("A", "0xfakeId-abcd"), ("C", "0xfakeId-abcd")]
+
+    def test_quorum_fails_early_when_unreachable(self):
+        backends = {"A": FakeIntegration("A", error=ValueError()), "B": FakeIntegration("B", error=ValueError()),
+                    "C": FakeIntegration("C", 1.0)}
+
+        start = time.time()
+        assert QuorumAnchorStrategy(2).anchor("abcd", backends) is None
+        assert time.time() - start < 0.5
+
+    def test_backend_timeout(self):
+        backends = {"ETHData": FakeIntegration("Ethereum", 0.01), "BTCOpReturn": FakeIntegration("Bitcoin", 1.0)}
+        strategy = AllAnchorStrategy(timeout=5, timeouts={"BTCOpReturn": 0.1})
+
+        start = time.time()
+        assert strategy.anchor("abcd", backends) is None
+        assert time.time() - start < 0.5
+
+    def test_late_transactions_are_reported(self):
+        backends = {"ETHData": FakeIntegration("Ethereum", 0.01), "BTCOpReturn": FakeIntegration("Bitcoin", 0.2)}
+        late = []
+
+        assert AnyAnchorStrategy().anchor("abcd", backends, lambda *args: late.append(args)) == \
+            [("ETHData", "0xfakeId-abcd")]
+        assert late == []
+        time.sleep(0.4)
+        assert late == [("abcd", "BTCOpReturn", "0xfakeId-abcd")]
+
+    def test_transactions_of_failed_anchoring_are_reported(self):
+        backends = {"ETHData": FakeIntegration("Ethereum"), "BTCOpReturn": FakeIntegration("Bitcoin", error=IOError())}
+        late = []
+
+        assert AllAnchorStrategy().anchor("abcd", backends, lambda *args: late.append(args)) is None
+        assert late == [("abcd", "ETHData", "0xfakeId-abcd")]
+
+    def test_busy_backend_is_skipped(self):
+        bitcoin = FakeIntegration("Bitcoin", 0.3)
+        backends = {"ETHData": FakeIntegration("Ethereum"), "BTCOpReturn": bitcoin}
+        strategy = AnyAnchorStrategy(timeout=0.05)
+
+        assert strategy.anchor("abcd", backends) == [("ETHData", "0xfakeId-abcd")]
+        assert strategy.anchor("ef01", backends) == [("ETHData", "0xfakeId-ef01")]
+        assert bitcoin.calls == 1
+        time.sleep(0.4)
+        assert strategy.anchor("2345", backends) is not None
+        assert bitcoin.calls == 2
+
+    def test_anchoring_uses_default_strategy(self):
+        backends = {"ETHData": FakeIntegration("Ethereum"), "BTCOpReturn": FakeIntegration("Bitcoin", 1.0)}
+        anchoring = Anchoring(backends, {"any": AnyAnchorStrategy(), "all": AllAnchorStrategy()}, "any")
+        assert anchoring.anchor("abcd") == [("ETHData", "0xfakeId-abcd")]
@@ -1,14 +1,52 @@
 import json
+import logging
+from itertools import chain
 from math import ceil
 from time import time
 
-from flask import request, abort
+from flask import request, abort, Response, stream_with_context
+from sqlalchemy.orm import scoped_session
 
 import tierion
 from tierion import chainpoint_util
 
 
-def setup(app, session):
+def _stream_json_list(json_items):
+    """
+    :param json_items: iterable of JSON encoded items
+    :return: generator yielding the chunks of the JSON list of the items
+    """
+    yield "["
+    for i, item in enumerate(json_items):
+        yield item if i == 0 else "," + item
+    yield "]"
+
+
+def setup(app, session, aggregator=None, aggregation_timeout=600, max_batch_size=10000, ingest_chunk_size=1000,
+          ingest_max_pending=None):
+    """
+    Registers the REST API on a flask app
+    :param app: the flask app
+    :param session: the database session to be used, with a scoped_session such as tierion.db.Session every request
+                    gets its own session that is removed when the request ends
+    :param aggregator: if set, this node acts as aggregator node and accepts merkle roots of child nodes
+    :param aggregation_timeout: the maximum number of seconds a child submission waits to be anchored
+    :param max_batch_size: the maximum number of items accepted by one batch request
+    :param ingest_chunk_size: the number of items of a streamed upload committed at once
+    :param ingest_max_pending: the number of pending hashitems at which streamed uploads pause until anchoring caught
+                               up, None to never pause
+    """
+    @app.before_request
+    def open_repository():
+        # accounts and datastores are looked up once per request
+        tierion.open_repository(session)
+
+    @app.teardown_request
+    def close_repository(exc):
+        tierion.close_repository(session)
+        if isinstance(session, scoped_session):
+            session.remove()
+
     @app.route('/api/v1/accounts', methods=['POST'])
     @app.route('/api/v1/accounts/<account_name>', methods=['GET', 'DELETE'])
     def accounts(account_name=None):
@@ -54,8 +92,10 @@ def setup(app, session):
 
         if request.method == 'GET':
             if datastore_id is None:
-                datastores = tierion.get_datastore(session, account_id)
-                return json.dumps([json.loads(ds.json_describe()) for ds in datastores])
+                # an account only has a few datastores, they are described before the response starts so a
+                # failure is still reported with an error status
+                datastores = [ds.json_describe() for ds in tierion.iter_datastores(session, account_id)]
+                return Response(_stream_json_list(datastores), mimetype="application/json")
             else:
                 datastore = tierion.get_datastore(session, account_id, datastore_id)
                 if datastore is None:
@@ -155,28 +195,82 @@ def setup(app, session):
                 if datastore is None:
                     abort(500, "No datasstore with ID {} found".format(datastore_id))
 
-                page = request.args["page"] if "page" in request.args else 1
+                page = int(request.args["page"]) if "page" in request.args else 1
                 pageSize = int(request.args["pageSize"]) if "pageSize" in request.args else 100
                 if pageSize < 1 or pageSize > 10000:
                     abort(401)
                 startDate = int(request.args["startDate"] if "startDate" in request.args else "{}".format(int(datastore.timestamp.timestamp())))
-                endDate = int(time())
-
-                _records = tierion.get_record(session, account_id, datastoreId=datastore_id, page=page, pageSize=pageSize,
-                                              startDate=startDate, endDate=endDate)
-
-                response = {
-                    "accountId": "TODO",
-                    "datastoreId": datastore_id,
-                    "page": page,
-                    "pageCount": ceil(len(_records) / pageSize),
-                    "pageSize": pageSize,
-                    "recordCount": len(_records),
-                    "startDate": startDate,
-                    "endDate": endDate,
-                    "records": [json.loads(x.json_describe()) for x in _records]
-                }
-                return json.dumps(response)
+                endDate = int(request.args["endDate"]) if "endDate" in request.args else int(time())
+
+                # pages are best requested with the nextCursor of the previous page, page numbers need to skip all
+                # earlier records
+                after = None
+                if "cursor" in request.args:
+                    try:
+                        after = tierion.decode_cursor(request.args["cursor"])
+                    except ValueError:
+                        abort(400, "Invalid cursor")
+
+                total_count = None
+                if request.args.get("count", "false").lower() == "true":
+                    total_count = tierion.count_records(session, account_id, datastoreId=datastore_id,
+                                                        startDate=startDate, endDate=endDate)
+
+                # receipts built from records loaded before an invalidation aren't cached
+                receipt_generation = chainpoint_util.receipt_cache.get_generation()
+                _records = iter(tierion.iter_records(session, account_id, datastoreId=datastore_id, page=page,
+                                                     pageSize=pageSize, startDate=startDate, endDate=endDate,
+                                                     after=after))
+                # the query runs before the response starts, so a failing query is reported with an error status
+                first_record = next(_records, None)
+                if first_record is not None:
+                    _records = chain([first_record], _records)
+
+                record_count = 0
+                last_record = None
+                failed = False
+
+                def describe_records():
+                    # once the response started a failure can only be reported in the body, the page is closed
+                    # with an error and a nextCursor after the last record written
+                    nonlocal record_count, last_record, failed
+                    try:
+                        for x in _records:
+                            described = x.json_describe(receipt_generation)
+                            record_count += 1
+                            last_record = x
+                            yield described
+                    except Exception:
+                        logging.exception("Listing the records of datastore %d failed", datastore_id)
+                        failed = True
+
+                def generate():
+                    # the records are written as the query yields them, the rest follows once it's known
+                    header = json.dumps({
+                        "accountId": "TODO",
+                        "datastoreId": datastore_id,
+                        "page": page if after is None else None,
+                        "pageSize": pageSize,
+                        "startDate": startDate,
+                        "endDate": endDate
+                    })
+                    yield '{}, "records": '.format(header[:-1])
+                    yield from _stream_json_list(describe_records())
+
+                    next_cursor = tierion.encode_cursor(last_record) if record_count == pageSize else None
+                    footer = {
+                        "recordCount": record_count,
+                        "totalCount": total_count,
+                        "pageCount": ceil(total_count / pageSize) if total_count is not None else None,
+                        "nextCursor": next_cursor
+                    }
+                    if failed:
+                        footer["nextCursor"] = tierion.encode_cursor(last_record) if last_record is not None \
+                            else request.args.get("cursor")
+                        footer["error"] = "Listing the records failed, the page is incomplete"
+                    yield ", {}".format(json.dumps(footer)[1:])
+
+                return Response(stream_with_context(generate()), mimetype="application/json")
 
         elif request.method == "POST":
             if record_id is not None:
@@ -204,6 +298,58 @@ def setup(app, session):
                 return record.json_describe()
             abort(500)
 
+    @app.route('/api/v1/records/batch', methods=['POST'])
+    def records_batch():
+        login_ok, account_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+        if login_ok is not True:
+            abort(403, "User and API Key invalid")
+
+        if "datastoreId" not in request.json or not isinstance(request.json.get("records"), list):
+            abort(400, "Required fields datastoreId and records missing")
+        datastore_id = request.json["datastoreId"]
+        items = request.json["records"]
+        if len(items) > max_batch_size:
+            abort(413, "At most {} records can be created at once".format(max_batch_size))
+
+        result = tierion.create_records(session, account_id, datastore_id, items)
+        if result is None:
+            abort(500, "Something went wrong creating the records")
+        ids, errors = result
+        return Response(json.dumps({
+            "datastoreId": datastore_id,
+            "recordCount": len(items) - len(errors),
+            "ids": ids,
+            "errors": errors
+        }), mimetype="application/json")
+
+    def ingest_response(insert_fn):
+        # reads the body line by line instead of through request.json, which would buffer all of it
+        # listing every created ID makes the summary grow with the upload, so clients have to ask for it
+        summary = tierion.ingest_ndjson(tierion.iter_ndjson(request.stream), insert_fn, chunk_size=ingest_chunk_size,
+                                        max_pending=ingest_max_pending,
+                                        include_ids=request.args.get("ids", "false").lower() == "true")
+        res = Response(json.dumps(summary), status=200 if summary["complete"] else 503, mimetype="application/json")
+        if not summary["complete"]:
+            res.headers["Retry-After"] = "30"
+        return res
+
+    @app.route('/api/v1/records/stream', methods=['POST'])
+    def records_stream():
+        login_ok, account_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+        if login_ok is not True:
+            abort(403, "User and API Key invalid")
+
+        if "datastoreId" not in request.args:
+            abort(400, "Required argument datastoreId missing")
+        try:
+            datastore_id = int(request.args["datastoreId"])
+        except ValueError:
+            abort(400, "datastoreId must be an integer")
+        if tierion.get_datastore(session, account_id, datastore_id) is None:
+            abort(404, "No datastore with ID {} found".format(datastore_id))
+
+        return ingest_response(lambda items: tierion.create_records(session, account_id, datastore_id, items))
+
     @app.route('/api/v1/hashitems', methods=['POST'])
     def hashitems():
         login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
@@ -211,9 +357,70 @@ def setup(app, session):
             abort(403, "User and API Key invalid")
 
         hex_data = request.json["hash"]
-        item = tierion.create_hashitem(session, acct_id, hex_data)
+        if len(tierion.validate_hex_digests([hex_data])) > 0:
+            abort(400, "hash must be a hex encoded SHA256 digest")
+        item = tierion.create_hashitem(session, acct_id, hex_data.lower())
         return item.json_describe()
 
+    @app.route('/api/v1/hashitems/batch', methods=['POST'])
+    def hashitems_batch():
+        login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+        if login_ok is not True:
+            abort(403, "User and API Key invalid")
+
+        if not isinstance(request.json.get("hashes"), list):
+            abort(400, "Required field hashes missing")
+        hashes = request.json["hashes"]
+        if len(hashes) > max_batch_size:
+            abort(413, "At most {} hashes can be submitted at once".format(max_batch_size))
+
+        result = tierion.create_hashitems(session, acct_id, hashes)
+        if result is None:
+            abort(500, "Something went wrong creating the hashitems")
+        ids, errors = result
+        return Response(json.dumps({
+            "hashItemCount": len(hashes) - len(errors),
+            "receiptIds": ids,
+            "errors": errors
+        }), mimetype="application/json")
+
+    @app.route('/api/v1/hashitems/stream', methods=['POST'])
+    def hashitems_stream():
+        login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+        if login_ok is not True:
+            abort(403, "User and API Key invalid")
+
+        return ingest_response(lambda items: tierion.create_hashitems(
+            session, acct_id, [item.get("hash") if isinstance(item, dict) else None for item in items]))
+
+    @app.route('/api/v1/hashitems/upload', methods=['POST'])
+    def hashitems_upload():
+        login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+        if login_ok is not True:
+            abort(403, "User and API Key invalid")
+
+        # only the sha256 of the documents is kept, multipart files are spooled to temporary files by werkzeug, any
+        # other body is hashed while it is read
+        if request.mimetype == "multipart/form-data":
+            documents = []
+            for key in request.files:
+                for file in request.files.getlist(key):
+                    sha256, size = tierion.hash_file(file.stream)
+                    documents.append({"filename": file.filename, "sha256": sha256, "size": size})
+                    file.close()
+        else:
+            sha256, size = tierion.hash_stream(request.stream)
+            documents = [{"filename": request.headers.get("X-Filename"), "sha256": sha256, "size": size}]
+        if len(documents) == 0:
+            abort(400, "No document uploaded")
+
+        result = tierion.create_hashitems(session, acct_id, [document["sha256"] for document in documents])
+        if result is None:
+            abort(500, "Something went wrong creating the hashitems")
+        for document, receipt_id in zip(documents, result[0]):
+            document["receipt_id"] = receipt_id
+        return Response(json.dumps({"documents": documents}), mimetype="application/json")
+
     @app.route('/api/v1/receipts/<int:receipt_id>', methods=['GET'])
     def receipts(receipt_id):
         login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
@@ -221,8 +428,30 @@ def setup(app, session):
             abort(403, "User and API Key invalid")
 
         item = tierion.get_hashitem(session, item_id=receipt_id)
-        receipt = chainpoint_util.build_chainpoint_receipt(item)
-        return json.dumps(receipt)
+        return chainpoint_util.receipt_cache.get_json(item)
+
+    if aggregator is not None:
+        @app.route('/api/v1/aggregator/roots', methods=['POST'])
+        def aggregator_roots():
+            login_ok, acct_id = tierion.login(session, account=request.headers["X-Username"], api_key=request.headers["X-Api-Key"])
+            if not login_ok:
+                abort(403, "User and API Key invalid")
+
+            if "merkleRoot" not in request.json:
+                abort(400, "Required field merkleRoot missing")
+            session.rollback()  # no database connection is held while waiting for the aggregation
+            try:
+                result = aggregator.submit(request.json["merkleRoot"], aggregation_timeout)
+            except ValueError:
+                abort(400, "merkleRoot must be a hex encoded SHA256 digest")
+            if result is None:
+                abort(504, "Anchoring the aggregated merkle tree failed or timed out")
+
+            return json.dumps({
+                "merkleRoot": result["merkleRoot"],
+                "proof": result["proof"],
+                "anchors": [{"type": endpoint, "sourceId": tx_id} for endpoint, tx_id in result["anchors"]]
+            })
 
     # @app.route('/api/v1/anchor/<int:dsid>', methods=['GET', 'POST'])
     # def anchor(dsid):
@@ -6,16 +6,19 @@ from flask_cors import CORS
 
 import flask_rest
 import tierion
+from blockchain_anchor import Anchoring, AllAnchorStrategy, AnyAnchorStrategy
 from blockchain_anchor.backends import ethereum, bitcoin
-from tierion import db
+from tierion import db, migrations
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger('sqlalchemy.engine.base.Engine').setLevel(logging.WARNING)
     logging.info("Starting up!")
 
-    engine = db.init("sqlite:///tierion.db", False)
-    session = db.create_session()
+    # e.g. TIERION_DATABASE_URL=postgresql://tierion@localhost/tierion, see tierion.db.options_from_env
+    connection_string, profile, options = db.options_from_env()
+    engine = db.init(connection_string, False, profile, **options)
+    migrations.migrate(engine)
 
     eth_privkey = "32b4c7dc7c2c26d983a5ddeeb65e35b1f18e0148e30fe1ee58cd56bf7a0e5c1e"
     eth_acct = utils.decode_addr(utils.privtoaddr(eth_privkey))
@@ -30,26 +33,29 @@ if __name__ == "__main__":
     # eth = None    # disable eth
     btc = None  # disable btc
 
+    # Hierarchical anchoring: an aggregator node anchors the merkle roots submitted by its child nodes in one
+    # transaction, a child node anchors through its aggregator instead of the blockchain integrations above
+    aggregate_roots = False  # act as aggregator node
+    aggregator_node = None  # e.g. ("http://127.0.0.1:5000", "adam@bdam.net", "<api key>") to act as child node
+
+
+    # the integrations anchor in parallel, "any" returns as soon as one of them succeeded, "all" waits for every one
+    # and e.g. QuorumAnchorStrategy(2) for two of them. Transactions of integrations finishing later are still stored
+    backends = {anchor_type: integration for anchor_type, integration in [("ETHData", eth), ("BTCOpReturn", btc)]
+                if integration is not None}
+    anchoring = Anchoring(backends, {"any": AnyAnchorStrategy(timeout=120), "all": AllAnchorStrategy(timeout=120)},
+                          default_strategy="any", late_anchor_callback=tierion.anchoring.add_late_anchor)
+
 
     def anchor_documents_callback(merkle_root):
         logging.info("Anchoring merkle_root %s", merkle_root)
 
-        eth_tx_id = eth.anchor(merkle_root) if eth is not None else None
-        btc_tx_id = btc.anchor(merkle_root) if btc is not None else None
-
-        if eth_tx_id is None and btc_tx_id is None:
+        endpoints = anchoring.anchor(merkle_root)
+        if endpoints is None:
             logging.error("Anchoring merkle root %s failed", merkle_root)
-            return None
         else:
-            logging.debug("Anchored merkle tree root %s into transaction %s", merkle_root, eth_tx_id)
-
-            endpoints = []
-            if eth is not None:
-                endpoints.append(("ETHData", eth_tx_id))
-            if btc is not None:
-                endpoints.append(("BTCOpReturn", btc_tx_id))
-
-            return endpoints
+            logging.debug("Anchored merkle tree root %s into transactions %s", merkle_root, endpoints)
+        return endpoints
 
 
     # def confirm_anchorings_callback(endpoint, transaction_id):
@@ -69,15 +75,40 @@ if __name__ == "__main__":
     #
     #     return block_header
 
+    def confirm_anchorings_bulk_callback(endpoint, transaction_ids):
+        # resolves all pending transactions of one endpoint in a single JSON-RPC batch request
+        integration = backends.get(endpoint)
+        if integration is None:
+            logging.info("Unsupported endpoint %s", endpoint)
+            return {}
+        return integration.confirm_many(transaction_ids)
+
+
+    def block_height_callback(endpoint):
+        integration = backends.get(endpoint)
+        return integration.get_block_height() if integration is not None else None
+
+
+    aggregator = tierion.Aggregator(anchor_documents_callback) if aggregate_roots else None
+    aggregation_thr = tierion.start_aggregation_thread(aggregator, checking_interval=30) if aggregate_roots else None
 
-    anchor_thr = tierion.start_anchoring_timer(anchor_documents_callback, queue_max_size=3, checking_interval=30)
-    # confirm_thr = tierion.start_confirmation_thread(confirm_anchorings_callback, checking_interval=30)
+    anchoring_callback = anchor_documents_callback if aggregator_node is None else tierion.AggregatorClient(*aggregator_node)
+    delivery_thr = tierion.start_delivery_thread()
+    anchor_thr = tierion.start_anchoring_timer(anchoring_callback, queue_max_size=3, checking_interval=30)
+    confirm_thr = tierion.start_confirmation_thread(None, checking_interval=30,
+                                                    bulk_callback=confirm_anchorings_bulk_callback,
+                                                    height_callback=block_height_callback)
 
     app = Flask(__name__)
     CORS(app)
 
-    flask_rest.setup(app, session)
-    app.run(debug=True, use_reloader=False)
+    # streamed uploads pause while more than 100000 hashitems wait for anchoring
+    # every request runs in its own session, so requests are served concurrently
+    flask_rest.setup(app, db.Session, aggregator, ingest_max_pending=100000)
+    app.run(debug=True, use_reloader=False, threaded=True)
 
     tierion.stop_anchoring_thread(anchor_thr)
-    # tierion.stop_confirmation_thread(confirm_thr)
+    tierion.stop_delivery_thread(delivery_thr)
+    if aggregation_thr is not None:
+        tierion.stop_aggregation_thread(aggregation_thr)
+    tierion.stop_confirmation_thread(confirm_thr)
@@ -0,0 +1,242 @@
+import hashlib
+import io
+import json
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from flask import Flask
+from sqlalchemy import event
+
+import flask_rest
+from tierion import db, accounts, datastore, record, hashitem
+from tierion.chainpoint_util import receipt_cache
+from tierion.db import Record
+
+
+class RestTestCase(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        self.session = db.create_session()
+        self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
+        self.datastore = datastore.create_datastore(self.session, self.user.id, "testDS", "testGroup")
+
+        app = Flask(__name__)
+        flask_rest.setup(app, self.session)
+        self.client = app.test_client()
+        self.headers = {"X-Username": self.user.email, "X-Api-Key": self.user.apiKey}
+
+
+class TestListings(RestTestCase):
+    def create_records(self, count):
+        created = [record.create_record(self.session, self.user.id, self.datastore.id, {"n": i}) for i in range(count)]
+        self.session.query(Record).update({Record.timestamp: datetime.utcnow() - timedelta(minutes=1)})
+        self.session.commit()
+        return created
+
+    def get_page(self, **args):
+        args.update({"datastoreId": self.datastore.id, "startDate": 0})
+        res = self.client.get("/api/v1/records", headers=self.headers, query_string=args)
+        assert res.status_code == 200 and res.mimetype == "application/json"
+        return json.loads(res.get_data(as_text=True))
+
+    def test_records_are_listed(self):
+        created = self.create_records(5)
+
+        page = self.get_page(pageSize=3, count="true")
+        assert (page["recordCount"], page["totalCount"], page["pageCount"], page["pageSize"]) == (3, 5, 2, 3)
+        expected = {r.id: json.loads(r.json_describe()) for r in created}
+        for listed in page["records"]:
+            assert listed == expected[listed["id"]]
+            assert listed["blockchain_receipt"]["targetHash"] == listed["sha256"]
+
+    def test_records_are_paged_with_cursor(self):
+        created = self.create_records(7)
+
+        listed = []
+        page = self.get_page(pageSize=3)
+        assert page["totalCount"] is None and page["pageCount"] is None
+        while page["nextCursor"] is not None:
+            listed += page["records"]
+            page = self.get_page(pageSize=3, cursor=page["nextCursor"])
+        listed += page["records"]
+
+        assert page["recordCount"] == 1
+        assert sorted(r["id"] for r in listed) == sorted(r.id for r in created)
+        assert [(r["timestamp"], r["id"]) for r in listed] == sorted((r["timestamp"], r["id"]) for r in listed)
+
+    def test_receipts_are_loaded_per_chunk(self):
+        self.create_records(10)
+        receipt_cache.clear()
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", listener)
+        try:
+            page = self.get_page()
+        finally:
+            event.remove(self.engine, "before_cursor_execute", listener)
+
+        assert page["recordCount"] == 10
+        assert len([s for s in statements if "item_confirmation" in s]) == 1, statements
+
+    def test_failure_while_listing_is_reported(self):
+        created = self.create_records(5)
+        describe = Record.json_describe
+        described = []
+
+        def fail_on_third(record, generation=None):
+            if len(described) == 2:
+                raise ValueError("broken record")
+            described.append(record.id)
+            return describe(record, generation)
+
+        with mock.patch.object(Record, "json_describe", fail_on_third):
+            page = self.get_page(pageSize=4)
+        assert "error" in page and page["recordCount"] == 2
+        assert [r["id"] for r in page["records"]] == described
+
+        rest = self.get_page(pageSize=4, cursor=page["nextCursor"])
+        assert "error" not in rest
+        assert sorted(described + [r["id"] for r in rest["records"]]) == sorted(r.id for r in created)
+
+    def test_invalid_cursor_is_rejected(self):
+        res = self.client.get("/api/v1/records", headers=self.headers,
+                              query_string={"datastoreId": self.datastore.id, "cursor": "not a cursor"})
+        assert res.status_code == 400
+
+    def test_empty_record_listing(self):
+        page = self.get_page(count="true")
+        assert (page["records"], page["recordCount"], page["pageCount"], page["nextCursor"]) == ([], 0, 0, None)
+
+    def test_datastores_are_listed(self):
+        datastore.create_datastore(self.session, self.user.id, "otherDS", "testGroup")
+
+        res = self.client.get("/api/v1/datastores", headers=self.headers)
+        assert [ds["name"] for ds in json.loads(res.get_data(as_text=True))] == ["testDS", "otherDS"]
+
+
+class TestBatchIngestion(RestTestCase):
+    def post_batch(self, items, datastore_id=None):
+        payload = {"datastoreId": datastore_id or self.datastore.id, "records": items}
+        return self.client.post("/api/v1/records/batch", headers=self.headers, json=payload)
+
+    def test_records_are_created_in_batch(self):
+        res = self.post_batch([{"n": 0}, "not an object", {"n": 2}])
+        assert res.status_code == 200
+        result = json.loads(res.get_data(as_text=True))
+        assert result["recordCount"] == 2
+        assert result["errors"] == [{"index": 1, "error": "Record data has to be a JSON object"}]
+        assert result["ids"][1] is None
+
+        for i in [0, 2]:
+            created = record.get_record(self.session, self.user.id, id=result["ids"][i])
+            assert created.data == {"n": i} and created.json == '{{"n":{}}}'.format(i)
+            assert created.datastoreId == self.datastore.id
+            assert created.hashitem.sha256 == hashlib.sha256(created.json.encode("utf-8")).hexdigest()
+        assert len({r.hashitemId for r in self.session.query(Record)}) == 2
+
+    def test_unencodable_record_fails_alone(self):
+        res = self.post_batch([{"n": 0}, {"a": "\ud800"}])
+        result = json.loads(res.get_data(as_text=True))
+        assert res.status_code == 200 and result["recordCount"] == 1
+        assert [error["index"] for error in result["errors"]] == [1]
+        assert "can't be serialized" in result["errors"][0]["error"]
+
+    def test_batch_for_unknown_datastore_fails(self):
+        assert self.post_batch([{"n": 0}], datastore_id=42).status_code == 500
+        assert self.session.query(Record).count() == 0
+
+    def test_hashes_with_whitespace_are_rejected(self):
+        res = self.client.post("/api/v1/hashitems/batch", headers=self.headers, json={"hashes": ["a" * 62 + "  "]})
+        result = json.loads(res.get_data(as_text=True))
+        assert result["hashItemCount"] == 0 and result["receiptIds"] == [None]
+        res = self.client.post("/api/v1/hashitems", headers=self.headers, json={"hash": "a" * 62 + "  "})
+        assert res.status_code == 400
+        assert len(hashitem.get_hashitem(self.session)) == 0
+
+    def test_hashes_are_submitted_in_batch(self):
+        digests = [hashlib.sha256(str(i).encode("utf-8")).hexdigest() for i in range(3)]
+        res = self.client.post("/api/v1/hashitems/batch", headers=self.headers, json={"hashes": digests + [42]})
+        result = json.loads(res.get_data(as_text=True))
+        assert res.status_code == 200 and result["hashItemCount"] == 3
+        assert [error["index"] for error in result["errors"]] == [3]
+        for receipt_id, digest in zip(result["receiptIds"], digests):
+            receipt = json.loads(self.client.get("/api/v1/receipts/{}".format(receipt_id), headers=self.headers)
+                                 .get_data(as_text=True))
+            assert receipt["targetHash"] == digest
+
+    def test_records_are_streamed_in(self):
+        body = "\n".join(json.dumps({"n": i}) for i in range(5)) + "\n[1]\n"
+        res = self.client.post("/api/v1/records/stream", headers=self.headers, data=body.encode("utf-8"),
+                               query_string={"datastoreId": self.datastore.id}, content_type="application/x-ndjson")
+        summary = json.loads(res.get_data(as_text=True))
+
+        assert res.status_code == 200 and summary["complete"] is True
+        assert (summary["createdCount"], summary["errorCount"], summary["errors"][0]["line"]) == (5, 1, 6)
+        assert sorted(r.data["n"] for r in self.session.query(Record)) == list(range(5))
+        assert "ids" not in summary
+
+        streamed_before = {r.id for r in self.session.query(Record)}
+        res = self.client.post("/api/v1/records/stream", headers=self.headers, data=body.encode("utf-8"),
+                               query_string={"datastoreId": self.datastore.id, "ids": "true"},
+                               content_type="application/x-ndjson")
+        summary = json.loads(res.get_data(as_text=True))
+        assert sorted(summary["ids"]) == sorted({r.id for r in self.session.query(Record)} - streamed_before)
+
+        res = self.client.post("/api/v1/records/stream", headers=self.headers, data=body.encode("utf-8"),
+                               query_string={"datastoreId": "first"}, content_type="application/x-ndjson")
+        assert res.status_code == 400
+
+    def test_documents_are_hashed_on_upload(self):
+        content = b"document " * 100000
+        res = self.client.post("/api/v1/hashitems/upload", headers=self.headers, content_type="multipart/form-data",
+                               data={"file": (io.BytesIO(content), "a.txt"), "other": (io.BytesIO(b""), "b.txt")})
+        documents = json.loads(res.get_data(as_text=True))["documents"]
+        assert [(d["filename"], d["sha256"], d["size"]) for d in documents] == [
+            ("a.txt", hashlib.sha256(content).hexdigest(), len(content)), ("b.txt", hashlib.sha256(b"").hexdigest(), 0)]
+
+        res = self.client.post("/api/v1/hashitems/upload", headers=dict(self.headers, **{"X-Filename": "c.bin"}),
+                               data=content, content_type="application/octet-stream")
+        document = json.loads(res.get_data(as_text=True))["documents"][0]
+        assert (document["filename"], document["sha256"]) == ("c.bin", hashlib.sha256(content).hexdigest())
+        receipt = json.loads(self.client.get("/api/v1/receipts/{}".format(document["receipt_id"]),
+                                             headers=self.headers).get_data(as_text=True))
+        assert receipt["targetHash"] == document["sha256"]
+
+
+class TestScopedSessions(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        user = accounts.create_account(db.Session, "tester", "test@test.com", "tester user", "secret")
+        self.datastore_id = datastore.create_datastore(db.Session, user.id, "testDS", "testGroup").id
+        self.headers = {"X-Username": user.email, "X-Api-Key": user.apiKey}
+        db.Session.remove()
+
+        self.app = Flask(__name__)
+        flask_rest.setup(self.app, db.Session)
+        self.client = self.app.test_client()
+
+    def test_every_request_gets_its_own_session(self):
+        sessions = []
+        self.app.before_request(lambda: sessions.append(db.Session()))
+
+        for _ in range(2):
+            res = self.client.get("/api/v1/datastores/{}".format(self.datastore_id), headers=self.headers)
+            assert json.loads(res.get_data(as_text=True))["name"] == "testDS"
+            assert not db.Session.registry.has()
+
+        assert len(sessions) == 2 and sessions[0] is not sessions[1]
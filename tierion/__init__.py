@@ -5,88 +5,142 @@ import time
 from datetime import datetime, timedelta
 from threading import Thread
 
-import merkletools
 import sys
 
 import requests
 
-from blockchain_anchor import util
 from tierion import db
-from tierion.accounts import create_account, delete_account, get_account, login
-from tierion.datastore import create_datastore, update_datastore, delete_datastore, get_datastore
+from tierion.accounts import create_account, delete_account, get_account, login, auth_cache
+from tierion.datastore import create_datastore, update_datastore, delete_datastore, get_datastore, iter_datastores
 from tierion.db import Confirmation
-from tierion.record import create_record, delete_record, get_record, RecordState
-from tierion.hashitem import create_hashitem, get_hashitem
+from tierion.record import create_record, create_records, delete_record, get_record, iter_records, count_records, \
+    encode_cursor, decode_cursor, RecordState
+from tierion.hashitem import create_hashitem, create_hashitems, validate_hex_digests, insert_hashitems, get_hashitem, \
+    count_hashitems
 from tierion.chainpoint_util import build_chainpoint_receipt
+from tierion.aggregator import Aggregator, AggregatorClient
+from tierion.arrivals import arrivals, to_epoch, ArrivalTracker
+from tierion import anchoring
+from tierion.delivery import DeliveryThread, enqueue_receipts
+from tierion.confirmations import ConfirmationScheduler, invalidate_receipts
+from tierion.repository import Repository, open_repository, close_repository, repository_scope
+from tierion.ingest import iter_ndjson, ingest_ndjson
+from tierion.canonical import canonical_json, PayloadHasher, payload_hasher
+from tierion.documents import hash_stream, hash_file
+from tierion.chainpoint_util import receipt_cache
+from tierion.merkle import MerkleTree
 
 
 def send_post_receipt(url, receipt):
-    requests.post(url, data=json.dumps(receipt))
+    requests.post(url, data=json.dumps(receipt), timeout=10)
 
 
-def _check_queue_fn(callback, queue_max_size, record_max_age, post_receipt_cb=send_post_receipt):
+def build_merkle_tree(hashitems):
+    """
+    Builds a merkle tree from the list of hashitems passed in, anchoring builds its trees through
+    anchoring.build_batch_tree instead
+    :param hashitems: HashItems to be added as leaf nodes
+    :return: tuple of the hex encoded merkle root and a dict of hashitem ID -> Chainpoint v2 proof
+    """
+    logging.debug("Building merkle tree for %d hashitems", len(hashitems))
+    tree = MerkleTree.from_hex([item.sha256 for item in hashitems])
+    return tree.get_merkle_root(), {item.id: proof for item, proof in zip(hashitems, tree.get_proofs())}
+
+
+def _check_queue_fn(callback, queue_max_size, record_max_age, post_receipt_cb=None,
+                    max_leaves_per_tree=10000):
+    """
+    Anchors the pending hashitems if there are at least queue_max_size of them or one is older than record_max_age.
+    The whole pending set as of the start of the check is drained in batches of max_leaves_per_tree items, each
+    anchored in its own merkle tree and taken through the stages in tierion.anchoring with short transactions, so
+    no database lock is held while the callback talks to the blockchain. Transactions the callback sent after it
+    returned, see anchoring.add_late_anchor, are stored first.
+    :param callback: A function of the form (merkle_root) -> [(endpoint, tx_id)] or None on failure. Callbacks anchoring
+                     through an aggregator node return [(endpoint, tx_id, anchored_root, proof)] instead, proof being
+                     the Chainpoint v2 proof of merkle_root in the tree with root anchored_root
+    :param post_receipt_cb: A function of the form (url, receipt) -> None sending the receipts synchronously, None
+                            queues them for the delivery thread, see start_delivery_thread
+    :return: the number of hashitems anchored
+    """
     logging.debug("Checking queue (max_size: %d, max_age: %d)", queue_max_size, record_max_age)
-    session = db.create_session()
-
-    end_date = int((datetime.utcnow() - timedelta(seconds=record_max_age)).timestamp())
-    have_expired_hashitems = len(get_hashitem(session, pending=True, end_date=end_date)) > 0
-    session.rollback()
-
-    queued_hashitems = get_hashitem(session, pending=True, for_update=True)
-    receipts = []
-
-    if len(queued_hashitems) >= queue_max_size or have_expired_hashitems:
-        # sent = callback(queued_hashitems)
-        # [("Ethereum", eth_tx_id)], merkle_root, hashitem_proofs
-        # TODO: maybe return the merkle tree and look up leaf hashes in here
-
-        logging.debug("Anchoring %d hashitems including %d records", len(queued_hashitems), len([x for x in queued_hashitems if x.record is not None]))
-        merkle_root, hashitem_proofs = build_merkle_tree(queued_hashitems)
-
-        tx_ids = callback(merkle_root)
-
-        if tx_ids is not None:
-
-            confirmations = [db.Confirmation(endpoint=ep, tx_id=tx_id, merkle_root=merkle_root) for ep, tx_id in tx_ids]
-            [session.add(c) for c in confirmations]
-            for i in queued_hashitems:
-                if i.id in hashitem_proofs:
-                    i.proof = hashitem_proofs[i.id]
-                    if i.record is not None:
-                        i.record.status = RecordState.UNPUBLISHED.value[0]  # TODO: why [0]?            
-                    [i.confirmations.append(c) for c in confirmations]
-                    receipts.append((i, build_chainpoint_receipt(i)))
-                    session.add(i)
-                else:
-                    logging.warning("Ignoring hashitem %s as no proof found", i.id)
+    with db.session_scope() as session:
+        anchoring.persist_late_anchors(session)
+        end_date = int((datetime.utcnow() - timedelta(seconds=record_max_age)).timestamp())
+        snapshot = arrivals.start_snapshot()
+        have_expired_hashitems = count_hashitems(session, claimable=True, end_date=end_date)[0] > 0
+        pending_count, last_pending_id, oldest_pending = count_hashitems(session, claimable=True)
+        session.rollback()
+        arrivals.reset(pending_count, to_epoch(oldest_pending), snapshot)
+
+        if pending_count == 0 or (pending_count < queue_max_size and not have_expired_hashitems):
+            return 0
+
+        anchored_count = 0
+        tree_count = 0
+        failed = False
+        while True:
+            batch = anchoring.claim_batch(session, max_leaves_per_tree, last_pending_id)
+            if batch is None:
+                break
+
+            leaf_count = batch.leaf_count
+            if not anchoring.anchor_batch(session, batch, callback, post_receipt_cb):
+                failed = True
+                break
+            anchored_count += leaf_count
+            tree_count += 1
+
+    logging.info("Anchored %d of %d pending hashitems in %d merkle trees", anchored_count, pending_count, tree_count)
+    arrivals.anchored(anchored_count, anchored_count == pending_count)
+    if failed:
+        logging.warning("Anchoring failed, retrying in %ds", arrivals.failed())
+    return anchored_count
+
+
+def _check_confirmations_fn(callback, bulk_callback=None):
+    """
+    Looks up the block headers of all pending confirmations, resolving the transactions of each endpoint in one go
+    :param callback: A function of the form (endpoint, tx_id) -> block_header or None if not yet confirmed
+    :param bulk_callback: A function of the form (endpoint, [tx_id]) -> {tx_id: block_header or None}, e.g. dispatching
+                          to BlockchainIntegration.confirm_many, used instead of callback if set
+    """
+    logging.debug("Checking pending confirmations")
+    with db.session_scope() as session:
+        pending = session.query(Confirmation.endpoint, Confirmation.tx_id) \
+            .filter(Confirmation.block_header.is_(None)).distinct().all()
+        session.rollback()  # no transaction is kept open while asking the blockchains
+
+        by_endpoint = {}
+        for endpoint, tx_id in pending:
+            by_endpoint.setdefault(endpoint, []).append(tx_id)
+
+        confirmed = 0
+        for endpoint, tx_ids in by_endpoint.items():
+            if bulk_callback is not None:
+                block_headers = bulk_callback(endpoint, tx_ids)
+            else:
+                block_headers = {tx_id: callback(endpoint, tx_id) for tx_id in tx_ids}
+
+            confirmed_tx_ids = [tx_id for tx_id, block_header in block_headers.items() if block_header is not None]
+            for tx_id in confirmed_tx_ids:
+                confirmed += session.query(Confirmation) \
+                    .filter(Confirmation.endpoint == endpoint) \
+                    .filter(Confirmation.tx_id == tx_id) \
+                    .filter(Confirmation.block_header.is_(None)) \
+                    .update({Confirmation.block_header: block_headers[tx_id]}, synchronize_session=False)
             session.commit()
-            
-            for item, receipt in receipts:
-                if item.record is not None:
-                    if item.record.datastore.postReceiptEnabled:
-                        post_receipt_cb(item.record.datastore.postReceiptUrl, receipt)
-        else:
-            logging.info("Anchoring callback returned no transaction ids, rolling back changes")
+            invalidate_receipts(session, endpoint, confirmed_tx_ids)
             session.rollback()
-    else:
-        session.rollback()
 
+    logging.debug("Confirmed %d of %d pending transactions", confirmed, len(pending))
+    return confirmed
 
-def _check_confirmations_fn(callback):
-    logging.debug("Checking pending confirmations")
-    session = db.create_session()
-    pending_confirmations = session.query(Confirmation).filter(Confirmation.block_header.is_(None)).with_for_update().all()
-
-    if len(pending_confirmations) > 0:
-        for c in pending_confirmations:
-            block_header = callback(c.endpoint, c.tx_id)
-            if block_header is not None:
-                c.block_header = block_header
-                session.add(c)
-
-        session.commit()
-    else:
-        session.rollback()
+
+def _check_scheduled_confirmations_fn(scheduler: ConfirmationScheduler):
+    with db.session_scope() as session:
+        confirmed = scheduler.check(session)
+    logging.debug("Confirmed %d transactions, %d still pending", confirmed, scheduler.get_pending_count())
+    return confirmed
 
 
 class QueueCheckerThread(Thread):
@@ -108,6 +162,33 @@ class QueueCheckerThread(Thread):
         sys.exit()  # TODO: this feels like a bit of a hack
 
 
+class AnchoringThread(Thread):
+    """
+    Runs the queue check whenever the ArrivalTracker reports the queue size or age threshold as crossed, the interval
+    only serves as fallback for hashitems that didn't arrive through this process
+    """
+
+    def __init__(self, interval, callback, cb_args, tracker: ArrivalTracker):
+        Thread.__init__(self)
+        self.stopped = False
+        self.interval = interval
+        self.callback = callback
+        self.cb_args = cb_args
+        self.tracker = tracker
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.callback(*self.cb_args)
+            except Exception:
+                logging.exception("Checking the anchoring queue failed, retrying in %ds", self.tracker.failed())
+            self.tracker.wait(self.interval, lambda: self.stopped)
+
+    def stop(self):
+        self.stopped = True
+        self.tracker.wake()
+
+
 class ConfirmationCheckerThread(Thread):
     def __init__(self, interval, callback, cb_args):
         Thread.__init__(self)
@@ -119,7 +200,10 @@ class ConfirmationCheckerThread(Thread):
 
     def run(self):
         while not self.stopped:
-            self.scheduler.run()
+            try:
+                self.scheduler.run()
+            except Exception:
+                logging.exception("Checking confirmations failed")
             self.scheduler.enter(self.interval, 1, self.callback, self.cb_args)
 
     def stop(self):
@@ -127,50 +211,101 @@ class ConfirmationCheckerThread(Thread):
         sys.exit()  # TODO: this feels like a bit of a hack
 
 
-def start_anchoring_timer(callback, queue_max_size=10, record_max_age=600, checking_interval=30):
+def start_anchoring_timer(callback, queue_max_size=10, record_max_age=600, checking_interval=30,
+                          max_leaves_per_tree=10000, backoff=30, max_backoff=600):
     """
-    This function starts a timer that periodically checks for queued records and sends a list of these (with a DB lock held) to the callback
-    :param callback: A function of the form ([Record]) -> {true,false}
+    This function starts a thread that anchors the queued hashitems as soon as there are queue_max_size of them or the
+    oldest one reached record_max_age, and in any case every checking_interval seconds. Batches interrupted by a
+    shutdown are recovered first, submitted ones are anchored again through callback before the thread starts
+    :param callback: A function of the form (merkle_root) -> [(endpoint, tx_id)], see _check_queue_fn
     :param queue_max_size: the maximum number of queued records, callback is called when this is exceeded
     :param record_max_age: the maximum age of queued records, callback is called when this is exceeded
-    :param checking_interval: the interval at which to check the queue size as well as the record age
+    :param checking_interval: the interval at which the queue is checked in the database as fallback for hashitems not
+                              created through this process, None to only check when woken by arrivals
+    :param max_leaves_per_tree: the maximum number of hashitems anchored in one merkle tree, a larger queue is drained
+                                by anchoring several trees in one check
+    :param backoff: the number of seconds to wait before retrying after a failed check, doubling with every failure
+                    in a row
+    :param max_backoff: the maximum number of seconds to wait before retrying after a failed check
     """
-    logging.info("Starting QueueChecker Thread")
-    thr = QueueCheckerThread(checking_interval, _check_queue_fn, [callback, queue_max_size, record_max_age])
+    logging.info("Starting Anchoring Thread")
+    with db.session_scope() as session:
+        anchoring.recover_batches(session, callback=callback)
+
+    arrivals.configure(queue_max_size, record_max_age, backoff, max_backoff)
+    thr = AnchoringThread(checking_interval, _check_queue_fn,
+                          [callback, queue_max_size, record_max_age, None, max_leaves_per_tree], arrivals)
     thr.daemon = True
     thr.start()
     return thr
 
 
-def start_confirmation_thread(callback, checking_interval=30):
+def start_delivery_thread(workers=8, batch_size=1, max_attempts=5, backoff=30, checking_interval=30):
+    """
+    Starts the thread delivering the queued receipts to the postReceiptUrl of their datastores
+    :param workers: the number of receipts POSTed in parallel
+    :param batch_size: the number of receipts POSTed at once as JSON list, 1 POSTs every receipt on its own
+    :param max_attempts: the number of attempts after which delivery of a receipt is given up
+    :param backoff: the number of seconds to wait before retrying a failed delivery, doubling with every attempt
+    :param checking_interval: the interval at which the queue is checked for receipts queued by other processes
+    """
+    logging.info("Starting Delivery Thread")
+    thr = DeliveryThread(checking_interval, workers, batch_size, max_attempts, backoff)
+    thr.start()
+    return thr
+
+
+def start_aggregation_thread(aggregator: Aggregator, checking_interval=30):
+    """
+    Starts a timer that periodically anchors the merkle roots submitted to an aggregator node
+    :param aggregator: the Aggregator collecting the roots of the child nodes
+    :param checking_interval: the interval at which the collected roots are anchored
+    """
+    logging.info("Starting Aggregation Thread")
+    thr = QueueCheckerThread(checking_interval, aggregator.aggregate, [])
+    thr.daemon = True
+    thr.start()
+    return thr
+
+
+def start_confirmation_thread(callback, checking_interval=30, bulk_callback=None, height_callback=None):
+    """
+    Starts a thread confirming the anchoring transactions, see ConfirmationScheduler
+    :param callback: A function of the form (endpoint, tx_id) -> block_header or None if not yet confirmed
+    :param checking_interval: the interval at which the endpoints are checked for new blocks
+    :param bulk_callback: A function of the form (endpoint, [tx_id]) -> {tx_id: block_header or None}, used instead of
+                          callback if set
+    :param height_callback: A function of the form (endpoint) -> block height or None, transactions are only checked
+                            once their endpoint has a new block. Without it they are checked every checking_interval
+    """
     logging.info("Starting ConfirmationChecker Thread")
-    thr = ConfirmationCheckerThread(checking_interval, _check_confirmations_fn, [callback])
+    if bulk_callback is None:
+        def bulk_callback(endpoint, tx_ids):
+            return {tx_id: callback(endpoint, tx_id) for tx_id in tx_ids}
+
+    scheduler = ConfirmationScheduler(bulk_callback, height_callback)
+    thr = ConfirmationCheckerThread(checking_interval, _check_scheduled_confirmations_fn, [scheduler])
     thr.daemon = True
     thr.start()
     return thr
 
 
-def stop_anchoring_thread(timer_thread: QueueCheckerThread):
-    logging.info("Stopping QueueChecker Thread")
+def stop_anchoring_thread(timer_thread: AnchoringThread):
+    logging.info("Stopping Anchoring Thread")
     timer_thread.stop()
 
 
+def stop_delivery_thread(delivery_thread: DeliveryThread):
+    logging.info("Stopping Delivery Thread")
+    delivery_thread.stop()
+
+
+def stop_aggregation_thread(aggregation_thread: QueueCheckerThread):
+    logging.info("Stopping Aggregation Thread")
+    aggregation_thread.stop()
+
+
 def stop_confirmation_thread(confirm_thread: ConfirmationCheckerThread):
     logging.info("Stopping ConfirmationCheckerThread Thread")
     confirm_thread.stop()
 
-
-def build_merkle_tree(hashitems):
-    """
-    Builds a merkletools merkle tree from the list of records passed in
-    :param hashitems: Hex strings to be added as leaf nodes
-    :return:
-    """
-    logging.debug("Building merkle tree for {} hashitems".format(len(hashitems)))
-    mt = merkletools.MerkleTools()
-    for i in hashitems:
-        mt.add_leaf(i.sha256)
-
-    mt.make_tree()
-    item_proofs = {hashitems[i].id: mt.get_proof(i) for i in range(0, len(hashitems))}
-    return mt.get_merkle_root(), item_proofs
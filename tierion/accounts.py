@@ -1,5 +1,8 @@
 import hashlib
+import time
 import uuid
+from collections import OrderedDict
+from threading import Lock
 
 import logging
 
@@ -8,6 +11,96 @@ import sys
 
 
 from tierion.db import Account
+from tierion.repository import lookup, forget
+
+
+class AuthCache:
+    """
+    Thread safe cache of successful API key logins mapping (email, API key) to the account ID, so authenticated requests
+    don't query the account table. Entries expire after ttl seconds and are dropped when an account is created or
+    deleted. Only a digest of the API key is kept. Logins read from the database are only cached if no invalidation
+    happened since, see get_generation.
+    """
+
+    def __init__(self, ttl=300, max_size=10000):
+        """
+        :param ttl: the number of seconds a login is cached, 0 disables caching
+        :param max_size: the maximum number of cached logins
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._logins = OrderedDict()  # (email, key digest) -> (account ID, expiry)
+        self._generation = 0  # bumped by every invalidation so logins read concurrently aren't cached stale
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(email, api_key):
+        return email, hashlib.sha256(bytearray(api_key, 'utf-8')).digest()
+
+    def get(self, email, api_key):
+        """
+        :return: the account ID of a cached login or None
+        """
+        key = self._key(email, api_key)
+        with self._lock:
+            entry = self._logins.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._logins.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._logins[key]
+            self.misses += 1
+            return None
+
+    def get_generation(self):
+        """
+        :return: the generation to pass to put, taken before the account is read from the database
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, email, api_key, account_id, generation):
+        """
+        Caches a login unless an account was invalidated since generation was taken, the account might be stale then
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._logins[self._key(email, api_key)] = (account_id, time.monotonic() + self.ttl)
+            while len(self._logins) > self.max_size:
+                self._logins.popitem(last=False)
+
+    def invalidate(self, account_id=None, email=None):
+        """
+        Drops the cached logins of an account, identified by ID or email, after the change was committed
+        """
+        with self._lock:
+            self._generation += 1
+            for key, (cached_id, _) in list(self._logins.items()):
+                if cached_id == account_id or key[0] == email:
+                    del self._logins[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._logins.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with the number of cached logins, hits, misses and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._logins), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else None}
+
+
+auth_cache = AuthCache()
 
 
 def create_account(session, name, email, full_name, secret, do_commit=True):
@@ -29,6 +122,7 @@ def create_account(session, name, email, full_name, secret, do_commit=True):
             session.rollback()
             logging.error("Error creating account: %s", sys.exc_info())
             user = None
+    auth_cache.invalidate(email=email)
 
     return user
 
@@ -38,28 +132,37 @@ def get_account(session, account_id=None, account_name=None):
 
     if account_id is not None:
         query = query.filter(Account.id == account_id)
+        key = ("account", "id", str(account_id))
     elif account_name is not None:
         query = query.filter(Account.name == account_name)
+        key = ("account", "name", account_name)
     else:
         logging.error("Can't query for ID and name, only one allowed")
         return None
 
-    if len(query.all()) == 1:
-        return query.all()[0]
-    logging.error("Account query for %s returned %s results", account_id, len(query.all()))
-    return None
+    def load():
+        res = query.all()
+        if len(res) == 1:
+            return res[0]
+        logging.error("Account query for %s returned %s results", account_id, len(res))
+        return None
+
+    return lookup(session, key, load)
 
 
 def delete_account(session, account_id, do_commit=True):
     account = get_account(session, account_id)
     if account is not None:
         session.delete(account)
+        forget(session, account)
+        account_id, email = account.id, account.email
         if do_commit:
             try:
                 session.commit()
             except sqlalchemy.exc.SQLAlchemyError:
                 session.rollback()
                 logging.error("Error deleting account: %s", sys.exc_info())
+        auth_cache.invalidate(account_id=account_id, email=email)
 
     return account
 
@@ -83,10 +186,17 @@ def login(session, account=None, secret=None, api_key=None):
                 return login_ok, acct.id if login_ok else None
 
         elif api_key is not None:
+            generation = auth_cache.get_generation()
+            account_id = auth_cache.get(account, api_key)
+            if account_id is not None:
+                return True, account_id
+
             res = session.query(Account).filter(Account.email == account).all()
             if len(res) == 1:
                 acct = res[0]
                 login_ok = acct.apiKey == api_key
+                if login_ok:
+                    auth_cache.put(account, api_key, acct.id, generation)
                 return login_ok, acct.id if login_ok else None
 
         return False, None
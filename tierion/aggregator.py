@@ -0,0 +1,141 @@
+import logging
+from threading import Event, Lock
+
+import requests
+
+from tierion.merkle import MerkleTree
+
+
+class _Submission:
+    def __init__(self, merkle_root):
+        self.merkle_root = merkle_root
+        self.result = None
+        self.done = Event()
+
+
+class Aggregator:
+    """
+    Parent side of the hierarchical anchoring mode: child nodes submit the merkle roots of their batches, the aggregator
+    builds a tree over all roots collected since the last aggregation and anchors its root once for all of them. Every
+    child gets back the anchors together with the proof of its root in the aggregated tree.
+    """
+
+    def __init__(self, callback, max_roots=None):
+        """
+        :param callback: anchoring callback of the form (merkle_root) -> [(endpoint, tx_id)] or None on failure
+        :param max_roots: if set, roots are aggregated as soon as this many are pending instead of waiting for the
+                          next call to aggregate
+        """
+        self._callback = callback
+        self._max_roots = max_roots
+        self._pending = []
+        self._lock = Lock()
+
+    def submit(self, merkle_root, timeout=None):
+        """
+        Submits a merkle root and blocks until it got anchored as part of an aggregated tree
+        :param merkle_root: hex encoded merkle root of a child batch
+        :param timeout: the maximum number of seconds to wait for the aggregation to start, None waits forever. A root
+                        that timed out is dropped and never anchored, once its aggregation started it is waited for
+                        until anchoring finished, bounded by the timeout of the anchoring callback
+        :return: a dict of the form {"merkleRoot": <anchored root>, "proof": <Chainpoint v2 proof of merkle_root>,
+                 "anchors": [(endpoint, tx_id)]} or None if anchoring failed or timed out
+        """
+        MerkleTree.from_hex([merkle_root])  # reject anything that isn't a SHA256 digest before queueing it
+
+        submission = _Submission(merkle_root)
+        with self._lock:
+            self._pending.append(submission)
+            full = self._max_roots is not None and len(self._pending) >= self._max_roots
+        if full:
+            self.aggregate()
+
+        if not submission.done.wait(timeout):
+            with self._lock:
+                dropped = submission in self._pending
+                if dropped:
+                    self._pending.remove(submission)
+            if dropped:
+                logging.warning("Timed out waiting for aggregation of merkle root %s", merkle_root)
+                return None
+            # the root is being anchored, giving up now would let the submitter anchor it a second time
+            submission.done.wait()
+        return submission.result
+
+    def aggregate(self):
+        """
+        Anchors all roots pending since the last aggregation in one tree
+        :return: the number of roots aggregated
+        """
+        with self._lock:
+            submissions, self._pending = self._pending, []
+        if len(submissions) == 0:
+            return 0
+
+        tree = MerkleTree.from_hex([s.merkle_root for s in submissions])
+        merkle_root = tree.get_merkle_root()
+        logging.info("Aggregating %d merkle roots into %s", len(submissions), merkle_root)
+
+        try:
+            anchors = self._callback(merkle_root)
+        except Exception:
+            logging.exception("Anchoring aggregated merkle root %s failed", merkle_root)
+            anchors = None
+
+        for submission, proof in zip(submissions, tree.get_proofs()):
+            if anchors is not None:
+                submission.result = {"merkleRoot": merkle_root, "proof": proof, "anchors": list(anchors)}
+            submission.done.set()
+        return len(submissions)
+
+    def as_anchoring_callback(self, timeout=None):
+        """
+        :return: an anchoring callback for a child node running in the same process as this aggregator
+        """
+        return lambda merkle_root: aggregated_anchors(self.submit(merkle_root, timeout))
+
+
+class AggregatorClient:
+    """
+    Anchoring callback for child nodes that submits their merkle roots to an aggregator node over its REST API
+    """
+
+    def __init__(self, url, username, api_key, timeout=900):
+        """
+        :param url: base URL of the aggregator node, e.g. 'http://127.0.0.1:5000'
+        :param username: email of the account on the aggregator node
+        :param api_key: API key of the account on the aggregator node
+        :param timeout: seconds to wait for the aggregator to anchor a submitted root, has to exceed the
+                        aggregation_timeout of the aggregator node plus the time its anchoring takes
+        """
+        self._url = "{}/api/v1/aggregator/roots".format(url.rstrip("/"))
+        self._headers = {"X-Username": username, "X-Api-Key": api_key}
+        self._timeout = timeout
+
+    def __call__(self, merkle_root):
+        try:
+            res = requests.post(self._url, json={"merkleRoot": merkle_root}, headers=self._headers,
+                                timeout=self._timeout)
+        except requests.RequestException as err:
+            logging.error("Submitting merkle root %s to aggregator %s failed: %s", merkle_root, self._url, err)
+            return None
+
+        if res.status_code != 200:
+            logging.error("Aggregator %s rejected merkle root %s: %d %s", self._url, merkle_root, res.status_code,
+                          res.text)
+            return None
+
+        result = res.json()
+        result["anchors"] = [(a["type"], a["sourceId"]) for a in result["anchors"]]
+        return aggregated_anchors(result)
+
+
+def aggregated_anchors(result):
+    """
+    Converts the result of Aggregator.submit into the anchors returned by an anchoring callback
+    :param result: the aggregation result or None
+    :return: list of tuples (endpoint, tx_id, anchored_root, proof) or None if result is None
+    """
+    if result is None:
+        return None
+    return [(endpoint, tx_id, result["merkleRoot"], result["proof"]) for endpoint, tx_id in result["anchors"]]
@@ -0,0 +1,284 @@
+import logging
+from queue import SimpleQueue, Empty
+
+from sqlalchemy import and_, bindparam, literal, select
+from sqlalchemy.orm import joinedload, subqueryload
+
+from tierion import db, delivery
+from tierion.chainpoint_util import build_chainpoint_receipt, receipt_cache
+from tierion.db import AnchorBatch, BatchState, HashItem, Record, DataStore, Confirmation, item_confirmation_table
+from tierion.hashitem import _filter_hashitems, validate_hex_digests
+from tierion.merkle import MerkleTree, encode_proof
+from tierion.record import RecordState
+
+# Anchoring runs in stages that each use their own short transaction, so no lock is held while waiting for the
+# blockchain: claim_batch -> build_batch_tree -> submit_batch -> persist_batch (or release_batch) -> notify_batch
+
+# (merkle root, endpoint, tx_id) of transactions sent after the anchoring callback returned, stored by the anchoring
+# thread at the start of its next cycle when the batches they belong to aren't changing anymore
+_late_anchors = SimpleQueue()
+
+
+def _get_item_ids(session, batch):
+    return [item_id for item_id, in session.query(HashItem.id).filter(HashItem.batchId == batch.id).all()]
+
+
+def _reject_items(session, item_ids):
+    # hashitems that would fail every tree they're part of are moved to a rejected batch instead of being claimed
+    batch = AnchorBatch(state=BatchState.REJECTED.value, leaf_count=len(item_ids))
+    session.add(batch)
+    session.flush()
+    session.execute(HashItem.__table__.update()
+                    .where(and_(HashItem.id.in_(item_ids), HashItem.batchId.is_(None)))
+                    .values(batchId=batch.id))
+    logging.warning("Rejected hashitems %s with invalid digests into batch %s", item_ids, batch.id)
+
+
+def claim_batch(session, max_leaves, up_to_id=None):
+    """
+    Assigns up to max_leaves claimable hashitems, in ID order, to a new batch. Hashitems whose digest isn't 64 hex
+    digits are rejected instead, see BatchState.REJECTED
+    :param up_to_id: if set only hashitems with an ID up to this are claimed
+    :return: the claimed AnchorBatch or None if there was nothing to claim
+    """
+    while True:
+        query = _filter_hashitems(session.query(HashItem.id, HashItem.sha256), up_to_id=up_to_id, claimable=True)
+        rows = query.order_by(HashItem.id).limit(max_leaves).with_for_update().all()
+        if len(rows) == 0:
+            session.rollback()
+            return None
+
+        invalid = {error["index"] for error in validate_hex_digests([sha256 for _, sha256 in rows])}
+        item_ids = [item_id for i, (item_id, _) in enumerate(rows) if i not in invalid]
+        if len(invalid) == 0:
+            break
+        _reject_items(session, [rows[i][0] for i in sorted(invalid)])
+        if len(item_ids) > 0:
+            break
+        session.commit()
+
+    batch = AnchorBatch(state=BatchState.CLAIMED.value, leaf_count=len(item_ids))
+    session.add(batch)
+    session.flush()
+
+    claim = HashItem.__table__.update() \
+        .where(and_(HashItem.id == bindparam("item_id"), HashItem.batchId.is_(None))) \
+        .values(batchId=batch.id, leafIndex=bindparam("leaf_index"))
+    claimed = session.execute(claim, [{"item_id": item_id, "leaf_index": i} for i, item_id in enumerate(item_ids)])
+    if claimed.rowcount != len(item_ids):
+        logging.warning("Claimed %d of %d hashitems for batch %s, another worker got the rest", claimed.rowcount,
+                        len(item_ids), batch.id)
+        session.rollback()
+        return None
+
+    session.commit()
+    logging.debug("Claimed %d hashitems for batch %s", len(item_ids), batch.id)
+    return batch
+
+
+def build_batch_tree(session, batch):
+    """
+    Builds and stores the merkle tree over the hashitems of a claimed batch
+    :return: the MerkleTree or None if the tree couldn't be built
+    """
+    leaves = [sha256 for sha256, in session.query(HashItem.sha256).filter(HashItem.batchId == batch.id)
+              .order_by(HashItem.leafIndex).all()]
+    try:
+        tree = MerkleTree.from_hex(leaves)
+    except ValueError as err:
+        logging.error("Building the merkle tree of batch %s failed: %s", batch.id, err)
+        session.rollback()
+        return None
+
+    batch.merkle_root = tree.get_merkle_root()
+    batch.levels = tree.get_levels_buffer()
+    batch.state = BatchState.BUILT.value
+    item_ids = _get_item_ids(session, batch)
+    session.commit()
+    db.tree_cache.put((batch.id, batch.merkle_root), tree)
+    receipt_cache.invalidate(item_ids)
+    return tree
+
+
+def submit_batch(session, batch, callback):
+    """
+    Hands the root of a built batch to the anchoring callback, no transaction is open while the callback runs
+    :return: the anchors returned by the callback or None on failure
+    """
+    merkle_root = batch.merkle_root
+    batch.state = BatchState.SUBMITTED.value
+    session.commit()
+
+    logging.debug("Anchoring batch %s with merkle root %s", batch.id, merkle_root)
+    try:
+        return callback(merkle_root)
+    except Exception:
+        logging.exception("Anchoring batch with merkle root %s failed", merkle_root)
+        return None
+
+
+def persist_batch(session, batch, anchors):
+    """
+    Stores the confirmations of an anchored batch, links them to its hashitems and marks its records unpublished
+    :param anchors: the anchors returned by the anchoring callback, see _check_queue_fn
+    """
+    confirmations = []
+    for anchor in anchors:
+        # anchors made through an aggregator node carry the anchored root and the proof of our root in it
+        endpoint, tx_id = anchor[:2]
+        anchored_root, upper_proof = anchor[2:] if len(anchor) > 2 else (batch.merkle_root, None)
+        if upper_proof is not None:
+            batch.upper_proof = encode_proof(upper_proof)
+        confirmations.append(Confirmation(endpoint=endpoint, tx_id=tx_id, merkle_root=anchored_root))
+    _add_confirmations(session, batch, confirmations)
+
+    batch_items = select([HashItem.id]).where(HashItem.batchId == batch.id)
+    session.execute(Record.__table__.update().where(Record.hashitemId.in_(batch_items))
+                    .values(status=RecordState.UNPUBLISHED.value[0]))
+
+    batch.state = BatchState.ANCHORED.value
+    item_ids = _get_item_ids(session, batch)
+    session.commit()
+    receipt_cache.invalidate(item_ids)
+
+
+def _add_confirmations(session, batch, confirmations):
+    session.add_all(confirmations)
+    session.flush()
+    for c in confirmations:
+        session.execute(item_confirmation_table.insert().from_select(
+            ["item_id", "confirmation_id"], select([HashItem.id, literal(c.id)]).where(HashItem.batchId == batch.id)))
+
+
+def add_late_anchor(merkle_root, endpoint, tx_id):
+    """
+    Queues a transaction that anchored merkle_root after the anchoring callback returned, e.g. of a backend that was
+    slower than the first one to succeed, see blockchain_anchor.Anchoring. It's stored by persist_late_anchors.
+    """
+    _late_anchors.put((merkle_root, endpoint, tx_id))
+
+
+def persist_late_anchors(session):
+    """
+    Stores the transactions queued by add_late_anchor. Those anchoring the root of an anchored batch are added to the
+    confirmations of its hashitems, any other is stored without hashitems so no sent transaction is lost
+    :return: the number of transactions stored
+    """
+    stored = 0
+    while True:
+        try:
+            merkle_root, endpoint, tx_id = _late_anchors.get_nowait()
+        except Empty:
+            break
+
+        batches = session.query(AnchorBatch).filter(AnchorBatch.merkle_root == merkle_root) \
+            .filter(AnchorBatch.state.in_([BatchState.ANCHORED.value, BatchState.NOTIFIED.value])).all()
+        if len(batches) == 0:
+            logging.warning("Transaction %s on %s anchors %s which belongs to no anchored batch", tx_id, endpoint,
+                            merkle_root)
+            session.add(Confirmation(endpoint=endpoint, tx_id=tx_id, merkle_root=merkle_root))
+        item_ids = []
+        for batch in batches:
+            _add_confirmations(session, batch, [Confirmation(endpoint=endpoint, tx_id=tx_id, merkle_root=merkle_root)])
+            item_ids.extend(_get_item_ids(session, batch))
+        session.commit()
+        receipt_cache.invalidate(item_ids)
+        stored += 1
+    return stored
+
+
+def release_batch(session, batch):
+    """
+    Marks a batch as failed and hands its hashitems back to the queue, its tree is dropped as it will never be needed
+    """
+    item_ids = _get_item_ids(session, batch)
+    session.execute(HashItem.__table__.update().where(HashItem.batchId == batch.id)
+                    .values(batchId=None, leafIndex=None))
+    batch.state = BatchState.FAILED.value
+    batch.levels = None
+    session.commit()
+    receipt_cache.invalidate(item_ids)
+
+
+def notify_batch(session, batch, post_receipt_cb=None):
+    """
+    Sends the receipts of all records of an anchored batch whose datastore has postReceipt enabled
+    :param post_receipt_cb: a function of the form (url, receipt) -> None called for every receipt, None queues the
+                            receipts for the delivery thread together with marking the batch notified
+    """
+    rows = session.query(HashItem, DataStore.postReceiptUrl) \
+        .join(Record, Record.hashitemId == HashItem.id) \
+        .join(DataStore, Record.datastoreId == DataStore.id) \
+        .filter(HashItem.batchId == batch.id) \
+        .filter(DataStore.postReceiptEnabled.is_(True)) \
+        .options(subqueryload(HashItem.confirmations), joinedload(HashItem.batch)) \
+        .all()
+    receipts = [(url, build_chainpoint_receipt(item)) for item, url in rows]
+
+    if post_receipt_cb is None:
+        delivery.enqueue_receipts(session, receipts, do_commit=False)
+    else:
+        session.rollback()
+        for url, receipt in receipts:
+            post_receipt_cb(url, receipt)
+
+    batch.state = BatchState.NOTIFIED.value
+    session.commit()
+    if post_receipt_cb is None and len(receipts) > 0:
+        delivery.receipts_queued()
+
+
+def anchor_batch(session, batch, callback, post_receipt_cb=None):
+    """
+    Runs a claimed batch through all remaining anchoring stages
+    :return: True if the batch got anchored, False if it was released
+    """
+    if build_batch_tree(session, batch) is None:
+        release_batch(session, batch)
+        return False
+
+    anchors = submit_batch(session, batch, callback)
+    if anchors is None:
+        logging.info("Anchoring callback returned no transaction ids, releasing batch %s", batch.id)
+        release_batch(session, batch)
+        return False
+
+    persist_batch(session, batch, anchors)
+    notify_batch(session, batch, post_receipt_cb)
+    return True
+
+
+def recover_batches(session, post_receipt_cb=None, callback=None):
+    """
+    Cleans up after batches interrupted by a shutdown: batches that weren't submitted yet are released, receipts of
+    anchored batches are sent. Whether the root of a submitted batch made it into a transaction is unknown, it's
+    submitted again as anchoring the same root twice yields the same proofs
+    :param callback: the anchoring callback submitted batches are anchored with, see _check_queue_fn. Without one they
+                     are released
+    :return: the number of interrupted batches
+    """
+    batches = session.query(AnchorBatch).filter(AnchorBatch.state.in_([
+        BatchState.CLAIMED.value, BatchState.BUILT.value, BatchState.SUBMITTED.value, BatchState.ANCHORED.value])).all()
+
+    for batch in batches:
+        if batch.state in (BatchState.CLAIMED.value, BatchState.BUILT.value):
+            logging.info("Releasing interrupted batch %s", batch.id)
+            release_batch(session, batch)
+        elif batch.state == BatchState.ANCHORED.value:
+            logging.info("Sending receipts of interrupted batch %s", batch.id)
+            notify_batch(session, batch, post_receipt_cb)
+        elif callback is None:
+            logging.warning("Releasing batch %s with merkle root %s, it was submitted but its anchoring result is "
+                            "unknown", batch.id, batch.merkle_root)
+            release_batch(session, batch)
+        else:
+            logging.warning("Submitting batch %s with merkle root %s again, its anchoring result is unknown",
+                            batch.id, batch.merkle_root)
+            anchors = submit_batch(session, batch, callback)
+            if anchors is None:
+                release_batch(session, batch)
+            else:
+                persist_batch(session, batch, anchors)
+                notify_batch(session, batch, post_receipt_cb)
+    session.rollback()
+    return len(batches)
@@ -0,0 +1,194 @@
+import calendar
+import time
+from threading import Condition, RLock
+
+
+def to_epoch(timestamp):
+    """
+    :param timestamp: datetime as read from the database, naive datetimes are taken to be UTC
+    :return: seconds since epoch or None if timestamp is None
+    """
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is None:
+        return calendar.timegm(timestamp.timetuple()) + timestamp.microsecond / 1e6
+    return timestamp.timestamp()
+
+
+class ArrivalTracker:
+    """
+    In-process view of the anchoring queue: counts hashitems arriving through create_hashitem and create_record and
+    keeps the arrival time of the oldest pending one, so the anchoring worker can be woken as soon as the queue size or
+    age threshold is crossed instead of polling the database
+    """
+
+    def __init__(self):
+        lock = RLock()
+        self._condition = Condition(lock)
+        self._drained = Condition(lock)  # notified when hashitems are taken off the queue
+        self._count = 0
+        self._oldest = None
+        self._oldest_arrival = None
+        self._queue_max_size = None
+        self._max_age = None
+        self._backoff = 30
+        self._max_backoff = 600
+        self._failures = 0
+        self._retry_at = None
+        self._sequence = 0  # the number of hashitems that ever arrived, see start_snapshot
+        self._snapshot_arrival = None
+
+    def configure(self, queue_max_size, max_age, backoff=30, max_backoff=600):
+        """
+        :param queue_max_size: the number of pending hashitems at which anchoring is due
+        :param max_age: the age in seconds of the oldest pending hashitem at which anchoring is due
+        :param backoff: the number of seconds anchoring isn't due after a failed cycle, doubling with every further
+                        failure in a row
+        :param max_backoff: the maximum number of seconds anchoring isn't due after a failed cycle
+        """
+        with self._condition:
+            self._queue_max_size = queue_max_size
+            self._max_age = max_age
+            self._backoff = backoff
+            self._max_backoff = max_backoff
+            self._failures = 0
+            self._retry_at = None
+            self._condition.notify_all()
+
+    def arrived(self, count=1):
+        """
+        Records hashitems that were added to the queue
+        """
+        with self._condition:
+            now = time.time()
+            self._count += count
+            self._sequence += count
+            if self._snapshot_arrival is None:
+                self._snapshot_arrival = now
+            if self._oldest is None:
+                self._oldest = now
+            if self._oldest_arrival is None:
+                self._oldest_arrival = now
+            if self._is_due():
+                self._condition.notify_all()
+
+    def start_snapshot(self):
+        """
+        Marks the start of reading a snapshot of the queue from the database, which runs without holding back arrived
+        calls
+        :return: the token to pass to reset
+        """
+        with self._condition:
+            self._snapshot_arrival = None
+            return self._sequence
+
+    def reset(self, pending_count, oldest, since=None):
+        """
+        Replaces the tracked state with a snapshot of the queue read from the database
+        :param pending_count: the number of pending hashitems
+        :param oldest: seconds since epoch of the oldest pending hashitem or None
+        :param since: the token start_snapshot returned before the snapshot was read. Hashitems arriving while it was
+                      read are counted on top of it as they might have been committed too late to be part of it
+        """
+        with self._condition:
+            missed = self._sequence - since if since is not None else 0
+            self._count = pending_count + missed
+            self._oldest_arrival = self._snapshot_arrival if missed > 0 else None
+            if oldest is None:
+                oldest = self._oldest_arrival
+            self._oldest = oldest
+            self._drained.notify_all()
+
+    def anchored(self, count, drained):
+        """
+        Records hashitems taken off the queue since the last reset
+        :param count: the number of hashitems anchored
+        :param drained: whether all hashitems of the last snapshot got anchored
+        """
+        with self._condition:
+            self._count = max(0, self._count - count)
+            if drained:
+                self._oldest = self._oldest_arrival if self._count > 0 else None
+            if count > 0:
+                self._failures = 0
+                self._retry_at = None
+            self._drained.notify_all()
+
+    def failed(self):
+        """
+        Records a failed anchoring cycle, anchoring isn't due again until its backoff passed
+        :return: the number of seconds until anchoring is due again
+        """
+        with self._condition:
+            backoff = min(self._backoff * 2 ** self._failures, self._max_backoff)
+            self._failures += 1
+            self._retry_at = time.time() + backoff
+            return backoff
+
+    def get_pending_count(self):
+        with self._condition:
+            return self._count
+
+    def wait_below(self, pending_count, timeout=None):
+        """
+        Blocks until fewer than pending_count hashitems are pending, used to hold back producers while anchoring
+        catches up
+        :param timeout: the maximum number of seconds to wait, None waits until enough hashitems got anchored
+        :return: True if fewer than pending_count hashitems are pending
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._count >= pending_count:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._drained.wait(remaining)
+            return True
+
+    def wait(self, timeout=None, cancelled=None):
+        """
+        Blocks until anchoring is due, the timeout expired or wake is called
+        :param timeout: the maximum number of seconds to wait, None waits until due or woken
+        :param cancelled: optional function of the form () -> bool, checked before blocking so a wake call made just
+                          before waiting isn't missed
+        :return: True if anchoring is due
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            if deadline is not None and self._retry_at is not None:
+                deadline = max(deadline, self._retry_at)  # no fallback check before the backoff passed either
+            while not self._is_due():
+                if cancelled is not None and cancelled():
+                    return False
+                wait_until = deadline
+                if self._oldest is not None and self._max_age is not None:
+                    age_deadline = self._oldest + self._max_age
+                    wait_until = age_deadline if wait_until is None else min(wait_until, age_deadline)
+                if self._retry_at is not None:
+                    wait_until = self._retry_at if wait_until is None else max(wait_until, self._retry_at)
+
+                remaining = None if wait_until is None else wait_until - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                if not self._condition.wait(remaining):
+                    if deadline is not None and time.time() >= deadline:
+                        break
+                elif not self._is_due():
+                    return False  # woken explicitly
+            return self._is_due()
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _is_due(self):
+        if self._count == 0:
+            return False
+        if self._retry_at is not None and time.time() < self._retry_at:
+            return False
+        if self._queue_max_size is not None and self._count >= self._queue_max_size:
+            return True
+        return self._max_age is not None and self._oldest is not None and time.time() - self._oldest >= self._max_age
+
+
+arrivals = ArrivalTracker()
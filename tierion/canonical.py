@@ -0,0 +1,80 @@
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Records are hashed over the canonical JSON of their data so equal data always gets the same hash, however its keys
+# were ordered when it was submitted.
+
+
+def canonical_json(data):
+    """
+    Serializes data with sorted keys, without whitespace and with non-ASCII characters as is instead of escaped. For
+    data without floats this equals JSON.stringify of the key sorted data, so any client can reproduce the sha256 of a
+    record from its data.
+    :raises ValueError: if data contains NaN or infinity, which have no JSON representation
+    """
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, allow_nan=False)
+
+
+def sha256_hex(json_text):
+    """
+    :return: the hex encoded sha256 of the UTF-8 encoding of json_text
+    :raises ValueError: if json_text contains lone surrogates, which JSON allows but UTF-8 can't encode
+    """
+    return hashlib.sha256(json_text.encode("utf-8")).hexdigest()
+
+
+def _sha256_buffer(buffer):
+    return hashlib.sha256(buffer).hexdigest()
+
+
+class PayloadHasher:
+    """
+    Hashes many JSON strings at once, those larger than parallel_above bytes on a thread pool. hashlib releases the
+    GIL while hashing large buffers, so large payloads of a batch are hashed in parallel while the calling thread
+    serializes and hashes the others. Every payload is encoded once and handed to the pool as a memoryview of that
+    encoding.
+    """
+
+    def __init__(self, max_workers=4, parallel_above=65536):
+        """
+        :param max_workers: the number of threads hashing large payloads
+        :param parallel_above: the number of bytes above which a payload is hashed on the pool
+        """
+        self.max_workers = max_workers
+        self.parallel_above = parallel_above
+        self._executor = None
+        self._lock = Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="payload-hashing")
+            return self._executor
+
+    def hash_many(self, json_texts):
+        """
+        :param json_texts: iterable of JSON strings, see canonical_json, or their UTF-8 encodings. A generator
+                           serializing the payloads lets the pool hash the large ones while the next ones are
+                           serialized
+        :return: list of the hex encoded sha256 of every string in the order of json_texts
+        :raises ValueError: if a string contains lone surrogates, see sha256_hex
+        """
+        digests = []
+        for json_text in json_texts:
+            raw = json_text if isinstance(json_text, bytes) else json_text.encode("utf-8")
+            if len(raw) > self.parallel_above:
+                digests.append(self._get_executor().submit(_sha256_buffer, memoryview(raw)))
+            else:
+                digests.append(_sha256_buffer(raw))
+        return [digest if isinstance(digest, str) else digest.result() for digest in digests]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+payload_hasher = PayloadHasher()
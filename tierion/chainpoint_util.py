@@ -1,4 +1,11 @@
+import json
 import logging
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy.orm import object_session
+
+from tierion.merkle import decode_proof
 
 
 def build_chainpoint_receipt(item, version=2):
@@ -10,6 +17,102 @@ def build_chainpoint_receipt(item, version=2):
         "type": "ChainpointSHA256v2",
         "targetHash": "{}".format(item.sha256),
         "merkleRoot": "{}".format(item.confirmations[0].merkle_root if len(item.confirmations) > 0 else "0x0"),
-        "proof": item.proof,
+        "proof": decode_proof(item.proof) if item.proof is not None else None,
         "anchors": [{"type": c.endpoint, "sourceId": c.tx_id} for c in item.confirmations]
     }
+
+
+def _reload_item(item):
+    # the proof and confirmations of a hashitem as committed now, the batch holds the root its proof leads to
+    session = object_session(item)
+    if session is None:
+        return
+    session.refresh(item)
+    if item.batch is not None:
+        session.refresh(item.batch)
+
+
+class ReceiptCache:
+    """
+    Thread safe LRU cache of JSON serialized receipts keyed by hashitem ID. Entries have to be invalidated whenever the
+    proof or the confirmations of a hashitem change, which tierion.anchoring and the confirmation checkers do.
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: the maximum number of receipts kept, 0 disables caching
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._receipts = OrderedDict()
+        self._generation = 0  # bumped by every invalidation so receipts built concurrently aren't cached stale
+        self._lock = Lock()
+
+    def get_generation(self):
+        """
+        :return: the generation to pass to get_json, taken before the hashitems are loaded
+        """
+        with self._lock:
+            return self._generation
+
+    def get_json(self, item, generation=None):
+        """
+        :param item: the HashItem, only loaded further on a cache miss
+        :param generation: the generation returned by get_generation before item was loaded. Without it the state of
+                           item the receipt is built from is reloaded on a cache miss, as it might have been read before
+                           the latest invalidation
+        :return: the JSON serialized Chainpoint receipt of item
+        """
+        with self._lock:
+            receipt = self._receipts.get(item.id)
+            if receipt is not None:
+                self._receipts.move_to_end(item.id)
+                self.hits += 1
+                return receipt
+            self.misses += 1
+            if generation is None:
+                generation = self._generation
+                reload = True
+            else:
+                reload = False
+
+        if reload:
+            _reload_item(item)
+        receipt = json.dumps(build_chainpoint_receipt(item))
+        with self._lock:
+            if self.max_size > 0 and generation == self._generation:
+                self._receipts[item.id] = receipt
+                while len(self._receipts) > self.max_size:
+                    self._receipts.popitem(last=False)
+        return receipt
+
+    def get(self, item, generation=None):
+        """
+        :return: the Chainpoint receipt of item as dict, see get_json
+        """
+        return json.loads(self.get_json(item, generation))
+
+    def invalidate(self, item_ids):
+        """
+        :param item_ids: iterable of the IDs of the hashitems whose receipts changed
+        """
+        with self._lock:
+            self._generation += 1
+            for item_id in item_ids:
+                self._receipts.pop(item_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._receipts.clear()
+
+    def get_stats(self):
+        """
+        :return: dict with the number of cached receipts, hits and misses
+        """
+        with self._lock:
+            return {"size": len(self._receipts), "hits": self.hits, "misses": self.misses}
+
+
+receipt_cache = ReceiptCache()
@@ -0,0 +1,145 @@
+import heapq
+import logging
+import time
+
+from tierion.chainpoint_util import receipt_cache
+from tierion.db import Confirmation, item_confirmation_table
+
+
+def invalidate_receipts(session, endpoint, tx_ids):
+    """
+    Drops the cached receipts of all hashitems anchored in the given transactions
+    """
+    if len(tx_ids) == 0:
+        return
+    item_ids = session.query(item_confirmation_table.c.item_id) \
+        .join(Confirmation, Confirmation.id == item_confirmation_table.c.confirmation_id) \
+        .filter(Confirmation.endpoint == endpoint) \
+        .filter(Confirmation.tx_id.in_(tx_ids)).all()
+    receipt_cache.invalidate(item_id for item_id, in item_ids)
+
+
+class ConfirmationScheduler:
+    """
+    Confirms anchoring transactions only when the chain of their endpoint grew a new block. Every pending transaction
+    is kept in a per endpoint priority queue of next check times: it is checked on every new block for the first
+    stale_after checks, after that with an exponentially growing delay so transactions that don't get mined don't cause
+    a lookup on every block.
+    """
+
+    def __init__(self, bulk_callback, height_callback=None, stale_after=6, base_delay=60, max_delay=3600):
+        """
+        :param bulk_callback: a function of the form (endpoint, [tx_id]) -> {tx_id: block_header or None}
+        :param height_callback: a function of the form (endpoint) -> the current block height or None if unknown, an
+                                endpoint whose height is unknown is checked on every call of check
+        :param stale_after: the number of checks after which a transaction is considered stale
+        :param base_delay: the number of seconds between the first two checks of a stale transaction, doubling for
+                           every further check
+        :param max_delay: the maximum number of seconds between two checks of a transaction
+        """
+        self._bulk_callback = bulk_callback
+        self._height_callback = height_callback
+        self._stale_after = stale_after
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._queues = {}  # endpoint -> heap of (next check, tx_id)
+        self._attempts = {}  # (endpoint, tx_id) -> number of checks
+        self._heights = {}  # endpoint -> block height seen at the last check
+        self._last_id = 0
+
+    def load(self, session):
+        """
+        Adds the confirmations created since the last call to the queues
+        :return: the number of transactions added
+        """
+        pending = session.query(Confirmation.id, Confirmation.endpoint, Confirmation.tx_id) \
+            .filter(Confirmation.id > self._last_id) \
+            .filter(Confirmation.block_header.is_(None)) \
+            .order_by(Confirmation.id).all()
+        session.rollback()
+
+        added = 0
+        now = time.time()
+        for confirmation_id, endpoint, tx_id in pending:
+            self._last_id = max(self._last_id, confirmation_id)
+            if (endpoint, tx_id) in self._attempts:
+                continue
+            self._attempts[(endpoint, tx_id)] = 0
+            heapq.heappush(self._queues.setdefault(endpoint, []), (now, tx_id))
+            added += 1
+        return added
+
+    def get_pending_count(self):
+        return len(self._attempts)
+
+    def check(self, session):
+        """
+        Loads new confirmations and checks the due transactions of every endpoint that has a new block
+        :return: the number of transactions confirmed
+        """
+        try:
+            self.load(session)
+        except Exception:
+            logging.exception("Loading pending confirmations failed")
+            session.rollback()
+        confirmed = 0
+        for endpoint, queue in self._queues.items():
+            if len(queue) == 0 or not self._has_new_block(endpoint):
+                continue
+
+            now = time.time()
+            due = []
+            while len(queue) > 0 and queue[0][0] <= now:
+                due.append(heapq.heappop(queue)[1])
+            if len(due) == 0:
+                continue
+
+            try:
+                block_headers = self._bulk_callback(endpoint, due)
+            except Exception:
+                logging.exception("Confirming %d transactions on %s failed", len(due), endpoint)
+                block_headers = {}
+
+            confirmed_tx_ids = []
+            for tx_id in due:
+                block_header = block_headers.get(tx_id)
+                if block_header is not None:
+                    confirmed += session.query(Confirmation) \
+                        .filter(Confirmation.endpoint == endpoint) \
+                        .filter(Confirmation.tx_id == tx_id) \
+                        .filter(Confirmation.block_header.is_(None)) \
+                        .update({Confirmation.block_header: block_header}, synchronize_session=False)
+                    confirmed_tx_ids.append(tx_id)
+                    del self._attempts[(endpoint, tx_id)]
+                else:
+                    heapq.heappush(queue, (now + self._get_delay(endpoint, tx_id), tx_id))
+            session.commit()
+            invalidate_receipts(session, endpoint, confirmed_tx_ids)
+            session.rollback()
+
+        return confirmed
+
+    def _has_new_block(self, endpoint):
+        if self._height_callback is None:
+            return True
+        try:
+            height = self._height_callback(endpoint)
+        except Exception:
+            logging.exception("Getting the block height of %s failed", endpoint)
+            return False  # its node is likely unreachable, it's asked again on the next check
+        if height is None:
+            return True
+        if self._heights.get(endpoint) == height:
+            return False
+        logging.debug("%s is at block %d", endpoint, height)
+        self._heights[endpoint] = height
+        return True
+
+    def _get_delay(self, endpoint, tx_id):
+        attempts = self._attempts[(endpoint, tx_id)] + 1
+        self._attempts[(endpoint, tx_id)] = attempts
+        if attempts < self._stale_after:
+            return 0
+        if attempts == self._stale_after:
+            logging.info("Transaction %s on %s still isn't confirmed after %d blocks", tx_id, endpoint, attempts)
+        return min(self._max_delay, self._base_delay * 2 ** (attempts - self._stale_after))
@@ -1,5 +1,6 @@
 from tierion.accounts import *
 from tierion.db import DataStore
+from tierion.repository import lookup, forget
 
 
 def get_datastore(session, account_id, id=None):
@@ -11,14 +12,26 @@ def get_datastore(session, account_id, id=None):
 
     if id is None:
         return query.all()
-    else:
-        if len(query.all()) == 1:
-            return query.all()[0]
-        elif len(query.all()) == 0:
+
+    def load():
+        res = query.all()
+        if len(res) == 1:
+            return res[0]
+        elif len(res) == 0:
             return None
-        logging.error("Looking up Datastore for ID %s returned %d items!", id, len(query.all()))
+        logging.error("Looking up Datastore for ID %s returned %d items!", id, len(res))
         raise Exception("Somehow ID lookup returned more than 1 item")
 
+    return lookup(session, ("datastore", str(account_id), str(id)), load)
+
+
+def iter_datastores(session, account_id, batch_size=500):
+    """
+    Yields all datastores of an account while they are fetched from the database in chunks of batch_size
+    """
+    return session.query(DataStore).filter(DataStore.accountId == account_id).order_by(DataStore.id) \
+        .yield_per(batch_size)
+
 
 def create_datastore(session, account_id, name, group_name, redirect_enabled=False, redirect_url=None,
                      email_notification_enabled=False,
@@ -121,6 +134,7 @@ def delete_datastore(session, account_id, id, do_commit=True):
     datastore = get_datastore(session, account_id, id)
     if datastore is not None:
         session.delete(datastore)
+        forget(session, datastore)
 
         if do_commit:
             session.commit()
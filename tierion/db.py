@@ -1,15 +1,78 @@
 import json
-
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, PickleType, func, Table
-from sqlalchemy import create_engine
+import os
+import pickle
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from enum import Enum
+
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, func, Table, LargeBinary, \
+    Index
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, deferred
+from sqlalchemy.pool import StaticPool, QueuePool, NullPool
+from sqlalchemy.types import TypeDecorator
 
-from tierion import chainpoint_util
+from tierion import chainpoint_util, merkle
 
 Base = declarative_base()
 engine = None
+tree_cache = merkle.TreeCache()
+
+
+class PackedProof(TypeDecorator):
+    """
+    Merkle proof stored in the packed binary encoding of tierion.merkle.encode_proof. Proofs written by earlier versions
+    as pickled lists of Chainpoint dicts share the same BLOB column and are packed transparently when read.
+    """
+    impl = LargeBinary
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value[:1] == pickle.PROTO:
+            return merkle.encode_proof(pickle.loads(value))
+        return value
+
+
+def encode_payload(json_text, compress_above=1024):
+    """
+    :param json_text: JSON string
+    :param compress_above: the number of bytes above which the JSON is zlib compressed if that makes it smaller
+    :return: the JSON encoded as stored by CompactJSON, its first byte telling plain from compressed JSON
+    """
+    raw = json_text.encode("utf-8")
+    if len(raw) > compress_above:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return b"z" + compressed
+    return b"j" + raw
+
+
+def decode_payload(value):
+    """
+    :param value: JSON encoded by encode_payload
+    :return: the JSON string
+    """
+    if value[:1] == b"z":
+        return zlib.decompress(value[1:]).decode("utf-8")
+    return bytes(value[1:]).decode("utf-8")
+
+
+class CompactJSON(TypeDecorator):
+    """
+    JSON string stored once in a BLOB column, large values zlib compressed, see encode_payload
+    """
+    impl = LargeBinary
+
+    def __init__(self, compress_above=1024, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress_above = compress_above
+
+    def process_bind_param(self, value, dialect):
+        return encode_payload(value, self.compress_above) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return decode_payload(value) if value is not None else None
 
 
 class Account(Base):
@@ -31,14 +94,17 @@ class Account(Base):
         return "<Account(name='{}', fullname='{}', password='{}', last_token_time='{}')>".format(
             self.name, self.fullname, self.password, self.last_token_time)
 
-    def json_describe(self):
-        return json.dumps({
+    def to_dict(self):
+        return {
             "id": self.id,
             "name": self.name,
             "email": self.email,
             "fullname": self.fullname,
             "api_key": self.apiKey
-        })
+        }
+
+    def json_describe(self):
+        return json.dumps(self.to_dict())
 
 
 class DataStore(Base):
@@ -77,11 +143,13 @@ class DataStore(Base):
     records = relationship("Record", back_populates="datastore")
     owner = relationship("Account", back_populates="datastores")
 
+    __table_args__ = (Index("ix_datastore_accountId", accountId),)
+
     def __repr__(self):
         return "<DataStore(id='{}', key='{}', name='{}')>".format(self.id, self.key, self.name)
 
-    def json_describe(self):
-        return json.dumps({
+    def to_dict(self):
+        return {
             "id": self.id,
             "key": self.key,
             "name": self.name,
@@ -95,7 +163,10 @@ class DataStore(Base):
             "postReceiptEnabled": self.postReceiptEnabled,
             "postReceiptUrl": self.postReceiptUrl,
             "timestamp": "{}".format(int(self.timestamp.timestamp()))
-        })
+        }
+
+    def json_describe(self):
+        return json.dumps(self.to_dict())
 
 
 class Record(Base):
@@ -120,9 +191,12 @@ class Record(Base):
     accountId = Column(Integer, ForeignKey("account.id"), nullable=False)
     datastoreId = Column(Integer, ForeignKey("datastore.id"), nullable=False)
     status = Column(String, nullable=False)
-    data = Column(PickleType)
-    json = Column(String)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # the data is kept once as the JSON string it was hashed from and only decoded to a dict when accessed, records
+    # written by earlier versions are converted by migration 3
+    payload = Column(CompactJSON)
+    # set on the client so all timestamps carry microseconds and compare consistently with keyset pagination cursors,
+    # records written through the server default by earlier versions are converted by migration 5
+    timestamp = Column(DateTime(timezone=True), default=datetime.utcnow, server_default=func.now())
     insights = Column(String)
     hashitemId = Column(Integer, ForeignKey("hashitem.id"), nullable=False)
 
@@ -130,30 +204,114 @@ class Record(Base):
     owner = relationship("Account", back_populates="records")
     hashitem = relationship("HashItem", uselist=False, back_populates="record", lazy="subquery")
 
+    __table_args__ = (Index("ix_record_account_datastore_timestamp_id", accountId, datastoreId, timestamp, id),
+                      Index("ix_record_datastoreId", datastoreId),
+                      Index("ix_record_hashitemId", hashitemId))
+
     def __repr__(self):
         return "<Record(id='{}, accountId='{}', datastoreId='{}', status='{}')>".format(self.id, self.accountId,
                                                                                         self.datastoreId, self.status)
 
-    def json_describe(self):
-        return json.dumps({
+    @property
+    def json(self):
+        return self.payload
+
+    @property
+    def data(self):
+        return json.loads(self.payload) if self.payload is not None else None
+
+    def to_dict(self, include_receipt=True, include_data=True, generation=None):
+        """
+        :param generation: the generation of the receipt cache taken before the record was loaded, see
+                           ReceiptCache.get_json
+        """
+        record = {
             "id": self.id,
             "accountId": self.accountId,
             "datastoreId": self.datastoreId,
             "status": self.status,
-            "data": self.data,
             "json": self.json,
-            "sha256": self.hashitem.proof,
-            "timestamp": "{}".format(int(self.timestamp.timestamp())),
-            "blockchain_receipt": chainpoint_util.build_chainpoint_receipt(self.hashitem)
-        })
+            "sha256": self.hashitem.sha256,
+            "timestamp": "{}".format(int(self.timestamp.timestamp()))
+        }
+        if include_data:
+            record["data"] = self.data
+        if include_receipt:
+            record["blockchain_receipt"] = chainpoint_util.receipt_cache.get(self.hashitem, generation)
+        return record
+
+    def json_describe(self, generation=None):
+        # the data and the receipt are spliced in as JSON instead of being decoded and encoded again
+        record = json.dumps(self.to_dict(include_receipt=False, include_data=False))
+        receipt = chainpoint_util.receipt_cache.get_json(self.hashitem, generation)
+        return '{}, "data": {}, "blockchain_receipt": {}}}'.format(record[:-1], self.payload or "null", receipt)
 
 
 item_confirmation_table = Table('item_confirmation', Base.metadata,
                                 Column('item_id', Integer, ForeignKey('hashitem.id')),
-                                Column('confirmation_id', Integer, ForeignKey('confirmation.id'))
+                                Column('confirmation_id', Integer, ForeignKey('confirmation.id')),
+                                Index("ix_item_confirmation_item_id", "item_id", "confirmation_id"),
+                                Index("ix_item_confirmation_confirmation_id", "confirmation_id")
                                 )
 
 
+class BatchState(Enum):
+    CLAIMED = 'claimed'
+    BUILT = 'built'
+    SUBMITTED = 'submitted'
+    ANCHORED = 'anchored'
+    NOTIFIED = 'notified'
+    FAILED = 'failed'
+    REJECTED = 'rejected'
+
+
+class AnchorBatch(Base):
+    """
+    A merkle tree anchored in one go, stored once for all of its hashitems which only keep their leaf index
+
+    state                       The anchoring stage the batch is in
+        - claimed -                 Hashitems were assigned to the batch, the tree isn't built yet.
+        - built -                   The tree is built and stored, it wasn't handed to the blockchain yet.
+        - submitted -               The root was handed to the blockchain, no transaction is known yet.
+        - anchored -                The confirmations of the anchoring transactions are stored.
+        - notified -                The receipts were sent to all datastores with postReceipt enabled.
+        - failed -                  Anchoring failed, the hashitems were released back to the queue and the levels
+                                    cleared.
+        - rejected -                Holds hashitems whose digest can't be a leaf, which keeps them out of the queue.
+                                    Never anchored and without a tree.
+    merkle_root                 The hex encoded root of the tree
+    leaf_count                  The number of leaves
+    levels                      All levels of the tree concatenated as raw digests, see MerkleTree.get_levels_buffer
+    upper_proof                 The packed proof of merkle_root in the tree of an aggregator node if the batch was
+                                anchored through one, extending the proofs of all items up to the anchored root
+    timestamp                   The number of seconds elapsed since epoch when this batch was anchored
+    """
+    __tablename__ = 'anchor_batch'
+
+    id = Column(Integer, primary_key=True)
+    state = Column(String, nullable=False)
+    merkle_root = Column(String, nullable=True)
+    leaf_count = Column(Integer, nullable=False)
+    levels = deferred(Column(LargeBinary, nullable=True))
+    upper_proof = Column(PackedProof, nullable=True)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    items = relationship("HashItem", back_populates="batch")
+
+    __table_args__ = (Index("ix_anchor_batch_state", state),)
+
+    def __repr__(self):
+        return "<AnchorBatch(id='{}', state='{}', merkle_root='{}', leaf_count='{}')>".format(
+            self.id, self.state, self.merkle_root, self.leaf_count)
+
+    def get_tree(self):
+        """
+        :return: the MerkleTree of this batch, served from tree_cache if possible
+        """
+        return tree_cache.get((self.id, self.merkle_root),
+                              lambda: merkle.MerkleTree.from_levels(self.levels, self.leaf_count))
+
+
 class HashItem(Base):
     __tablename__ = 'hashitem'
 
@@ -161,20 +319,44 @@ class HashItem(Base):
     accountId = Column(Integer, ForeignKey("account.id"), nullable=False)
     sha256 = Column(String, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
-    proof = Column(PickleType)
+    batchId = Column(Integer, ForeignKey("anchor_batch.id"), nullable=True)
+    leafIndex = Column(Integer, nullable=True)
+    stored_proof = Column("proof", PackedProof)  # only set for items anchored before batches were introduced
 
     confirmations = relationship("Confirmation", secondary=item_confirmation_table, back_populates="items")
     record = relationship("Record", uselist=False, back_populates="hashitem")
+    batch = relationship("AnchorBatch", back_populates="items")
+
+    __table_args__ = (Index("ix_hashitem_accountId_timestamp", accountId, timestamp),
+                      Index("ix_hashitem_timestamp", timestamp),
+                      Index("ix_hashitem_batchId_leafIndex", batchId, leafIndex))
+
+    @property
+    def proof(self):
+        """
+        :return: the packed merkle proof of this item, derived from its anchor batch, or None if not yet anchored
+        """
+        if self.stored_proof is not None:
+            return self.stored_proof
+        if self.batch is not None and self.batch.merkle_root is not None:
+            proof = self.batch.get_tree().get_packed_proof(self.leafIndex)
+            if self.batch.upper_proof is not None:
+                proof = merkle.join_proofs(proof, self.batch.upper_proof)
+            return proof
+        return None
 
     def __repr__(self):
         return "<HashItem(id='{}', sha256='{}', pending='{}', timestamp='{}')>".format(
             self.id, self.sha256, len(self.confirmations) == 0, self.timestamp)
 
-    def json_describe(self):
-        return json.dumps({
+    def to_dict(self):
+        return {
             "receipt_id": self.id,
             "timestamp": "{}".format(int(self.timestamp.timestamp()))
-        })
+        }
+
+    def json_describe(self):
+        return json.dumps(self.to_dict())
 
 
 class Confirmation(Base):
@@ -188,14 +370,161 @@ class Confirmation(Base):
 
     items = relationship("HashItem", secondary=item_confirmation_table, back_populates="confirmations")
 
+    __table_args__ = (Index("ix_confirmation_endpoint_tx_id", endpoint, tx_id),
+                      Index("ix_confirmation_block_header", block_header))
+
+
+class ReceiptDelivery(Base):
+    """
+    A receipt queued for delivery to the postReceiptUrl of a datastore, see tierion.delivery
+
+    url                         The URL the receipt is POSTed to
+    receipt                     The JSON encoded Chainpoint receipt
+    attempts                    The number of failed delivery attempts
+    next_attempt                When the next delivery attempt is due
+    failed                      Set once delivery was given up after too many attempts
+    timestamp                   The number of seconds elapsed since epoch when the receipt was queued
+    """
+    __tablename__ = 'receipt_delivery'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False)
+    receipt = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False, default=datetime.utcnow)
+    failed = Column(Boolean, nullable=False, default=False)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (Index("ix_receipt_delivery_failed_next_attempt", failed, next_attempt),
+                      Index("ix_receipt_delivery_url_failed_next_attempt", url, failed, next_attempt))
+
+    def __repr__(self):
+        return "<ReceiptDelivery(id='{}', url='{}', attempts='{}', failed='{}')>".format(
+            self.id, self.url, self.attempts, self.failed)
+
+
+class SchemaVersion(Base):
+    """
+    The migrations applied to the database, see tierion.migrations
+    """
+    __tablename__ = 'schema_version'
 
-def init(connection_string, echo):
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# thread local sessions, e.g. one per request of the REST API, see flask_rest.setup
+Session = scoped_session(sessionmaker())
+
+
+# Engine settings by database, the options of a profile can be overridden one by one, see create_db_engine
+ENGINE_PROFILES = {
+    # WAL lets readers run concurrently with the writer and synchronous=NORMAL only syncs at checkpoints, which is
+    # still safe against corruption in WAL mode. busy_timeout makes writers wait for the lock instead of failing
+    "sqlite": {"pool_class": "queue", "pool_size": 8, "max_overflow": 8,
+               "sqlite_pragmas": {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -65536,
+                                  "busy_timeout": 5000}},
+    # one connection shared by all threads in rollback journal mode, as before profiles were introduced
+    "sqlite-legacy": {"pool_class": "static", "sqlite_pragmas": {}},
+    "postgresql": {"pool_class": "queue", "pool_size": 10, "max_overflow": 20, "pool_pre_ping": True,
+                   "pool_recycle": 1800},
+}
+
+_POOL_CLASSES = {"queue": QueuePool, "static": StaticPool, "null": NullPool}
+
+# environment variables read by options_from_env and the engine option each of them sets
+_ENV_OPTIONS = {
+    "TIERION_DB_POOL_CLASS": ("pool_class", str),
+    "TIERION_DB_POOL_SIZE": ("pool_size", int),
+    "TIERION_DB_MAX_OVERFLOW": ("max_overflow", int),
+    "TIERION_SQLITE_JOURNAL_MODE": ("journal_mode", str),
+    "TIERION_SQLITE_SYNCHRONOUS": ("synchronous", str),
+    "TIERION_SQLITE_CACHE_SIZE": ("cache_size", int),
+}
+
+
+def get_engine_options(connection_string, profile=None, **options):
+    """
+    :param profile: the name of an ENGINE_PROFILES entry, None picks "postgresql" for PostgreSQL URLs and "sqlite"
+                    otherwise
+    :param options: overrides of the profile: pool_class ("queue", "static" or "null"), pool_size, max_overflow,
+                    pool_pre_ping, pool_recycle and sqlite_pragmas, a dict of PRAGMA name -> value
+    :return: the options of the profile with the overrides applied
+    """
+    if profile is None:
+        profile = "postgresql" if connection_string.startswith("postgresql") else "sqlite"
+    if profile not in ENGINE_PROFILES:
+        raise ValueError("Unknown database profile {}".format(profile))
+
+    engine_options = dict(ENGINE_PROFILES[profile])
+    engine_options["sqlite_pragmas"] = dict(engine_options.get("sqlite_pragmas", {}),
+                                            **options.pop("sqlite_pragmas", {}))
+    engine_options.update(options)
+    if connection_string in ("sqlite://", "sqlite:///:memory:"):
+        # an in-memory database only exists in its connection, which all threads have to share, and has no journal
+        engine_options["pool_class"] = "static"
+        engine_options["sqlite_pragmas"].pop("journal_mode", None)
+    return engine_options
+
+
+def options_from_env(environ=None):
+    """
+    :param environ: mapping of environment variables, defaults to os.environ
+    :return: (connection string, profile, options) configured by TIERION_DATABASE_URL, TIERION_DATABASE_PROFILE and
+             the TIERION_DB_* and TIERION_SQLITE_* variables, to be passed on to init
+    """
+    environ = os.environ if environ is None else environ
+    options = {}
+    pragmas = {}
+    for variable, (option, convert) in _ENV_OPTIONS.items():
+        if variable in environ:
+            target = pragmas if variable.startswith("TIERION_SQLITE_") else options
+            target[option] = convert(environ[variable])
+    if len(pragmas) > 0:
+        options["sqlite_pragmas"] = pragmas
+    return environ.get("TIERION_DATABASE_URL", "sqlite:///tierion.db"), environ.get("TIERION_DATABASE_PROFILE"), options
+
+
+def create_db_engine(connection_string, echo=False, profile=None, **options):
+    """
+    Creates an engine configured by a profile, see get_engine_options
+    """
+    engine_options = get_engine_options(connection_string, profile, **options)
+    kwargs = {"echo": echo, "poolclass": _POOL_CLASSES[engine_options["pool_class"]]}
+    if engine_options["pool_class"] == "queue":
+        for option in ["pool_size", "max_overflow", "pool_recycle"]:
+            if option in engine_options:
+                kwargs[option] = engine_options[option]
+    if "pool_pre_ping" in engine_options:
+        kwargs["pool_pre_ping"] = engine_options["pool_pre_ping"]
+
+    is_sqlite = connection_string.startswith("sqlite")
+    if is_sqlite:
+        # sessions of all threads share the pool, each connection is only used by one thread at a time
+        kwargs["connect_args"] = {'check_same_thread': False}
+    new_engine = create_engine(connection_string, **kwargs)
+
+    pragmas = engine_options["sqlite_pragmas"] if is_sqlite else {}
+    if len(pragmas) > 0:
+        @event.listens_for(new_engine, "connect")
+        def _set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute("PRAGMA {}={}".format(name, value))
+            cursor.close()
+    return new_engine
+
+
+def init(connection_string, echo, profile=None, **options):
+    """
+    Creates the engine used by create_session and Session on the first call, see create_db_engine
+    """
     global engine
     if engine is None:
-        engine = create_engine(connection_string, echo=echo,
-                               connect_args={'check_same_thread': False},
-                               poolclass=StaticPool)
+        engine = create_db_engine(connection_string, echo, profile, **options)
         Base.metadata.create_all(engine)
+        Session.configure(bind=engine)
 
     return engine
 
@@ -203,3 +532,16 @@ def init(connection_string, echo):
 def create_session():
     global engine
     return sessionmaker(bind=engine)()
+
+
+@contextmanager
+def session_scope():
+    """
+    Session for one unit of work, e.g. an anchoring or confirmation cycle, closed afterwards even on errors so no
+    transaction and no loaded object outlives the unit of work
+    """
+    session = create_session()
+    try:
+        yield session
+    finally:
+        session.close()
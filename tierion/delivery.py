@@ -0,0 +1,235 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import zip_longest
+from threading import Thread, Condition, Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import func
+
+from tierion import db
+from tierion.db import ReceiptDelivery
+
+# Receipts are delivered to the postReceiptUrl of their datastores off the anchoring thread: notify_batch queues them in
+# the receipt_delivery table in the same transaction that marks the batch notified, a DeliveryThread POSTs them
+
+_queued = Condition()
+_queued_generation = 0
+
+
+def enqueue_receipts(session, receipts, do_commit=True):
+    """
+    Queues receipts for delivery
+    :param receipts: list of (url, receipt) tuples, receipt being a Chainpoint receipt dict
+    """
+    if len(receipts) == 0:
+        return
+    session.bulk_insert_mappings(ReceiptDelivery, [{"url": url, "receipt": json.dumps(receipt)}
+                                                   for url, receipt in receipts])
+    if do_commit:
+        session.commit()
+        receipts_queued()
+
+
+def receipts_queued():
+    """
+    Wakes the delivery threads, to be called once receipts queued with do_commit=False are committed
+    """
+    global _queued_generation
+    with _queued:
+        _queued_generation += 1
+        _queued.notify_all()
+
+
+class ReceiptSender:
+    """
+    POSTs receipts over one keep-alive requests.Session per URL
+    """
+
+    def __init__(self, timeout=10, pool_size=4):
+        """
+        :param timeout: the number of seconds to wait for a receiver to connect and answer
+        :param pool_size: the number of connections kept open per receiver
+        """
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._sessions = {}
+        self._lock = Lock()
+
+    def _get_session(self, url):
+        with self._lock:
+            if url not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["Content-Type"] = "application/json"
+                self._sessions[url] = session
+            return self._sessions[url]
+
+    def __call__(self, url, payload):
+        """
+        :param payload: the JSON encoded receipt or list of receipts
+        :return: True if the receiver accepted the payload
+        """
+        try:
+            res = self._get_session(url).post(url, data=payload, timeout=self._timeout)
+        except requests.RequestException as err:
+            logging.warning("Posting receipts to %s failed: %s", url, err)
+            return False
+        if res.status_code >= 300:
+            logging.warning("Posting receipts to %s failed with status %d", url, res.status_code)
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def deliver_receipts(session, send_fn, executor, batch_size=1, max_attempts=5, backoff=30, limit=1000,
+                     limit_per_url=100):
+    """
+    Delivers the queued receipts that are due, each URL's receipts being POSTed in parallel to those of other URLs
+    :param send_fn: a function of the form (url, payload) -> bool, see ReceiptSender
+    :param executor: the executor the POSTs run on
+    :param batch_size: the number of receipts POSTed at once as JSON list, 1 POSTs single receipts as before
+    :param max_attempts: the number of attempts after which delivery of a receipt is given up
+    :param backoff: the number of seconds to wait before the first retry, doubling with every further attempt
+    :param limit: the maximum number of receipts delivered in one call
+    :param limit_per_url: the maximum number of receipts delivered to one URL in one call, so a URL with a large
+                          backlog doesn't hold back the receipts of the others
+    :return: the number of receipts delivered
+    """
+    now = datetime.utcnow()
+    urls = [url for url, in session.query(ReceiptDelivery.url).distinct()
+            .filter(ReceiptDelivery.failed.is_(False))
+            .filter(ReceiptDelivery.next_attempt <= now)
+            .order_by(ReceiptDelivery.url).limit(limit).all()]
+    if len(urls) == 0:
+        session.rollback()
+        return 0
+
+    per_url = max(batch_size, min(limit_per_url, limit // len(urls)))
+    due_per_url = []
+    for url in urls:
+        due_per_url.append(session.query(ReceiptDelivery.id, ReceiptDelivery.url, ReceiptDelivery.receipt,
+                                         ReceiptDelivery.attempts)
+                           .filter(ReceiptDelivery.url == url)
+                           .filter(ReceiptDelivery.failed.is_(False))
+                           .filter(ReceiptDelivery.next_attempt <= now)
+                           .order_by(ReceiptDelivery.id).limit(per_url).all())
+    session.rollback()  # no transaction is kept open while posting
+    due = [d for deliveries in due_per_url for d in deliveries]
+
+    # the chunks of all URLs are submitted in turns, so the executor doesn't work through one URL's backlog first
+    url_chunks = [[deliveries[i:i + batch_size] for i in range(0, len(deliveries), batch_size)]
+                  for deliveries in due_per_url]
+    chunks = []
+    for turn in zip_longest(*url_chunks):
+        for chunk in turn:
+            if chunk is None:
+                continue
+            url = chunk[0].url
+            if batch_size == 1:
+                payload = chunk[0].receipt
+            else:
+                payload = "[{}]".format(",".join(d.receipt for d in chunk))
+            chunks.append((url, chunk, executor.submit(send_fn, url, payload)))
+
+    delivered = []
+    retries = []
+    for url, chunk, future in chunks:
+        try:
+            ok = future.result()
+        except Exception:
+            logging.exception("Posting receipts to %s failed", url)
+            ok = False
+
+        if ok:
+            delivered.extend(d.id for d in chunk)
+            continue
+        for d in chunk:
+            attempts = d.attempts + 1
+            if attempts >= max_attempts:
+                logging.error("Giving up delivering receipt %s to %s after %d attempts", d.id, url, attempts)
+                retries.append({"id": d.id, "attempts": attempts, "failed": True})
+            else:
+                retries.append({"id": d.id, "attempts": attempts,
+                                "next_attempt": datetime.utcnow() + timedelta(seconds=backoff * 2 ** (attempts - 1))})
+
+    if len(delivered) > 0:
+        session.query(ReceiptDelivery).filter(ReceiptDelivery.id.in_(delivered)).delete(synchronize_session=False)
+    session.bulk_update_mappings(ReceiptDelivery, retries)
+    session.commit()
+    logging.debug("Delivered %d of %d due receipts", len(delivered), len(due))
+    return len(delivered)
+
+
+def get_next_attempt(session):
+    """
+    :return: the time the next queued receipt is due or None if the queue is empty
+    """
+    next_attempt = session.query(func.min(ReceiptDelivery.next_attempt)) \
+        .filter(ReceiptDelivery.failed.is_(False)).scalar()
+    session.rollback()
+    return next_attempt
+
+
+class DeliveryThread(Thread):
+    """
+    Delivers queued receipts whenever new ones are queued or retries are due, the interval only serves as fallback for
+    receipts queued by other processes
+    """
+
+    def __init__(self, interval=30, workers=8, batch_size=1, max_attempts=5, backoff=30, send_fn=None):
+        """
+        :param interval: the maximum number of seconds between checks of the queue, None to only check when woken
+        :param send_fn: a function of the form (url, payload) -> bool, defaults to a ReceiptSender
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.stopped = False
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.sender = ReceiptSender(pool_size=workers) if send_fn is None else None
+        self.send_fn = send_fn if send_fn is not None else self.sender
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="receipt-delivery")
+
+    def run(self):
+        session = db.create_session()
+        while not self.stopped:
+            with _queued:
+                generation = _queued_generation
+            try:
+                while deliver_receipts(session, self.send_fn, self.executor, self.batch_size, self.max_attempts,
+                                       self.backoff) > 0 and not self.stopped:
+                    pass
+                next_attempt = get_next_attempt(session)
+            except Exception:
+                logging.exception("Delivering receipts failed")
+                session.rollback()
+                next_attempt = None
+
+            timeout = self.interval
+            if next_attempt is not None:
+                due_in = max(0.0, (next_attempt - datetime.utcnow()).total_seconds())
+                timeout = due_in if timeout is None else min(timeout, due_in)
+            with _queued:
+                if not self.stopped and generation == _queued_generation:
+                    _queued.wait(timeout)
+
+        session.close()
+        self.executor.shutdown(wait=False)
+        if self.sender is not None:
+            self.sender.close()
+
+    def stop(self):
+        self.stopped = True
+        receipts_queued()
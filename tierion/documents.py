@@ -0,0 +1,59 @@
+import hashlib
+import io
+import mmap
+import os
+
+# Documents are notarized by their sha256 only: uploads are hashed in fixed size chunks as they are read and their
+# content is discarded, so documents of any size are hashed in constant memory.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_stream(stream, chunk_size=CHUNK_SIZE):
+    """
+    Hashes a stream while reading it, e.g. the body of a request
+    :param stream: binary file like object
+    :return: tuple of the hex encoded sha256 and the number of bytes read
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if len(chunk) == 0:
+            return sha256.hexdigest(), size
+        sha256.update(chunk)
+        size += len(chunk)
+
+
+def hash_file(file, chunk_size=CHUNK_SIZE):
+    """
+    Hashes a whole file, memory mapped if it is on disk, e.g. an uploaded file werkzeug spooled to a temporary file
+    :param file: binary file like object
+    :return: tuple of the hex encoded sha256 and the size of the file
+    """
+    fileno = _get_fileno(file)
+    if fileno is None:
+        file.seek(0)
+        return hash_stream(file, chunk_size)
+
+    size = os.fstat(fileno).st_size
+    sha256 = hashlib.sha256()
+    if size > 0:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, chunk_size):
+                    sha256.update(view[offset:offset + chunk_size])
+            finally:
+                view.release()
+    return sha256.hexdigest(), size
+
+
+def _get_fileno(file):
+    # a SpooledTemporaryFile only has a file descriptor once it rolled over to disk, asking for it earlier would
+    # write the in-memory content to disk, so its underlying file is checked instead
+    file = getattr(file, "_file", file)
+    try:
+        return file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
@@ -1,11 +1,17 @@
 import logging
+import re
 import sys
 from datetime import datetime
 
 import sqlalchemy.exc
+from sqlalchemy import func
 
+from tierion.arrivals import arrivals
 from tierion.db import HashItem
 
+# bytes.fromhex skips whitespace, so digests are checked against the hex digits themselves
+_HEX_DIGITS = re.compile("[0-9a-fA-F]*")
+
 
 def create_hashitem(session, account_id, hex_data, do_commit=True):
     item = HashItem(accountId=account_id, sha256=hex_data)
@@ -14,6 +20,7 @@ def create_hashitem(session, account_id, hex_data, do_commit=True):
     if do_commit:
         try:
             session.commit()
+            arrivals.arrived()
         except sqlalchemy.exc.InterfaceError:
             logging.error("Error creating record: %s", sys.exc_info())
             session.rollback()
@@ -22,33 +29,138 @@ def create_hashitem(session, account_id, hex_data, do_commit=True):
     return item
 
 
-def get_hashitem(session, account_id=None, page=1, page_size=100, start_date=None, end_date=None, item_id=None, pending=None, for_update=False):
+def validate_hex_digests(hex_digests, digest_size=32):
+    """
+    :param hex_digests: list of hex encoded digests
+    :return: list of errors as dicts of the index of the invalid digest and a message
+    """
+    length = 2 * digest_size
+    if all(isinstance(hex_data, str) and len(hex_data) == length for hex_data in hex_digests):
+        # a single match over all digests instead of one per digest for the common all-valid case
+        if _HEX_DIGITS.fullmatch("".join(hex_digests)):
+            return []
+
+    errors = []
+    for i, hex_data in enumerate(hex_digests):
+        if not isinstance(hex_data, str) or len(hex_data) != length or not _HEX_DIGITS.fullmatch(hex_data):
+            errors.append({"index": i, "error": "Hash has to be a string of {} hex digits".format(length)})
+    return errors
+
+
+def create_hashitems(session, account_id, hex_digests, do_commit=True):
+    """
+    Creates many hashitems at once with multi-row INSERT statements in a single transaction, see create_hashitem
+    :param hex_digests: list of hex encoded sha256 digests
+    :return: tuple of the list of created hashitem IDs in the order of hex_digests, None for invalid digests, and the
+             list of errors as returned by validate_hex_digests. None if the insert failed
+    """
+    errors = validate_hex_digests(hex_digests)
+    invalid = {error["index"] for error in errors}
+    valid = [i for i in range(len(hex_digests)) if i not in invalid]
+
+    ids = [None] * len(hex_digests)
+    if len(valid) == 0:
+        return ids, errors
+    try:
+        for i, item_id in zip(valid, insert_hashitems(session, account_id, [hex_digests[i].lower() for i in valid])):
+            ids[i] = item_id
+        if do_commit:
+            session.commit()
+            arrivals.arrived(len(valid))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logging.error("Error creating hashitems: %s", sys.exc_info())
+        session.rollback()
+        return None
+
+    return ids, errors
+
+
+def insert_hashitems(session, account_id, hex_digests, chunk_size=499):
+    """
+    Inserts hashitems with multi-row INSERT statements in the session's transaction, without creating ORM objects
+    :param hex_digests: list of hex encoded sha256 digests
+    :param chunk_size: the number of rows per statement, SQLite allows at most 999 parameters per statement and every
+                       row takes two
+    :return: the IDs of the inserted hashitems in the order of hex_digests
+    """
+    table = HashItem.__table__
+    dialect = session.get_bind().dialect
+    ids = []
+    for i in range(0, len(hex_digests), chunk_size):
+        rows = [{"accountId": account_id, "sha256": hex_data} for hex_data in hex_digests[i:i + chunk_size]]
+        if dialect.name == "sqlite":
+            # SQLite assigns the rows of one statement consecutive IDs ending at lastrowid
+            last_id = session.execute(table.insert().values(rows)).lastrowid
+            ids.extend(range(last_id - len(rows) + 1, last_id + 1))
+        elif dialect.implicit_returning:
+            ids.extend(row[0] for row in session.execute(table.insert().values(rows).returning(table.c.id)))
+        else:
+            ids.extend(session.execute(table.insert().values(row)).inserted_primary_key[0] for row in rows)
+    return ids
+
+
+def _filter_hashitems(query, account_id=None, start_date=None, end_date=None, pending=None, after_id=None,
+                      up_to_id=None, claimable=None):
+    if account_id is not None:
+        query = query.filter(HashItem.accountId == account_id)
+    if start_date is not None:
+        query = query.filter(HashItem.timestamp > datetime.fromtimestamp(start_date))
+    if end_date is not None:
+        query = query.filter(HashItem.timestamp < datetime.fromtimestamp(end_date))
+    if pending is not None:
+        query = query.filter(~HashItem.confirmations.any() if pending else HashItem.confirmations.any())
+    if after_id is not None:
+        query = query.filter(HashItem.id > after_id)
+    if up_to_id is not None:
+        query = query.filter(HashItem.id <= up_to_id)
+    if claimable:
+        query = query.filter(HashItem.batchId.is_(None)).filter(~HashItem.confirmations.any())
+    return query
+
+
+def get_hashitem(session, account_id=None, page=1, page_size=100, start_date=None, end_date=None, item_id=None, pending=None, for_update=False,
+                 after_id=None, up_to_id=None):
+    """
+    :param after_id:    Cursor for walking large result sets, if set only items with an ID greater than this are
+                        returned, ordered by ID and page is ignored
+    :param up_to_id:    If set only items with an ID less than or equal to this are returned
+    """
     query = session.query(HashItem)
     if account_id is not None:
-        query.filter(HashItem.accountId == account_id)
+        query = query.filter(HashItem.accountId == account_id)
 
     if item_id is not None:
         query = query.filter(HashItem.id == item_id)
         if for_update:
-            query.with_for_update()
-        if len(query.all()) == 1:
-            return query.all()[0]
-        logging.error("Query for HashItem with id %s returned %s results", item_id, len(query.all()))
+            query = query.with_for_update()
+        res = query.all()
+        if len(res) == 1:
+            return res[0]
+        logging.error("Query for HashItem with id %s returned %s results", item_id, len(res))
         return None
     else:
-        if start_date is not None:
-            query = query.filter(HashItem.timestamp > datetime.fromtimestamp(start_date))
-        if end_date is not None:
-            query = query.filter(HashItem.timestamp < datetime.fromtimestamp(end_date))
-        if pending is not None:
-            query = query.filter(~HashItem.confirmations.any() if pending else HashItem.confirmations.any())
-
-        query = query.limit(page_size).offset((page - 1) * page_size)
+        query = _filter_hashitems(query, start_date=start_date, end_date=end_date, pending=pending,
+                                  after_id=after_id, up_to_id=up_to_id)
+
+        if after_id is not None:
+            query = query.order_by(HashItem.id).limit(page_size)
+        else:
+            query = query.limit(page_size).offset((page - 1) * page_size)
         if for_update:
-            query.with_for_update()
+            query = query.with_for_update()
         return query.all()
 
 
+def count_hashitems(session, account_id=None, start_date=None, end_date=None, pending=None, claimable=None):
+    """
+    :param claimable:   If set only hashitems that are neither anchored nor part of an anchoring batch are counted
+    :return: tuple of the number of hashitems matching the criteria, the highest matching ID and the oldest matching
+             timestamp (both None if nothing matches)
+    """
+    query = session.query(func.count(HashItem.id), func.max(HashItem.id), func.min(HashItem.timestamp))
+    return _filter_hashitems(query, account_id, start_date, end_date, pending, claimable=claimable).one()
+
+
 # def get_receipt(session, receipt_id):
 #     res = session.query(HashItem).filter(HashItem.receipt_id == receipt_id).all()
 #
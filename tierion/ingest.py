@@ -0,0 +1,126 @@
+import json
+import logging
+import time
+
+from tierion.arrivals import arrivals
+
+# Uploads of newline delimited JSON are read line by line and committed in chunks, so an upload of any size runs in
+# constant memory unless the client asks for all created IDs. Reading pauses while the anchoring queue is over its
+# limit or the database takes longer than its budget to commit a chunk, which holds the client back through TCP flow
+# control.
+
+
+def iter_ndjson(stream, max_line_length=65536):
+    """
+    :param stream: binary file like object, e.g. the request stream
+    :param max_line_length: the maximum number of bytes of a line, longer lines are skipped and reported as error
+    :return: generator yielding (line number, item, error) tuples for all non-empty lines, item being None if the line
+             isn't valid JSON and error None otherwise
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_length + 1)
+        if len(line) == 0:
+            return
+        line_number += 1
+
+        if len(line) > max_line_length and not line.endswith(b"\n"):
+            while len(line) > 0 and not line.endswith(b"\n"):
+                line = stream.readline(max_line_length + 1)  # skip the rest of the line
+            yield line_number, None, "Line exceeds {} bytes".format(max_line_length)
+            continue
+
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            yield line_number, json.loads(line.decode("utf-8")), None
+        except ValueError as err:
+            yield line_number, None, "Invalid JSON: {}".format(err)
+
+
+def ingest_ndjson(lines, insert_fn, chunk_size=1000, max_pending=None, pending_timeout=30, chunk_budget=1.0,
+                  max_errors=100, include_ids=False):
+    """
+    Inserts the items of an upload in chunks, each committed on its own
+    :param lines: iterable of (line number, item, error) tuples as yielded by iter_ndjson
+    :param insert_fn: a function of the form ([item]) -> (ids, errors) or None, see create_records and
+                      create_hashitems, committing the items and reporting errors by index into the chunk
+    :param chunk_size: the number of items committed at once
+    :param max_pending: the number of pending hashitems at which reading pauses until anchoring caught up, None to
+                        never pause for the anchoring queue
+    :param pending_timeout: the maximum number of seconds to pause for the anchoring queue before giving up
+    :param chunk_budget: the number of seconds a chunk may take to commit, reading pauses for as long as a chunk took
+                         longer
+    :param max_errors: the maximum number of errors reported, the rest is only counted
+    :param include_ids: whether to list the IDs that can't be reported as ranges, e.g. record UUIDs, which makes the
+                        summary grow with the upload
+    :return: dict summarizing the upload: lineCount, createdCount, errorCount, errors (list of dicts of line and
+             error), idRanges (list of [first, last] ranges of consecutive integer IDs created), ids (list of the
+             other IDs created in line order, only if include_ids is set), complete (False if the upload was
+             aborted) and committedLines (the number of lines fully processed, an aborted upload can be resumed after
+             that line)
+    """
+    summary = {"lineCount": 0, "createdCount": 0, "errorCount": 0, "errors": [], "idRanges": [], "complete": True,
+               "committedLines": 0}
+    if include_ids:
+        summary["ids"] = []
+
+    def add_error(line_number, error):
+        summary["errorCount"] += 1
+        if len(summary["errors"]) < max_errors:
+            summary["errors"].append({"line": line_number, "error": error})
+
+    def flush(chunk, last_line):
+        if len(chunk) > 0:
+            if max_pending is not None and not arrivals.wait_below(max_pending, pending_timeout):
+                logging.warning("Anchoring queue still holds %d hashitems after %ds, aborting upload",
+                                arrivals.get_pending_count(), pending_timeout)
+                return False
+
+            start = time.perf_counter()
+            result = insert_fn([item for _, item in chunk])
+            if result is None:
+                return False
+            ids, errors = result
+            for error in errors:
+                add_error(chunk[error["index"]][0], error["error"])
+            for item_id in ids:
+                if item_id is None:
+                    continue
+                summary["createdCount"] += 1
+                if isinstance(item_id, int):
+                    _add_to_ranges(summary["idRanges"], item_id)
+                elif include_ids:
+                    summary["ids"].append(item_id)
+
+            overshoot = time.perf_counter() - start - chunk_budget
+            if overshoot > 0:
+                logging.debug("Committing %d items took %.2fs longer than budgeted, pausing", len(chunk), overshoot)
+                time.sleep(overshoot)
+        summary["committedLines"] = last_line
+        return True
+
+    chunk = []
+    for line_number, item, error in lines:
+        summary["lineCount"] = line_number
+        if error is not None:
+            add_error(line_number, error)
+        else:
+            chunk.append((line_number, item))
+        if len(chunk) >= chunk_size:
+            if not flush(chunk, line_number):
+                summary["complete"] = False
+                return summary
+            chunk = []
+
+    if not flush(chunk, summary["lineCount"]):
+        summary["complete"] = False
+    return summary
+
+
+def _add_to_ranges(ranges, item_id):
+    if len(ranges) > 0 and ranges[-1][1] + 1 == item_id:
+        ranges[-1][1] = item_id
+    else:
+        ranges.append([item_id, item_id])
@@ -0,0 +1,285 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+HASH_SIZE = 32
+
+
+class MerkleTree:
+    """
+    Merkle tree over raw 32 byte SHA256 digests, compatible with the trees and Chainpoint v2 proofs produced by
+    merkletools.MerkleTools: pairs are hashed as sha256(left + right) and an odd node at the end of a level is promoted
+    to the next level unchanged.
+
+    Every level is kept as a single contiguous buffer of concatenated digests, level 0 being the leaves.
+    """
+
+    def __init__(self, leaves):
+        """
+        :param leaves: bytes-like object holding the concatenated 32 byte leaf digests
+        """
+        if len(leaves) % HASH_SIZE != 0:
+            raise ValueError("Leaf buffer length {} is not a multiple of {}".format(len(leaves), HASH_SIZE))
+
+        self.levels = [bytes(leaves)]
+        self._make_tree()
+
+    @classmethod
+    def from_levels(cls, levels, leaf_count):
+        """
+        Restores a tree from the buffer returned by get_levels_buffer without rehashing
+        :param levels: bytes-like object holding all levels concatenated, leaves first
+        :param leaf_count: number of leaves of the tree
+        :return: the MerkleTree
+        """
+        tree = cls.__new__(cls)
+        tree.levels = []
+        offset = 0
+        level_len = leaf_count
+        while True:
+            tree.levels.append(bytes(levels[offset:offset + level_len * HASH_SIZE]))
+            offset += level_len * HASH_SIZE
+            if level_len <= 1:
+                break
+            level_len = (level_len + 1) // 2
+
+        if offset != len(levels):
+            raise ValueError("Levels buffer of length {} does not hold a tree of {} leaves".format(len(levels),
+                                                                                                 leaf_count))
+        return tree
+
+    @classmethod
+    def from_hex(cls, hex_leaves):
+        """
+        Builds a tree from a list of hex encoded SHA256 digests
+        :param hex_leaves: list of 64 character hex strings
+        :return: the MerkleTree
+        """
+        for i, leaf in enumerate(hex_leaves):
+            if len(leaf) != 2 * HASH_SIZE:
+                raise ValueError("Leaf {} is not a hex encoded SHA256 digest: {}".format(i, leaf))
+        return cls(bytes.fromhex("".join(hex_leaves)))
+
+    def _make_tree(self):
+        level = self.levels[0]
+        while len(level) > HASH_SIZE:
+            view = memoryview(level)
+            paired = len(level) - len(level) % (2 * HASH_SIZE)
+            sha256 = hashlib.sha256
+            next_level = bytearray(b"".join(sha256(view[i:i + 2 * HASH_SIZE]).digest()
+                                             for i in range(0, paired, 2 * HASH_SIZE)))
+            if paired != len(level):
+                next_level += view[paired:]  # promote the odd node
+
+            level = bytes(next_level)
+            self.levels.append(level)
+
+    def get_levels_buffer(self):
+        """
+        :return: all levels concatenated into one buffer, leaves first, see from_levels
+        """
+        return b"".join(self.levels)
+
+    def get_leaf_count(self):
+        return len(self.levels[0]) // HASH_SIZE
+
+    def get_leaf(self, index):
+        return self.levels[0][index * HASH_SIZE:(index + 1) * HASH_SIZE].hex()
+
+    def get_merkle_root(self):
+        """
+        :return: hex encoded merkle root or None if the tree has no leaves
+        """
+        if self.get_leaf_count() == 0:
+            return None
+        return self.levels[-1].hex()
+
+    def get_proof(self, index):
+        """
+        Computes the Chainpoint v2 proof for a single leaf
+        :param index: index of the leaf
+        :return: list of {"left"|"right": <hex>} dicts ordered from the leaf to the root or None if out of range
+        """
+        if index < 0 or index >= self.get_leaf_count():
+            return None
+
+        proof = []
+        for level in self.levels[:-1]:
+            level_len = len(level) // HASH_SIZE
+            if not (index == level_len - 1 and level_len % 2 == 1):
+                is_right_node = index % 2
+                sibling_index = index - 1 if is_right_node else index + 1
+                proof.append({"left" if is_right_node else "right":
+                              level[sibling_index * HASH_SIZE:(sibling_index + 1) * HASH_SIZE].hex()})
+            index //= 2
+        return proof
+
+    def get_packed_proof(self, index):
+        """
+        Computes the proof for a single leaf in the packed binary encoding, see encode_proof
+        :param index: index of the leaf
+        :return: the packed proof or None if out of range
+        """
+        if index < 0 or index >= self.get_leaf_count():
+            return None
+
+        directions = 0
+        siblings = []
+        for level in self.levels[:-1]:
+            level_len = len(level) // HASH_SIZE
+            if not (index == level_len - 1 and level_len % 2 == 1):
+                if index % 2:
+                    directions |= 1 << len(siblings)
+                sibling_index = index ^ 1
+                siblings.append(level[sibling_index * HASH_SIZE:(sibling_index + 1) * HASH_SIZE])
+            index //= 2
+        return _pack_proof(len(siblings), directions, siblings)
+
+    def get_proofs(self):
+        """
+        Computes the Chainpoint v2 proofs of all leaves in one sweep over the levels, every node is hex encoded at most
+        once and shared between the proofs that reference it
+        :return: list of proofs in leaf order, see get_proof
+        """
+        leaf_count = self.get_leaf_count()
+        proofs = [[] for _ in range(leaf_count)]
+
+        for height, level in enumerate(self.levels[:-1]):
+            level_len = len(level) // HASH_SIZE
+            level_hex = level.hex()
+
+            # the sibling of every node that has one, an odd last node has none and is skipped
+            siblings = []
+            for node in range(level_len - level_len % 2):
+                sibling = node ^ 1
+                siblings.append({"left" if node % 2 else "right":
+                                 level_hex[sibling * 2 * HASH_SIZE:(sibling + 1) * 2 * HASH_SIZE]})
+
+            # at this height leaf i sits at node i >> height
+            for leaf in range(leaf_count):
+                node = leaf >> height
+                if node < len(siblings):
+                    proofs[leaf].append(siblings[node])
+
+        return proofs
+
+
+class TreeCache:
+    """
+    Small thread safe LRU cache of MerkleTrees
+    """
+
+    def __init__(self, max_size=8):
+        """
+        :param max_size: the maximum number of trees kept, 0 disables caching
+        """
+        self.max_size = max_size
+        self._trees = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, loader):
+        """
+        :param key: hashable key identifying the tree
+        :param loader: function of the form () -> MerkleTree called on a cache miss
+        :return: the cached or loaded tree
+        """
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+                return tree
+
+        tree = loader()
+        self.put(key, tree)
+        return tree
+
+    def put(self, key, tree):
+        with self._lock:
+            if self.max_size > 0:
+                self._trees[key] = tree
+                self._trees.move_to_end(key)
+                while len(self._trees) > self.max_size:
+                    self._trees.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+def _pack_proof(count, directions, siblings):
+    return bytes([count]) + directions.to_bytes((count + 7) // 8, "little") + b"".join(siblings)
+
+
+def _unpack_proof(packed):
+    count = packed[0]
+    offset = 1 + (count + 7) // 8
+    siblings = packed[offset:]
+    if len(siblings) != count * HASH_SIZE:
+        raise ValueError("Packed proof of {} siblings has invalid length {}".format(count, len(packed)))
+    return count, int.from_bytes(packed[1:offset], "little"), siblings
+
+
+def join_proofs(lower, upper):
+    """
+    Extends a packed proof leading to the leaf of another tree with the packed proof of that leaf, e.g. a batch proof
+    with the proof of the batch root in an aggregated tree
+    :param lower: the packed proof starting at the target hash
+    :param upper: the packed proof starting at the root of lower
+    :return: the packed proof leading from the target hash to the root of upper
+    """
+    lower_count, lower_directions, lower_siblings = _unpack_proof(lower)
+    upper_count, upper_directions, upper_siblings = _unpack_proof(upper)
+    return _pack_proof(lower_count + upper_count, lower_directions | upper_directions << lower_count,
+                       [lower_siblings, upper_siblings])
+
+
+def encode_proof(proof):
+    """
+    Packs a Chainpoint v2 proof into its compact binary form: one byte holding the number of siblings n, a bitmap of
+    ceil(n / 8) bytes in which bit i is set if sibling i is a left node, followed by the n raw 32 byte siblings
+    :param proof: list of {"left"|"right": <hex>} dicts
+    :return: the packed proof as bytes
+    """
+    directions = 0
+    siblings = []
+    for i, p in enumerate(proof):
+        if "left" in p:
+            directions |= 1 << i
+            siblings.append(bytes.fromhex(p["left"]))
+        else:
+            siblings.append(bytes.fromhex(p["right"]))
+    return _pack_proof(len(siblings), directions, siblings)
+
+
+def decode_proof(packed):
+    """
+    Unpacks a proof packed by encode_proof
+    :param packed: the packed proof
+    :return: list of {"left"|"right": <hex>} dicts
+    """
+    count, directions, siblings = _unpack_proof(packed)
+    siblings = siblings.hex()
+    return [{"left" if directions >> i & 1 else "right": siblings[i * 2 * HASH_SIZE:(i + 1) * 2 * HASH_SIZE]}
+            for i in range(count)]
+
+
+def validate_proof(proof, target_hash, merkle_root):
+    """
+    Validates a Chainpoint v2 proof
+    :param proof: list of {"left"|"right": <hex>} dicts
+    :param target_hash: hex encoded leaf
+    :param merkle_root: hex encoded merkle root
+    :return: True if the proof leads from target_hash to merkle_root
+    """
+    proof_hash = bytes.fromhex(target_hash)
+    for p in proof:
+        if "left" in p:
+            proof_hash = hashlib.sha256(bytes.fromhex(p["left"]) + proof_hash).digest()
+        else:
+            proof_hash = hashlib.sha256(proof_hash + bytes.fromhex(p["right"])).digest()
+
+    valid = proof_hash == bytes.fromhex(merkle_root)
+    if not valid:
+        logging.debug("Proof for %s does not lead to merkle root %s", target_hash, merkle_root)
+    return valid
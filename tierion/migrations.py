@@ -0,0 +1,203 @@
+import json
+import logging
+import pickle
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, func, text
+
+from tierion import db
+from tierion.db import Account, AnchorBatch, Confirmation, DataStore, HashItem, ReceiptDelivery, Record, SchemaVersion
+from tierion.db import BatchState, item_confirmation_table
+
+# Databases created by create_all already have the current schema, the migrations bring databases created by earlier
+# versions up to date. Every migration has to be idempotent as it's also recorded for fresh databases.
+
+
+def _add_anchor_batch_columns(connection):
+    columns = [c["name"] for c in inspect(connection).get_columns(HashItem.__tablename__)]
+    if "batchId" not in columns:
+        connection.execute('ALTER TABLE hashitem ADD COLUMN "batchId" INTEGER REFERENCES anchor_batch (id)')
+    if "leafIndex" not in columns:
+        connection.execute('ALTER TABLE hashitem ADD COLUMN "leafIndex" INTEGER')
+
+
+def _create_indexes(connection):
+    tables = [Account.__table__, DataStore.__table__, Record.__table__, HashItem.__table__, item_confirmation_table,
+              Confirmation.__table__, AnchorBatch.__table__, ReceiptDelivery.__table__]
+    inspector = inspect(connection)
+    for table in tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info("Creating index %s", index.name)
+                index.create(connection)
+
+
+def _compact_record_payloads(connection, batch_size=1000):
+    # records used to keep their data twice, pickled in the data column and as JSON in the json column, the JSON is
+    # moved to the payload column and both are cleared. The legacy columns are kept, SQLite before 3.35 can't drop
+    # them, and the freed pages stay in an SQLite file until VACUUM is run by hand, which can't run in a transaction
+    columns = [c["name"] for c in inspect(connection).get_columns(Record.__tablename__)]
+    if "payload" not in columns:
+        payload_type = Record.__table__.c.payload.type.compile(dialect=connection.dialect)
+        connection.execute('ALTER TABLE record ADD COLUMN payload {}'.format(payload_type))
+    legacy = [column for column in ["json", "data"] if column in columns]
+    if len(legacy) == 0:
+        return
+
+    select = text('SELECT id, {} FROM record WHERE payload IS NULL AND id > :after ORDER BY id LIMIT {}'.format(
+        ", ".join('"{}"'.format(column) for column in legacy), batch_size))
+    update = text('UPDATE record SET payload = :payload, {} WHERE id = :id'.format(
+        ", ".join('"{}" = NULL'.format(column) for column in legacy)))
+    after = ""
+    converted = 0
+    while True:
+        rows = connection.execute(select, after=after).fetchall()
+        if len(rows) == 0:
+            break
+        updates = []
+        for row in rows:
+            legacy_json = row["json"] if "json" in legacy else None
+            if legacy_json is None and "data" in legacy and row["data"] is not None:
+                legacy_json = json.dumps(pickle.loads(row["data"]))
+            if legacy_json is not None:
+                updates.append({"id": row["id"], "payload": db.encode_payload(legacy_json)})
+        if len(updates) > 0:
+            connection.execute(update, updates)
+        converted += len(updates)
+        after = rows[-1]["id"]
+    logging.info("Converted the payload of %d records", converted)
+    if converted > 0 and connection.dialect.name == "sqlite":
+        logging.info("Run VACUUM on the database to shrink its file")
+
+
+def _clear_failed_batch_levels(connection):
+    # failed batches used to keep their tree although none of their hashitems will ever be proven by it
+    connection.execute(AnchorBatch.__table__.update().where(AnchorBatch.state == BatchState.FAILED.value)
+                       .values(levels=None))
+
+
+def _add_record_timestamp_fractions(connection):
+    # SQLite stores timestamps as strings and its CURRENT_TIMESTAMP server default has no fraction, such rows compare
+    # as smaller than a cursor of the same second, which carries microseconds, and were skipped when paging
+    if connection.dialect.name == "sqlite":
+        connection.execute("UPDATE record SET timestamp = timestamp || '.000000' WHERE length(timestamp) = 19")
+
+
+MIGRATIONS = [
+    (1, "Columns of anchor batches", _add_anchor_batch_columns),
+    (2, "Indexes for the hot query paths", _create_indexes),
+    (3, "Single copy record payloads", _compact_record_payloads),
+    (4, "Drop the trees of failed batches", _clear_failed_batch_levels),
+    (5, "Microseconds in legacy record timestamps", _add_record_timestamp_fractions),
+    (6, "Index for the receipts due per URL", _create_indexes),
+]
+
+
+def get_schema_version(session):
+    """
+    :return: the version of the last migration applied or 0 if none was
+    """
+    version = session.query(func.max(SchemaVersion.version)).scalar()
+    session.rollback()
+    return version if version is not None else 0
+
+
+def migrate(engine):
+    """
+    Creates missing tables and applies all pending migrations, each in its own transaction
+    :return: the schema version after migrating
+    """
+    db.Base.metadata.create_all(engine)
+    session = db.create_session()
+    version = get_schema_version(session)
+    session.close()
+
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logging.info("Migrating database to version %d: %s", migration_version, description)
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=migration_version,
+                                                                       description=description))
+        version = migration_version
+    return version
+
+
+def _hot_queries(session):
+    # the query shapes issued on every API request or anchoring cycle, see accounts.login, datastore.get_datastore,
+    # record.iter_records, record.count_records, hashitem.get_hashitem and count_hashitems, tierion.anchoring,
+    # tierion.confirmations and tierion.delivery
+    from tierion.hashitem import _filter_hashitems
+    from tierion.record import iter_records, _filter_records
+
+    now = datetime.utcnow()
+    return {
+        "login": session.query(Account).filter(Account.email == "user@example.com"),
+        "get_datastore": session.query(DataStore).filter(DataStore.accountId == 1),
+        "record_page": iter_records(session, 1, datastoreId=1, startDate=0, endDate=2000000000, after=(now, "")),
+        "record_count": _filter_records(session.query(func.count(Record.id)), 1, 1, 0, 2000000000),
+        "record_by_hashitem": session.query(Record.id).filter(Record.hashitemId.in_([1, 2])),
+        "hashitems_by_date": _filter_hashitems(session.query(HashItem), 1, start_date=0, end_date=2000000000),
+        "expired_hashitems": _filter_hashitems(session.query(func.count(HashItem.id)), end_date=2000000000,
+                                               claimable=True),
+        "claimable_hashitems": _filter_hashitems(session.query(HashItem.id, HashItem.sha256), up_to_id=100,
+                                                 claimable=True)
+        .order_by(HashItem.id).limit(100),
+        "batch_leaves": session.query(HashItem.sha256).filter(HashItem.batchId == 1).order_by(HashItem.leafIndex),
+        "interrupted_batches": session.query(AnchorBatch).filter(AnchorBatch.state.in_(["claimed", "built"])),
+        "pending_confirmations": session.query(Confirmation.endpoint, Confirmation.tx_id)
+        .filter(Confirmation.block_header.is_(None)),
+        "confirmation_by_tx": session.query(Confirmation).filter(Confirmation.endpoint == "ETHData")
+        .filter(Confirmation.tx_id == "0x0"),
+        "confirmed_items": session.query(item_confirmation_table.c.item_id)
+        .join(Confirmation, Confirmation.id == item_confirmation_table.c.confirmation_id)
+        .filter(Confirmation.endpoint == "ETHData").filter(Confirmation.tx_id.in_(["0x0"])),
+        "due_receipts": session.query(ReceiptDelivery.id).filter(ReceiptDelivery.failed.is_(False))
+        .filter(ReceiptDelivery.next_attempt <= now + timedelta(days=1)),
+        "due_receipts_of_url": session.query(ReceiptDelivery.id).filter(ReceiptDelivery.url == "https://a")
+        .filter(ReceiptDelivery.failed.is_(False)).filter(ReceiptDelivery.next_attempt <= now)
+        .order_by(ReceiptDelivery.id),
+    }
+
+
+def explain_hot_queries(session):
+    """
+    Logs the query plan of every hot query and warns about plans that scan a whole table
+    :return: dict of query name -> list of plan lines
+    """
+    dialect = session.get_bind().dialect
+    prefix = "EXPLAIN QUERY PLAN " if dialect.name == "sqlite" else "EXPLAIN "
+    plans = {}
+    for name, query in _hot_queries(session).items():
+        compiled = query.statement.compile(dialect=dialect)
+        params = compiled.construct_params()
+        if dialect.positional:
+            params = [params[key] for key in compiled.positiontup]
+        rows = session.get_bind().execute(prefix + str(compiled), params).fetchall()
+        plan = [" ".join(str(column) for column in row) for row in rows]
+        plans[name] = plan
+
+        full_scans = [line for line in plan if _is_full_scan(line)]
+        if len(full_scans) > 0:
+            logging.warning("Query %s scans whole tables: %s", name, full_scans)
+        else:
+            logging.info("Query %s: %s", name, plan)
+    return plans
+
+
+def _is_full_scan(plan_line):
+    # SQLite reports "SCAN TABLE x" (or "SCAN x") without "USING ... INDEX", PostgreSQL "Seq Scan on x"
+    if "Seq Scan" in plan_line:
+        return True
+    return " SCAN " in " {} ".format(plan_line) and "INDEX" not in plan_line
+
+
+if __name__ == "__main__":
+    # python -m tierion.migrations [connection string]
+    logging.basicConfig(level=logging.INFO)
+    engine = db.init(sys.argv[1] if len(sys.argv) > 1 else "sqlite:///tierion.db", False)
+    logging.info("Database is at schema version %d", migrate(engine))
+    explain_hot_queries(db.create_session())
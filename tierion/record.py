@@ -1,16 +1,23 @@
-import hashlib
-import json
+import base64
+import binascii
 import logging
 import sys
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
 
 import sqlalchemy.exc
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload, selectinload
 
 from tierion import get_datastore, get_account
-from tierion.hashitem import create_hashitem
-from tierion.db import Record
+from tierion.arrivals import arrivals
+from tierion.canonical import canonical_json, sha256_hex, payload_hasher
+from tierion.hashitem import create_hashitem, insert_hashitems
+from tierion.db import Record, HashItem
+
+
+_CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
 
 class RecordState(Enum):
@@ -36,34 +43,97 @@ def get_record(session, account_id, datastoreId=None, page=1, pageSize=100, star
     if id is not None:
         query = session.query(Record).filter(Record.accountId == account_id).filter(Record.id == id)
         if for_update:
-            query.with_for_update()
-        if len(query.all()) == 1:
-            return query.all()[0]
-        logging.error("Query for Record with ID %s returned %s results", id, len(query.all()))
+            query = query.with_for_update()
+        res = query.all()
+        if len(res) == 1:
+            return res[0]
+        logging.error("Query for Record with ID %s returned %s results", id, len(res))
         return None
     else:
-        query = session.query(Record).filter(Record.accountId == account_id)
-        if datastoreId is not None:
-            query = query.filter(Record.datastoreId == datastoreId)
-        if startDate is not None:
-            query = query.filter(Record.timestamp > datetime.fromtimestamp(startDate))
-        if endDate is not None:
-            query = query.filter(Record.timestamp < datetime.fromtimestamp(endDate))
-        if status is not None:
-            query = query.filter(Record.status == status)
-
+        query = _filter_records(session.query(Record), account_id, datastoreId, startDate, endDate, status)
         query = query.limit(pageSize).offset((page - 1) * pageSize)
         if for_update:
-            query.with_for_update()
+            query = query.with_for_update()
         return query.all()
 
 
+def iter_records(session, account_id, datastoreId=None, page=1, pageSize=100, startDate=None, endDate=None,
+                 status=None, after=None, batch_size=500):
+    """
+    Like get_record, but yields the records in (timestamp, id) order while they are fetched from the database in chunks
+    of batch_size instead of loading the whole page at once
+    :param after: (timestamp, id) of the last record of the previous page as decoded by decode_cursor. If set the page
+                  starts right after that record, which uses the (accountId, datastoreId, timestamp, id) index instead of
+                  skipping all earlier rows, and page is ignored
+    """
+    query = _filter_records(session.query(Record), account_id, datastoreId, startDate, endDate, status)
+    # the receipts of records missing from the receipt cache are built from the batch and confirmations of their
+    # hashitem, which are loaded along with every chunk instead of one record at a time
+    query = query.options(joinedload(Record.hashitem).joinedload(HashItem.batch),
+                          joinedload(Record.hashitem).selectinload(HashItem.confirmations)) \
+        .order_by(Record.timestamp, Record.id)
+    if after is not None:
+        after_timestamp, after_id = after
+        query = query.filter(or_(Record.timestamp > after_timestamp,
+                                 and_(Record.timestamp == after_timestamp, Record.id > after_id)))
+    else:
+        query = query.offset((page - 1) * pageSize)
+    return query.limit(pageSize).yield_per(batch_size)
+
+
+def count_records(session, account_id, datastoreId=None, startDate=None, endDate=None, status=None):
+    """
+    :return: the number of records matching the criteria, see get_record
+    """
+    query = _filter_records(session.query(func.count(Record.id)), account_id, datastoreId, startDate, endDate, status)
+    return query.scalar()
+
+
+def encode_cursor(record):
+    """
+    :param record: the last record of a page
+    :return: an opaque token the next page can be requested with, see decode_cursor
+    """
+    timestamp = record.timestamp
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    raw = "{}|{}".format(timestamp.strftime(_CURSOR_TIME_FORMAT), record.id)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    """
+    :param token: a token returned by encode_cursor
+    :return: (timestamp, id) of the record the token was created for
+    :raises ValueError: if the token is malformed
+    """
+    try:
+        timestamp, record_id = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").split("|", 1)
+        return datetime.strptime(timestamp, _CURSOR_TIME_FORMAT), record_id
+    except (ValueError, UnicodeError, binascii.Error) as err:
+        raise ValueError("Invalid cursor {}".format(token)) from err
+
+
+def _filter_records(query, account_id, datastoreId=None, startDate=None, endDate=None, status=None):
+    query = query.filter(Record.accountId == account_id)
+    if datastoreId is not None:
+        query = query.filter(Record.datastoreId == datastoreId)
+    if startDate is not None:
+        query = query.filter(Record.timestamp > datetime.fromtimestamp(startDate))
+    if endDate is not None:
+        query = query.filter(Record.timestamp < datetime.fromtimestamp(endDate))
+    if status is not None:
+        query = query.filter(Record.status == status)
+    return query
+
+
 def create_record(session, account_id, datastore_id, data, status=RecordState.QUEUED.value[0], do_commit=True):
     """
     :param session:                     The session to be used for the DB connection
     :param account_id:	                A unique numeric identifier for the Account associated with this Record.
     :param datastore_id: 	            A unique numeric identifier for the Datastore associated with this Record.
     :param data:                        A dynamic collection of key/value pairs representing the custom data received for this Record.
+                                        Stored and hashed as its canonical JSON, see tierion.canonical.
     :param status:                      The records status, default is 'queued'
     :param do_commit:                   Whether to commit the transaction or not
     ":return:                           The created record or None on failure
@@ -78,26 +148,31 @@ def create_record(session, account_id, datastore_id, data, status=RecordState.QU
         logging.error("User %s does not exist!", account_id)
         return None
 
-    _json = json.dumps(data)
+    try:
+        _json = canonical_json(data)
+        sha256 = sha256_hex(_json)
+    except ValueError:
+        logging.error("Record data can't be serialized: %s", sys.exc_info())
+        return None
 
-    hashitem = create_hashitem(session, account_id, hashlib.sha256(bytearray(_json, 'utf-8')).hexdigest(), False)
+    hashitem = create_hashitem(session, account_id, sha256, False)
 
     rec = Record(
         id=str(uuid.uuid4()),
         datastoreId=datastore_id,
         accountId=account_id,
         status=status,
-        data=data,
-        json=_json,
+        payload=_json,
         hashitem=hashitem
     )
-    ds.records.append(rec)
-    user.records.append(rec)
+    # the IDs link the record to its datastore and account, appending it to ds.records and user.records would load
+    # all their records
 
     session.add(rec)
     if do_commit:
         try:
             session.commit()
+            arrivals.arrived()
         except sqlalchemy.exc.InterfaceError:
             logging.error("Error creating record: %s", sys.exc_info())
             session.rollback()
@@ -106,6 +181,65 @@ def create_record(session, account_id, datastore_id, data, status=RecordState.QU
     return rec
 
 
+def create_records(session, account_id, datastore_id, items, status=RecordState.QUEUED.value[0], do_commit=True):
+    """
+    Creates many records of one datastore at once: their canonical JSON is hashed in one pass, large payloads in
+    parallel, and the hashitems and records are inserted with bulk statements in a single transaction, see
+    create_record
+    :param items:                       list of dicts of custom data, one per record
+    :return:                            tuple of the list of created record IDs in the order of items, None for items that
+                                        failed, and the list of errors as dicts of the index of the item and a message.
+                                        None if the datastore or account doesn't exist or the insert failed
+    """
+    if get_datastore(session, account_id, datastore_id) is None:
+        logging.error("DataStore %s does not exist!", datastore_id)
+        return None
+    if get_account(session, account_id) is None:
+        logging.error("User %s does not exist!", account_id)
+        return None
+
+    ids = [None] * len(items)
+    errors = []
+    valid = []
+
+    def serialize():
+        # consumed by hash_many, which hashes large payloads on its pool while the next ones are serialized
+        for i, data in enumerate(items):
+            if not isinstance(data, dict):
+                errors.append({"index": i, "error": "Record data has to be a JSON object"})
+                continue
+            try:
+                _json = canonical_json(data)
+                raw = _json.encode("utf-8")  # fails for lone surrogates, see sha256_hex
+            except ValueError as err:
+                errors.append({"index": i, "error": "Record data can't be serialized: {}".format(err)})
+                continue
+            valid.append((i, _json))
+            yield raw
+
+    digests = payload_hasher.hash_many(serialize())
+    if len(valid) == 0:
+        return ids, errors
+    timestamp = datetime.utcnow()
+    try:
+        hashitem_ids = insert_hashitems(session, account_id, digests)
+        rows = []
+        for (i, _json), hashitem_id in zip(valid, hashitem_ids):
+            ids[i] = str(uuid.uuid4())
+            rows.append({"id": ids[i], "accountId": account_id, "datastoreId": datastore_id, "status": status,
+                         "payload": _json, "timestamp": timestamp, "hashitemId": hashitem_id})
+        session.execute(Record.__table__.insert(), rows)
+        if do_commit:
+            session.commit()
+            arrivals.arrived(len(rows))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logging.error("Error creating records: %s", sys.exc_info())
+        session.rollback()
+        return None
+
+    return ids, errors
+
+
 def delete_record(session, account_id, record_id, do_commit=True):
     """
 
@@ -0,0 +1,92 @@
+import logging
+from contextlib import contextmanager
+
+# Accounts and datastores are looked up over and over while serving one request, e.g. once per record created. A
+# Repository opened on a session memoizes them until it is closed, get_account and get_datastore use it when there is
+# one and query the database otherwise.
+
+_INFO_KEY = "tierion.repository"
+
+
+class Repository:
+    """
+    Identity map of the entities looked up in one session during a request, counting the queries it saved
+    """
+
+    def __init__(self):
+        self._entities = {}
+        self.queries = 0
+        self.queries_saved = 0
+
+    def get(self, key, load_fn):
+        """
+        :param key: hashable identifying the entity, e.g. ("account", id)
+        :param load_fn: a function of the form () -> entity or None, only called if the entity isn't memoized yet
+        :return: the entity or None if it doesn't exist
+        """
+        if key in self._entities:
+            self.queries_saved += 1
+            return self._entities[key]
+
+        self.queries += 1
+        entity = load_fn()
+        if entity is not None:
+            self._entities[key] = entity
+        return entity
+
+    def forget(self, entity):
+        """
+        Drops an entity, to be called when it gets deleted
+        """
+        for key in [key for key, memoized in self._entities.items() if memoized is entity]:
+            del self._entities[key]
+
+    def get_stats(self):
+        return {"size": len(self._entities), "queries": self.queries, "queries_saved": self.queries_saved}
+
+
+def open_repository(session):
+    """
+    Starts memoizing the lookups of a session, see close_repository
+    :return: the Repository
+    """
+    repository = Repository()
+    session.info[_INFO_KEY] = repository
+    return repository
+
+
+def close_repository(session):
+    """
+    Stops memoizing the lookups of a session
+    :return: the closed Repository or None if none was open
+    """
+    repository = session.info.pop(_INFO_KEY, None)
+    if repository is not None and repository.queries_saved > 0:
+        logging.debug("Repository saved %d of %d lookups", repository.queries_saved,
+                      repository.queries + repository.queries_saved)
+    return repository
+
+
+@contextmanager
+def repository_scope(session):
+    repository = open_repository(session)
+    try:
+        yield repository
+    finally:
+        close_repository(session)
+
+
+def lookup(session, key, load_fn):
+    """
+    Looks up an entity through the repository open on the session or with load_fn if there is none
+    """
+    repository = session.info.get(_INFO_KEY)
+    if repository is None:
+        return load_fn()
+    return repository.get(key, load_fn)
+
+
+def forget(session, entity):
+    repository = session.info.get(_INFO_KEY)
+    if repository is not None:
+        repository.forget(entity)
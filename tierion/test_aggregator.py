@@ -0,0 +1,165 @@
+import hashlib
+import time
+from threading import Thread, Event
+from unittest import TestCase
+from uuid import uuid4
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+import flask_rest
+from tierion import db, accounts, hashitem, _check_queue_fn
+from tierion.aggregator import Aggregator, AggregatorClient
+from tierion.chainpoint_util import build_chainpoint_receipt, receipt_cache
+from tierion.merkle import MerkleTree, validate_proof
+
+
+def _random_leaves(count):
+    return [hashlib.sha256(uuid4().bytes).hexdigest() for _ in range(count)]
+
+
+class TestAggregator(TestCase):
+    def setUp(self):
+        self.anchored_roots = []
+
+    def anchor_cb(self, merkle_root):
+        self.anchored_roots.append(merkle_root)
+        return [("ETHData", "0xfakeTxId{}".format(len(self.anchored_roots)))]
+
+    def test_child_roots_are_anchored_once(self):
+        aggregator = Aggregator(self.anchor_cb, max_roots=3)
+        child_trees = [MerkleTree.from_hex(_random_leaves(5)) for _ in range(3)]
+        results = [None] * 3
+
+        def child(i):
+            results[i] = aggregator.submit(child_trees[i].get_merkle_root(), timeout=10)
+
+        threads = [Thread(target=child, args=(i,)) for i in range(3)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        assert len(self.anchored_roots) == 1
+        for tree, result in zip(child_trees, results):
+            assert result["merkleRoot"] == self.anchored_roots[0]
+            assert result["anchors"] == [("ETHData", "0xfakeTxId1")]
+            for i, leaf_proof in enumerate(tree.get_proofs()):
+                assert validate_proof(leaf_proof + result["proof"], tree.get_leaf(i), result["merkleRoot"])
+
+    def test_failed_anchoring_is_reported_to_all_children(self):
+        aggregator = Aggregator(lambda _: None, max_roots=2)
+        results = []
+        threads = [Thread(target=lambda: results.append(aggregator.submit(_random_leaves(1)[0], timeout=10)))
+                   for _ in range(2)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        assert results == [None, None]
+
+    def test_submission_times_out_without_aggregation(self):
+        aggregator = Aggregator(self.anchor_cb)
+        assert aggregator.submit(_random_leaves(1)[0], timeout=0.01) is None
+        assert aggregator.aggregate() == 0
+
+    def test_submission_waits_for_started_anchoring(self):
+        anchoring = Event()
+
+        def slow_anchor_cb(merkle_root):
+            anchoring.set()
+            time.sleep(0.2)
+            return self.anchor_cb(merkle_root)
+
+        aggregator = Aggregator(slow_anchor_cb)
+        results = []
+        submitter = Thread(target=lambda: results.append(aggregator.submit(_random_leaves(1)[0], timeout=0.1)))
+        submitter.start()
+        aggregating = Thread(target=aggregator.aggregate)
+        time.sleep(0.05)
+        aggregating.start()
+        assert anchoring.wait(1)
+        submitter.join()
+        aggregating.join()
+
+        assert results[0]["merkleRoot"] == self.anchored_roots[0]
+
+    def test_invalid_root_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Aggregator(self.anchor_cb).submit("not a hash")
+
+
+class TestAggregatedAnchoring(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        self.session = db.create_session()
+        self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
+
+    def test_child_receipts_are_extended_to_aggregated_root(self):
+        anchored_roots = []
+
+        def anchor_cb(merkle_root):
+            anchored_roots.append(merkle_root)
+            return [("ETHData", "0xfakeTxId")]
+
+        aggregator = Aggregator(anchor_cb, max_roots=2)
+        sibling_root = _random_leaves(1)[0]
+        sibling = Thread(target=aggregator.submit, args=(sibling_root, 10))
+        sibling.start()
+
+        for _ in range(3):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        assert _check_queue_fn(aggregator.as_anchoring_callback(10), 0, 0) == 3
+        sibling.join()
+
+        assert len(anchored_roots) == 1
+        for item in hashitem.get_hashitem(self.session):
+            receipt = build_chainpoint_receipt(item)
+            assert receipt["merkleRoot"] == anchored_roots[0]
+            assert receipt["anchors"] == [{"type": "ETHData", "sourceId": "0xfakeTxId"}]
+            assert validate_proof(receipt["proof"], receipt["targetHash"], receipt["merkleRoot"])
+
+    def test_children_submit_over_rest(self):
+        anchored_roots = []
+
+        def anchor_cb(merkle_root):
+            anchored_roots.append(merkle_root)
+            return [("ETHData", "0xfakeTxId")]
+
+        aggregator = Aggregator(anchor_cb, max_roots=3)
+        app = Flask(__name__)
+        flask_rest.setup(app, self.session, aggregator, aggregation_timeout=10)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            url = "http://127.0.0.1:{}".format(server.server_port)
+            children = [AggregatorClient(url, self.user.email, self.user.apiKey, timeout=10) for _ in range(3)]
+            roots = _random_leaves(3)
+            results = [None] * 3
+
+            def child(i):
+                results[i] = children[i](roots[i])
+
+            threads = [Thread(target=child, args=(i,)) for i in range(3)]
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+        finally:
+            server.shutdown()
+
+        assert len(anchored_roots) == 1
+        for root, anchors in zip(roots, results):
+            assert len(anchors) == 1
+            endpoint, tx_id, anchored_root, proof = anchors[0]
+            assert (endpoint, tx_id, anchored_root) == ("ETHData", "0xfakeTxId", anchored_roots[0])
+            assert validate_proof(proof, root, anchored_root)
+
+    def test_rest_submission_requires_login(self):
+        app = Flask(__name__)
+        flask_rest.setup(app, self.session, Aggregator(lambda _: None))
+        res = app.test_client().post("/api/v1/aggregator/roots", json={"merkleRoot": _random_leaves(1)[0]},
+                                     headers={"X-Username": self.user.email, "X-Api-Key": "wrong"})
+        assert res.status_code == 403
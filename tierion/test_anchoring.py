@@ -0,0 +1,165 @@
+import hashlib
+from unittest import TestCase
+from uuid import uuid4
+
+from tierion import db, accounts, datastore, hashitem, record, anchoring, _check_queue_fn, RecordState
+from tierion.chainpoint_util import receipt_cache
+from tierion.db import AnchorBatch, BatchState, Confirmation
+
+
+class TestAnchoringStages(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        self.session = db.create_session()
+        self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
+        self.datastore = datastore.create_datastore(self.session, self.user.id, "testDS", "testGroup")
+
+    def create_hashitems(self, count):
+        return [hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+                for _ in range(count)]
+
+    def batch_states(self):
+        self.session.rollback()
+        return [b.state for b in self.session.query(AnchorBatch).order_by(AnchorBatch.id).all()]
+
+    def test_ingest_continues_while_batch_is_submitted(self):
+        self.create_hashitems(3)
+        seen = {}
+
+        def test_cb(merkle_root):
+            seen["states"] = self.batch_states()
+            seen["late_item"] = self.create_hashitems(1)[0].id
+            return [("ETHData", "0xfakeId")]
+
+        assert _check_queue_fn(test_cb, 0, 0) == 3
+        assert seen["states"] == [BatchState.SUBMITTED.value]
+        assert self.batch_states() == [BatchState.NOTIFIED.value]
+
+        late_item = hashitem.get_hashitem(self.session, item_id=seen["late_item"])
+        assert late_item.batchId is None
+        assert len(hashitem.get_hashitem(self.session, pending=True)) == 1
+
+    def test_claimed_items_are_not_claimed_twice(self):
+        self.create_hashitems(5)
+        first = anchoring.claim_batch(self.session, 3)
+        second = anchoring.claim_batch(self.session, 3)
+        assert anchoring.claim_batch(self.session, 3) is None
+
+        assert (first.leaf_count, second.leaf_count) == (3, 2)
+        items = hashitem.get_hashitem(self.session)
+        assert sorted((x.batchId, x.leafIndex) for x in items) == \
+            [(first.id, 0), (first.id, 1), (first.id, 2), (second.id, 0), (second.id, 1)]
+
+    def test_failed_batch_is_released(self):
+        self.create_hashitems(2)
+        assert _check_queue_fn(lambda _: None, 0, 0) == 0
+
+        assert self.batch_states() == [BatchState.FAILED.value]
+        assert self.session.query(AnchorBatch).one().levels is None
+        assert all(x.batchId is None and x.leafIndex is None for x in hashitem.get_hashitem(self.session))
+        assert _check_queue_fn(lambda _: [("ETHData", "0xfakeId")], 0, 0) == 2
+
+    def test_invalid_hashitems_are_rejected(self):
+        valid = self.create_hashitems(2)
+        invalid = [hashitem.create_hashitem(self.session, self.user.id, hex_data)
+                   for hex_data in ["a" * 62 + "  ", "zz" * 32]]
+        roots = []
+
+        def test_cb(merkle_root):
+            roots.append(merkle_root)
+            return [("ETHData", "0xfakeId")]
+
+        assert _check_queue_fn(test_cb, 0, 0) == 2
+        assert _check_queue_fn(test_cb, 0, 0) == 0
+        assert len(roots) == 1
+        assert self.batch_states() == [BatchState.REJECTED.value, BatchState.NOTIFIED.value]
+        rejected = self.session.query(AnchorBatch).filter(AnchorBatch.state == BatchState.REJECTED.value).one()
+        assert [x.batchId for x in invalid] == [rejected.id, rejected.id]
+        assert all(x.proof is not None for x in valid)
+        assert all(x.proof is None for x in invalid)
+
+    def test_only_invalid_hashitems_are_not_anchored(self):
+        hashitem.create_hashitem(self.session, self.user.id, "zz" * 32)
+        assert anchoring.claim_batch(self.session, 10) is None
+        assert self.batch_states() == [BatchState.REJECTED.value]
+
+    def test_late_anchors_are_stored(self):
+        items = self.create_hashitems(2)
+        roots = []
+
+        def test_cb(merkle_root):
+            roots.append(merkle_root)
+            return [("ETHData", "0xfakeId")]
+
+        _check_queue_fn(test_cb, 0, 0)
+        anchoring.add_late_anchor(roots[0], "BTCOpReturn", "fakeBtcId")
+        anchoring.add_late_anchor("ff" * 32, "ETHData", "0xorphan")
+        assert anchoring.persist_late_anchors(self.session) == 2
+
+        for item in items:
+            self.session.refresh(item)
+            assert sorted((c.endpoint, c.tx_id) for c in item.confirmations) == \
+                [("BTCOpReturn", "fakeBtcId"), ("ETHData", "0xfakeId")]
+        orphan = self.session.query(Confirmation).filter(Confirmation.tx_id == "0xorphan").one()
+        assert orphan.merkle_root == "ff" * 32 and len(orphan.items) == 0
+
+    def test_persist_marks_records_unpublished(self):
+        record.create_record(self.session, self.user.id, self.datastore.id, "foobar0")
+        batch = anchoring.claim_batch(self.session, 10)
+        anchoring.build_batch_tree(self.session, batch)
+        anchoring.persist_batch(self.session, batch, [("ETHData", "0xfakeId"), ("BTCOpReturn", "fakeBtcId")])
+
+        rec = record.get_record(self.session, self.user.id)[0]
+        assert rec.status == RecordState.UNPUBLISHED.value[0]
+        assert sorted(c.endpoint for c in rec.hashitem.confirmations) == ["BTCOpReturn", "ETHData"]
+        assert batch.state == BatchState.ANCHORED.value
+
+    def test_recover_releases_unsubmitted_and_notifies_anchored_batches(self):
+        ds = datastore.create_datastore(self.session, self.user.id, "postDS", "testGroup", post_receipt_enabled=True,
+                                        post_receipt_url="https://foobar")
+        record.create_record(self.session, self.user.id, ds.id, "foobar0")
+        anchored = anchoring.claim_batch(self.session, 10)
+        anchoring.build_batch_tree(self.session, anchored)
+        anchoring.persist_batch(self.session, anchored, [("ETHData", "0xfakeId")])
+        self.create_hashitems(2)
+        anchoring.claim_batch(self.session, 10)
+        posted = []
+
+        assert anchoring.recover_batches(self.session, lambda url, receipt: posted.append(url)) == 2
+        assert posted == ["https://foobar"]
+        assert self.batch_states() == [BatchState.NOTIFIED.value, BatchState.FAILED.value]
+        assert len(hashitem.get_hashitem(self.session, pending=True)) == 2
+
+    def test_recover_submits_submitted_batches_again(self):
+        self.create_hashitems(2)
+        batch = anchoring.claim_batch(self.session, 10)
+        anchoring.build_batch_tree(self.session, batch)
+        merkle_root = batch.merkle_root
+        anchoring.submit_batch(self.session, batch, lambda root: None)
+        anchored_roots = []
+
+        def callback(root):
+            anchored_roots.append(root)
+            return [("ETHData", "0xfakeId")]
+
+        assert anchoring.recover_batches(self.session, callback=callback) == 1
+        assert anchored_roots == [merkle_root]
+        assert self.batch_states() == [BatchState.NOTIFIED.value]
+        assert all(len(item.confirmations) == 1 for item in hashitem.get_hashitem(self.session))
+
+    def test_recover_releases_submitted_batches_without_callback(self):
+        self.create_hashitems(2)
+        batch = anchoring.claim_batch(self.session, 10)
+        anchoring.build_batch_tree(self.session, batch)
+        anchoring.submit_batch(self.session, batch, lambda root: None)
+
+        assert anchoring.recover_batches(self.session) == 1
+        assert self.batch_states() == [BatchState.FAILED.value]
+        assert len(hashitem.get_hashitem(self.session, pending=True)) == 2
+        assert anchoring.claim_batch(self.session, 10) is not None
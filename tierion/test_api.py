@@ -1,11 +1,18 @@
 import hashlib
 import json
+import pickle
+import time
+from threading import Event
 from unittest import TestCase
 from uuid import uuid4
 
-from tierion import db, datastore, record, accounts, hashitem, _check_queue_fn, RecordState, _check_confirmations_fn
+from sqlalchemy import event
+
+from tierion import db, datastore, record, accounts, hashitem, repository, _check_queue_fn, RecordState, _check_confirmations_fn, \
+    start_anchoring_timer, stop_anchoring_thread, build_merkle_tree
 from tierion.db import Record
-from tierion.chainpoint_util import build_chainpoint_receipt
+from tierion.chainpoint_util import build_chainpoint_receipt, receipt_cache
+from tierion.merkle import validate_proof
 
 
 class TestDataStoreAPI(TestCase):
@@ -14,6 +21,8 @@ class TestDataStoreAPI(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
 
         self.session = db.create_session()
         self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
@@ -88,6 +97,8 @@ class TestAccountsAPI(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
         self.session = db.create_session()
 
     def test_create_user_and_log_in(self):
@@ -101,6 +112,37 @@ class TestAccountsAPI(TestCase):
         assert login_ok is False
         assert account_id is None
 
+    def test_api_key_login_is_cached(self):
+        acct = accounts.create_account(self.session, "test", "test@test.com", "test user", "password")
+        hits, misses = accounts.auth_cache.hits, accounts.auth_cache.misses
+
+        assert accounts.login(self.session, "test@test.com", api_key=acct.apiKey) == (True, acct.id)
+        assert accounts.login(self.session, "test@test.com", api_key=acct.apiKey) == (True, acct.id)
+        assert accounts.login(self.session, "test@test.com", api_key="wrong key") == (False, None)
+        assert accounts.auth_cache.hits - hits == 1
+        assert accounts.auth_cache.misses - misses == 2
+
+        accounts.delete_account(self.session, acct.id)
+        assert accounts.login(self.session, "test@test.com", api_key=acct.apiKey) == (False, None)
+
+    def test_auth_cache_expiry(self):
+        cache = accounts.AuthCache(ttl=0.05, max_size=2)
+        cache.put("a@test.com", "key", 1, cache.get_generation())
+        assert cache.get("a@test.com", "key") == 1
+        assert cache.get("a@test.com", "other key") is None
+        time.sleep(0.1)
+        assert cache.get("a@test.com", "key") is None
+        assert cache.get_stats() == {"size": 0, "hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+    def test_login_read_before_invalidation_isnt_cached(self):
+        acct = accounts.create_account(self.session, "test", "test@test.com", "test user", "password")
+        generation = accounts.auth_cache.get_generation()
+        accounts.delete_account(self.session, acct.id)
+
+        accounts.auth_cache.put("test@test.com", acct.apiKey, acct.id, generation)
+        assert accounts.auth_cache.get("test@test.com", acct.apiKey) is None
+        assert accounts.login(self.session, "test@test.com", api_key=acct.apiKey) == (False, None)
+
 
 class TestRecordAPI(TestCase):
     def setUp(self):
@@ -108,6 +150,8 @@ class TestRecordAPI(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
 
         self.session = db.create_session()
         self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
@@ -119,7 +163,8 @@ class TestRecordAPI(TestCase):
         r = record.create_record(self.session, self.user.id, self.ds1.id, data)
 
         assert r is not None
-        assert r.json == json.dumps(data)
+        assert r.json == '{"a":"1","b":"2"}'
+        assert r.hashitem.sha256 == hashlib.sha256(b'{"a":"1","b":"2"}').hexdigest()
 
     def test_create_two_records(self):
         data1 = {"a": "1", "b": "2"}
@@ -133,6 +178,36 @@ class TestRecordAPI(TestCase):
     def test_get_non_existant_record(self):
         assert record.get_record(self.session, self.user.id, id=42) is None
 
+    def test_create_records_in_repository_scope(self):
+        user_id, ds_id = self.user.id, self.ds1.id
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count_statement)
+        try:
+            with repository.repository_scope(self.session) as repo:
+                counts = []
+                for i in range(5):
+                    del statements[:]
+                    assert record.create_record(self.session, user_id, ds_id, {"i": i}) is not None
+                    counts.append(len(statements))
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count_statement)
+
+        # the first record looks up the datastore and account, every further one only inserts its hashitem and record
+        assert counts[1:] == [2] * 4
+        assert counts[0] == 4
+        assert repo.get_stats() == {"size": 2, "queries": 2, "queries_saved": 8}
+        assert "tierion.repository" not in self.session.info
+
+    def test_deleted_datastore_is_forgotten(self):
+        with repository.repository_scope(self.session):
+            assert datastore.get_datastore(self.session, self.user.id, self.ds2.id) is self.ds2
+            datastore.delete_datastore(self.session, self.user.id, self.ds2.id)
+            assert datastore.get_datastore(self.session, self.user.id, 2) is None
+
     def test_get_specific_record(self):
         data1 = {"a": "1", "b": "2"}
         data2 = {"a": "1", "b": "3"}
@@ -166,6 +241,9 @@ class TestRecordAPI(TestCase):
     def test_create_record_invalid_datastore(self):
         assert record.create_record(self.session, self.user.id, -1, {}) is None
 
+    def test_create_record_with_lone_surrogate_fails(self):
+        assert record.create_record(self.session, self.user.id, self.ds1.id, {"a": "\ud800"}) is None
+
     def test_create_record_invalid_account(self):
         assert record.create_record(self.session, 42, self.ds1.id, {}) is None
 
@@ -190,6 +268,8 @@ class TestHashAPI(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
 
         self.session = db.create_session()
         self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
@@ -209,6 +289,16 @@ class TestHashAPI(TestCase):
 
         assert len(items) == 2
 
+    def test_get_hashitems_with_cursor(self):
+        items = [hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+                 for _ in range(5)]
+
+        page1 = hashitem.get_hashitem(self.session, page_size=2, after_id=0)
+        page2 = hashitem.get_hashitem(self.session, page_size=2, after_id=page1[-1].id)
+        page3 = hashitem.get_hashitem(self.session, page_size=2, after_id=page2[-1].id, up_to_id=items[3].id)
+
+        assert [x.id for x in page1 + page2 + page3] == [x.id for x in items[:4]]
+
     def test_get_not_pending_hashitems(self):
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
@@ -217,6 +307,31 @@ class TestHashAPI(TestCase):
 
         assert len(items) == 0
 
+    def test_create_hashitems(self):
+        hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        digests = [hashlib.sha256(uuid4().bytes).hexdigest() for _ in range(1200)]
+        digests[3] = "not hex" * 9 + "z"
+        digests[7] = digests[7][:-2]
+        digests[8] = digests[8].upper()
+
+        ids, errors = hashitem.create_hashitems(self.session, self.user.id, digests)
+
+        assert [error["index"] for error in errors] == [3, 7]
+        assert ids[3] is None and ids[7] is None
+        valid = [i for i in range(len(digests)) if i not in (3, 7)]
+        items = {item.id: item.sha256 for item in hashitem.get_hashitem(self.session, page_size=2000)}
+        assert len(items) == len(valid) + 1
+        assert [items[ids[i]] for i in valid] == [digests[i].lower() for i in valid]
+
+    def test_hashes_with_whitespace_are_rejected(self):
+        digests = [hashlib.sha256(uuid4().bytes).hexdigest(), "a" * 62 + "  ", "a" * 31 + " " + "a" * 32,
+                   "\t" + "a" * 63]
+
+        ids, errors = hashitem.create_hashitems(self.session, self.user.id, digests)
+
+        assert [error["index"] for error in errors] == [1, 2, 3]
+        assert ids[0] is not None and ids[1:] == [None, None, None]
+
 
 class TestAnchorCheckerFunctions(TestCase):
     def setUp(self):
@@ -224,6 +339,8 @@ class TestAnchorCheckerFunctions(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
 
         self.session = db.create_session()
         self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
@@ -341,6 +458,76 @@ class TestAnchorCheckerFunctions(TestCase):
         assert all_records[0].status == RecordState.UNPUBLISHED.value[0]
         assert len(all_records[0].hashitem.confirmations) == 1
 
+    def test_whole_queue_is_drained_in_trees_of_bounded_size(self):
+        for _ in range(250):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest(), False)
+        self.session.commit()
+        anchored_roots = []
+
+        def test_cb(merkle_root_to_be_anchored):
+            anchored_roots.append(merkle_root_to_be_anchored)
+            return [("ETHData", "0xfakeId")]
+
+        assert _check_queue_fn(test_cb, 0, 600, max_leaves_per_tree=100) == 250
+        assert len(anchored_roots) == 3
+        assert len(hashitem.get_hashitem(self.session, pending=True)) == 0
+        assert len(hashitem.get_hashitem(self.session, pending=False, page_size=1000)) == 250
+
+    def test_draining_stops_when_anchoring_fails(self):
+        for _ in range(5):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        call_count = 0
+
+        def test_cb(merkle_root_to_be_anchored):
+            nonlocal call_count
+            call_count += 1
+            return None
+
+        assert _check_queue_fn(test_cb, 0, 600, max_leaves_per_tree=2) == 0
+        assert call_count == 1
+        assert len(hashitem.get_hashitem(self.session, pending=True)) == 5
+
+    def test_empty_queue_is_not_anchored(self):
+        def test_cb(merkle_root_to_be_anchored):
+            raise AssertionError("Callback must not be called for an empty queue")
+
+        assert _check_queue_fn(test_cb, 0, 0) == 0
+
+    def test_anchoring_thread_is_woken_by_arrivals(self):
+        anchored = Event()
+
+        def test_cb(merkle_root_to_be_anchored):
+            anchored.set()
+            return [("ETHData", "0xfakeId")]
+
+        thr = start_anchoring_timer(test_cb, queue_max_size=2, record_max_age=600, checking_interval=None)
+        time.sleep(0.1)  # the thread checks the queue when it starts, both can't use the in-memory database at once
+        try:
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+            assert not anchored.wait(0.2)
+            record.create_record(self.session, self.user.id, self.datastore.id, "foobar0")
+            assert anchored.wait(5)
+        finally:
+            stop_anchoring_thread(thr)
+            thr.join(5)
+
+    def test_anchoring_thread_backs_off_after_failure(self):
+        call_count = 0
+
+        def test_cb(merkle_root_to_be_anchored):
+            nonlocal call_count
+            call_count += 1
+            return None
+
+        hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        thr = start_anchoring_timer(test_cb, queue_max_size=1, record_max_age=600, checking_interval=0.01, backoff=600)
+        try:
+            time.sleep(0.3)
+            assert call_count == 1
+        finally:
+            stop_anchoring_thread(thr)
+            thr.join(5)
+
     def test_confirmation_checker_updates_confirmations(self):
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
         record.create_record(self.session, self.user.id, self.datastore.id, "foobar0")
@@ -370,6 +557,23 @@ class TestAnchorCheckerFunctions(TestCase):
         assert hashitems[0].confirmations[0] is not None
         assert hashitems[1].confirmations[0] is not None
 
+    def test_confirmations_are_resolved_per_endpoint_in_bulk(self):
+        for i in range(3):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+            _check_queue_fn(lambda _: [("ETHData", "0xeth{}".format(i)), ("BTCOpReturn", "btc{}".format(i))], 0, 0)
+        calls = []
+
+        def test_bulk_cb(endpoint, tx_ids):
+            calls.append((endpoint, sorted(tx_ids)))
+            return {tx_id: None if tx_id == "btc2" else "0xblock-" + tx_id for tx_id in tx_ids}
+
+        assert _check_confirmations_fn(None, test_bulk_cb) == 5
+        assert sorted(calls) == [("BTCOpReturn", ["btc0", "btc1", "btc2"]), ("ETHData", ["0xeth0", "0xeth1", "0xeth2"])]
+
+        calls.clear()
+        _check_confirmations_fn(None, test_bulk_cb)
+        assert calls == [("BTCOpReturn", ["btc2"])]
+
     def test_post_receipt_is_not_sent_when_disabled(self):
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
         record.create_record(self.session, self.user.id, self.datastore.id, "foobar0",)
@@ -422,11 +626,22 @@ class TestUtils(TestCase):
 
         db.Base.metadata.drop_all(bind=self.engine)
         db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
 
         self.session = db.create_session()
         self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
         self.datastore = datastore.create_datastore(self.session, self.user.id, "testDS", "testGroup")
 
+    def test_build_merkle_tree(self):
+        items = [hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+                 for _ in range(5)]
+
+        merkle_root, proofs = build_merkle_tree(items)
+        assert sorted(proofs) == sorted(item.id for item in items)
+        for item in items:
+            assert validate_proof(proofs[item.id], item.sha256, merkle_root)
+
     def test_create_receipt_for_confirmed_item(self):
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
         _check_queue_fn(lambda _: [("Ethereum", "0xfakeTxId")], 0, 0)
@@ -448,6 +663,77 @@ class TestUtils(TestCase):
         assert len(receipt["anchors"]) == 1
         assert receipt['anchors'][0] == {'type': 'Ethereum', 'sourceId': '0xfakeTxId'}
 
+    def test_receipt_proof_is_decoded_and_valid(self):
+        for _ in range(5):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        _check_queue_fn(lambda _: [("Ethereum", "0xfakeTxId")], 0, 0)
+
+        for item in hashitem.get_hashitem(self.session):
+            assert isinstance(item.proof, bytes)
+            receipt = build_chainpoint_receipt(item)
+            assert validate_proof(receipt["proof"], receipt["targetHash"], receipt["merkleRoot"])
+
+    def test_anchored_tree_is_stored_once_and_proofs_derived_from_it(self):
+        for _ in range(7):
+            hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        _check_queue_fn(lambda _: [("Ethereum", "0xfakeTxId")], 0, 0)
+        db.tree_cache.clear()
+
+        batches = self.session.query(db.AnchorBatch).all()
+        assert len(batches) == 1
+        assert batches[0].leaf_count == 7
+        items = hashitem.get_hashitem(self.session)
+        assert sorted(x.leafIndex for x in items) == list(range(7))
+        for item in items:
+            assert item.batchId == batches[0].id
+            assert item.stored_proof is None
+            receipt = build_chainpoint_receipt(item)
+            assert receipt["merkleRoot"] == batches[0].merkle_root
+            assert validate_proof(receipt["proof"], receipt["targetHash"], receipt["merkleRoot"])
+
+    def test_legacy_pickled_proof_is_read(self):
+        item = hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        proof = [{"right": hashlib.sha256(b"sibling").hexdigest()}]
+        self.session.execute("UPDATE hashitem SET proof = :proof WHERE id = :id",
+                             {"proof": pickle.dumps(proof, pickle.HIGHEST_PROTOCOL), "id": item.id})
+        self.session.commit()
+        self.session.expire_all()
+
+        assert build_chainpoint_receipt(hashitem.get_hashitem(self.session, item_id=item.id))["proof"] == proof
+
+    def test_receipt_cache_is_invalidated_by_anchoring(self):
+        record.create_record(self.session, self.user.id, self.datastore.id, "foobar0")
+        rec = record.get_record(self.session, self.user.id)[0]
+        stats = receipt_cache.get_stats()
+
+        pending = json.loads(rec.json_describe())["blockchain_receipt"]
+        assert json.loads(rec.json_describe())["blockchain_receipt"] == pending
+        assert receipt_cache.get_stats()["hits"] == stats["hits"] + 1
+        assert pending["anchors"] == [] and pending["proof"] is None
+
+        _check_queue_fn(lambda _: [("ETHData", "0xfakeTxId")], 0, 0)
+        self.session.expire_all()
+        anchored = json.loads(rec.json_describe())["blockchain_receipt"]
+        assert anchored["anchors"] == [{"type": "ETHData", "sourceId": "0xfakeTxId"}]
+        assert receipt_cache.get_stats()["misses"] == stats["misses"] + 2
+
+        _check_confirmations_fn(lambda _a, _b: "0xfakeBlockHash")
+        assert json.loads(rec.json_describe())["blockchain_receipt"] == anchored
+        assert receipt_cache.get_stats()["misses"] == stats["misses"] + 3
+
+    def test_receipt_of_item_loaded_before_anchoring_isnt_cached_stale(self):
+        record.create_record(self.session, self.user.id, self.datastore.id, "foobar0")
+        generation = receipt_cache.get_generation()
+        item = hashitem.get_hashitem(self.session)[0]
+        assert item.confirmations == []
+
+        _check_queue_fn(lambda _: [("ETHData", "0xfakeTxId")], 0, 0)
+        assert receipt_cache.get(item, generation)["proof"] is None  # built from what was loaded, but not cached
+        anchored = receipt_cache.get(item)
+        assert anchored["anchors"] == [{"type": "ETHData", "sourceId": "0xfakeTxId"}]
+        assert anchored["proof"] is not None
+        assert receipt_cache.get(item, generation) == anchored
+
     def test_create_receipt_for_item_no_tx_no_block(self):
         hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
 
@@ -0,0 +1,93 @@
+import time
+from threading import Thread
+from unittest import TestCase
+
+from tierion.arrivals import ArrivalTracker
+
+
+class TestArrivalTracker(TestCase):
+    def test_due_when_queue_size_reached(self):
+        tracker = ArrivalTracker()
+        tracker.configure(3, 600)
+        tracker.arrived(2)
+        assert tracker.wait(0.01) is False
+        tracker.arrived()
+        assert tracker.wait(0.01) is True
+
+    def test_due_when_oldest_item_expires(self):
+        tracker = ArrivalTracker()
+        tracker.configure(100, 0.05)
+        tracker.arrived()
+        start = time.time()
+        assert tracker.wait(5) is True
+        assert time.time() - start < 1
+
+    def test_arrival_wakes_waiting_thread(self):
+        tracker = ArrivalTracker()
+        tracker.configure(1, 600)
+        result = []
+        waiter = Thread(target=lambda: result.append(tracker.wait(5)))
+        waiter.start()
+        time.sleep(0.05)
+        tracker.arrived()
+        waiter.join(1)
+        assert result == [True]
+
+    def test_snapshot_and_anchoring(self):
+        tracker = ArrivalTracker()
+        tracker.configure(10, 600)
+        tracker.reset(4, time.time() - 1000)
+        assert tracker.wait(0) is True
+        tracker.arrived(2)
+        tracker.anchored(4, True)
+        assert tracker.get_pending_count() == 2
+        assert tracker.wait(0) is False
+        tracker.anchored(2, True)
+        assert tracker.get_pending_count() == 0
+
+    def test_producer_waits_until_anchoring_caught_up(self):
+        tracker = ArrivalTracker()
+        tracker.arrived(5)
+        assert tracker.wait_below(5, 0.01) is False
+
+        result = []
+        waiter = Thread(target=lambda: result.append(tracker.wait_below(5, 5)))
+        waiter.start()
+        time.sleep(0.05)
+        tracker.anchored(2, False)
+        waiter.join(1)
+        assert result == [True]
+
+    def test_not_due_until_backoff_after_failure_passed(self):
+        tracker = ArrivalTracker()
+        tracker.configure(1, 600, backoff=0.1, max_backoff=0.15)
+        tracker.arrived()
+        assert tracker.failed() == 0.1
+        start = time.time()
+        assert tracker.wait(0) is True
+        assert time.time() - start >= 0.09
+
+        assert tracker.failed() == 0.15  # doubled, but capped
+        tracker.anchored(1, True)
+        tracker.arrived()
+        assert tracker.wait(0) is True  # a successful cycle ends the backoff
+
+    def test_arrivals_during_snapshot_are_counted_after_reset(self):
+        tracker = ArrivalTracker()
+        tracker.configure(10, 600)
+        snapshot = tracker.start_snapshot()
+        producer = Thread(target=tracker.arrived)
+        producer.start()
+        producer.join(1)  # the hashitem is committed while the queue is counted, it doesn't wait for the count
+        arrived_at = time.time()
+        tracker.reset(0, None, snapshot)
+
+        assert tracker.get_pending_count() == 1
+        assert tracker.wait(0) is False
+        tracker.configure(10, 0.05)
+        time.sleep(0.06)
+        assert tracker.wait(0) is True and time.time() - arrived_at >= 0.05
+
+        snapshot = tracker.start_snapshot()
+        tracker.reset(3, None, snapshot)
+        assert tracker.get_pending_count() == 3
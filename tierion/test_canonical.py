@@ -0,0 +1,30 @@
+import hashlib
+from unittest import TestCase
+
+from tierion.canonical import canonical_json, sha256_hex, PayloadHasher
+
+
+class TestCanonical(TestCase):
+    def test_equal_data_serializes_equally(self):
+        assert canonical_json({"b": [1, {"d": 2, "c": None}], "a": "ä"}) == '{"a":"ä","b":[1,{"c":null,"d":2}]}'
+        assert sha256_hex(canonical_json({"x": 1, "y": 2})) == sha256_hex(canonical_json({"y": 2, "x": 1}))
+        assert sha256_hex('{"a":"ä"}') == hashlib.sha256('{"a":"ä"}'.encode("utf-8")).hexdigest()
+
+    def test_nan_is_rejected(self):
+        with self.assertRaises(ValueError):
+            canonical_json({"a": float("nan")})
+
+    def test_lone_surrogates_fail_to_hash(self):
+        text = canonical_json({"a": "\ud800"})  # valid JSON, but not encodable as UTF-8
+        with self.assertRaises(ValueError):
+            sha256_hex(text)
+        with self.assertRaises(ValueError):
+            PayloadHasher().hash_many([text])
+
+    def test_large_payloads_are_hashed_in_order(self):
+        hasher = PayloadHasher(max_workers=2, parallel_above=100)
+        texts = [canonical_json({"n": i, "pad": "x" * (i * 50)}) for i in range(6)]
+        try:
+            assert hasher.hash_many(texts) == [sha256_hex(text) for text in texts]
+        finally:
+            hasher.shutdown()
@@ -0,0 +1,101 @@
+import hashlib
+from unittest import TestCase
+from uuid import uuid4
+
+from tierion import db, accounts, hashitem, _check_queue_fn
+from tierion.chainpoint_util import receipt_cache
+from tierion.confirmations import ConfirmationScheduler
+from tierion.db import Confirmation
+
+
+class TestConfirmationScheduler(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        self.session = db.create_session()
+        self.user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
+        self.heights = {"ETHData": 100}
+        self.mined = set()
+        self.lookups = []
+
+    def anchor(self, tx_id):
+        hashitem.create_hashitem(self.session, self.user.id, hashlib.sha256(uuid4().bytes).hexdigest())
+        _check_queue_fn(lambda _: [("ETHData", tx_id)], 0, 0)
+
+    def bulk_cb(self, endpoint, tx_ids):
+        self.lookups.append(sorted(tx_ids))
+        return {tx_id: "block-" + tx_id if tx_id in self.mined else None for tx_id in tx_ids}
+
+    def block_headers(self):
+        self.session.rollback()
+        return {c.tx_id: c.block_header for c in self.session.query(Confirmation).all()}
+
+    def test_transactions_are_checked_on_new_blocks_only(self):
+        scheduler = ConfirmationScheduler(self.bulk_cb, self.heights.get)
+        self.anchor("0x1")
+        self.anchor("0x2")
+
+        assert scheduler.check(self.session) == 0
+        assert scheduler.check(self.session) == 0
+        assert self.lookups == [["0x1", "0x2"]]
+
+        self.mined.add("0x1")
+        self.heights["ETHData"] = 101
+        assert scheduler.check(self.session) == 1
+        assert self.lookups[-1] == ["0x1", "0x2"]
+        assert self.block_headers() == {"0x1": "block-0x1", "0x2": None}
+
+        self.anchor("0x3")
+        self.heights["ETHData"] = 102
+        scheduler.check(self.session)
+        assert self.lookups[-1] == ["0x2", "0x3"]
+        assert scheduler.get_pending_count() == 2
+
+    def test_stale_transactions_back_off(self):
+        scheduler = ConfirmationScheduler(self.bulk_cb, self.heights.get, stale_after=2, base_delay=3600)
+        self.anchor("0x1")
+
+        for height in range(101, 106):
+            self.heights["ETHData"] = height
+            scheduler.check(self.session)
+        assert len(self.lookups) == 2
+
+    def test_unknown_height_checks_every_time(self):
+        scheduler = ConfirmationScheduler(self.bulk_cb)
+        self.anchor("0x1")
+
+        scheduler.check(self.session)
+        self.mined.add("0x1")
+        assert scheduler.check(self.session) == 1
+        assert len(self.lookups) == 2
+        assert scheduler.get_pending_count() == 0
+
+    def test_failing_lookups_are_retried_on_the_next_check(self):
+        def failing_height(endpoint):
+            raise ConnectionError("node unreachable")
+
+        scheduler = ConfirmationScheduler(self.bulk_cb, failing_height)
+        self.anchor("0x1")
+        self.mined.add("0x1")
+        assert scheduler.check(self.session) == 0
+        assert self.lookups == []
+
+        scheduler._height_callback = self.heights.get
+        assert scheduler.check(self.session) == 1
+
+    def test_failing_load_keeps_known_transactions(self):
+        scheduler = ConfirmationScheduler(self.bulk_cb)
+        self.anchor("0x1")
+        scheduler.check(self.session)
+
+        def failing_load(session):
+            raise ConnectionError("database unreachable")
+
+        scheduler.load = failing_load
+        self.mined.add("0x1")
+        assert scheduler.check(self.session) == 1
@@ -0,0 +1,42 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from tierion import db
+
+
+class TestEngineProfiles(TestCase):
+    def test_profile_is_picked_by_url(self):
+        assert db.get_engine_options("postgresql://localhost/tierion")["pool_size"] == 10
+        options = db.get_engine_options("sqlite:///tierion.db", pool_size=2, sqlite_pragmas={"synchronous": "FULL"})
+        assert (options["pool_class"], options["pool_size"]) == ("queue", 2)
+        assert options["sqlite_pragmas"]["synchronous"] == "FULL"
+        assert options["sqlite_pragmas"]["journal_mode"] == "WAL"
+
+    def test_in_memory_database_shares_its_connection(self):
+        options = db.get_engine_options("sqlite:///:memory:")
+        assert options["pool_class"] == "static" and "journal_mode" not in options["sqlite_pragmas"]
+        assert isinstance(db.create_db_engine("sqlite://").pool, StaticPool)
+
+    def test_unknown_profile_is_rejected(self):
+        with self.assertRaises(ValueError):
+            db.get_engine_options("sqlite://", "oracle")
+
+    def test_options_from_env(self):
+        url, profile, options = db.options_from_env({"TIERION_DATABASE_PROFILE": "sqlite-legacy",
+                                                     "TIERION_DB_POOL_SIZE": "4",
+                                                     "TIERION_SQLITE_SYNCHRONOUS": "OFF"})
+        assert (url, profile) == ("sqlite:///tierion.db", "sqlite-legacy")
+        assert options == {"pool_size": 4, "sqlite_pragmas": {"synchronous": "OFF"}}
+
+    def test_sqlite_file_runs_in_wal_mode(self):
+        with TemporaryDirectory() as directory:
+            engine = db.create_db_engine("sqlite:///" + os.path.join(directory, "tierion.db"))
+            try:
+                assert isinstance(engine.pool, QueuePool)
+                assert engine.execute("PRAGMA journal_mode").scalar() == "wal"
+                assert engine.execute("PRAGMA synchronous").scalar() == 1  # NORMAL
+            finally:
+                engine.dispose()
@@ -0,0 +1,106 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event
+from unittest import TestCase
+
+from tierion import db, accounts, datastore, record, delivery, _check_queue_fn, stop_delivery_thread
+from tierion.chainpoint_util import receipt_cache
+from tierion.db import ReceiptDelivery
+
+
+class TestDelivery(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+
+        db.Base.metadata.drop_all(bind=self.engine)
+        db.Base.metadata.create_all(bind=self.engine)
+        receipt_cache.clear()
+        accounts.auth_cache.clear()
+
+        self.session = db.create_session()
+        self.executor = ThreadPoolExecutor(4)
+        self.posted = []
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def send_fn(self, url, payload):
+        self.posted.append((url, json.loads(payload)))
+        return True
+
+    def test_receipts_are_posted_and_removed(self):
+        delivery.enqueue_receipts(self.session, [("https://a", {"n": 0}), ("https://b", {"n": 1})])
+        assert delivery.deliver_receipts(self.session, self.send_fn, self.executor) == 2
+
+        assert sorted(self.posted) == [("https://a", {"n": 0}), ("https://b", {"n": 1})]
+        assert self.session.query(ReceiptDelivery).count() == 0
+
+    def test_receipts_are_batched_per_url(self):
+        delivery.enqueue_receipts(self.session, [("https://a", {"n": i}) for i in range(5)] + [("https://b", {"n": 5})])
+        assert delivery.deliver_receipts(self.session, self.send_fn, self.executor, batch_size=2) == 6
+
+        assert sorted(self.posted, key=lambda p: (p[0], len(p[1]))) == [
+            ("https://a", [{"n": 4}]), ("https://a", [{"n": 0}, {"n": 1}]), ("https://a", [{"n": 2}, {"n": 3}]),
+            ("https://b", [{"n": 5}])]
+
+    def test_large_backlog_of_one_url_doesnt_hold_back_others(self):
+        delivery.enqueue_receipts(self.session, [("https://hot", {"n": i}) for i in range(50)])
+        delivery.enqueue_receipts(self.session, [("https://cold", {"n": 50})])
+        single = ThreadPoolExecutor(1)
+        try:
+            assert delivery.deliver_receipts(self.session, self.send_fn, single, limit=20) == 11
+        finally:
+            single.shutdown()
+
+        assert [url for url, _ in self.posted[:2]] == ["https://cold", "https://hot"]
+        assert self.session.query(ReceiptDelivery).filter(ReceiptDelivery.url == "https://hot").count() == 40
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        delivery.enqueue_receipts(self.session, [("https://a", {"n": 0})])
+        assert delivery.deliver_receipts(self.session, lambda url, payload: False, self.executor, backoff=60) == 0
+
+        pending = self.session.query(ReceiptDelivery).one()
+        assert pending.attempts == 1 and not pending.failed
+        assert pending.next_attempt > datetime.utcnow() + timedelta(seconds=50)
+        assert delivery.deliver_receipts(self.session, self.send_fn, self.executor) == 0
+
+        pending.next_attempt = datetime.utcnow()
+        self.session.commit()
+        assert delivery.deliver_receipts(self.session, self.send_fn, self.executor) == 1
+
+    def test_delivery_is_given_up_after_max_attempts(self):
+        def raising_send_fn(url, payload):
+            raise IOError("connection refused")
+
+        delivery.enqueue_receipts(self.session, [("https://a", {"n": 0})])
+        for _ in range(3):
+            delivery.deliver_receipts(self.session, raising_send_fn, self.executor, max_attempts=3, backoff=0)
+
+        pending = self.session.query(ReceiptDelivery).one()
+        assert pending.attempts == 3 and pending.failed
+        assert delivery.get_next_attempt(self.session) is None
+
+    def test_anchoring_queues_receipts_for_delivery_thread(self):
+        user = accounts.create_account(self.session, "tester", "test@test.com", "tester user", "secret")
+        ds = datastore.create_datastore(self.session, user.id, "testDS", "testGroup", post_receipt_enabled=True,
+                                        post_receipt_url="https://foobar")
+        record.create_record(self.session, user.id, ds.id, "foobar0")
+        posted = Event()
+
+        def send_fn(url, payload):
+            self.send_fn(url, payload)
+            posted.set()
+            return True
+
+        thr = delivery.DeliveryThread(interval=None, send_fn=send_fn)
+        thr.start()
+        try:
+            assert _check_queue_fn(lambda _: [("ETHData", "0xfakeTxId")], 0, 0) == 1
+            assert posted.wait(5)
+        finally:
+            stop_delivery_thread(thr)
+            thr.join(5)
+
+        assert self.posted[0][0] == "https://foobar"
+        assert self.posted[0][1]["anchors"] == [{"type": "ETHData", "sourceId": "0xfakeTxId"}]
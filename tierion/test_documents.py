@@ -0,0 +1,29 @@
+import hashlib
+import io
+import os
+from tempfile import SpooledTemporaryFile, TemporaryFile
+from unittest import TestCase
+
+from tierion.documents import hash_stream, hash_file
+
+
+class TestDocuments(TestCase):
+    def setUp(self):
+        self.content = os.urandom(3 * 1024 + 17)
+        self.expected = hashlib.sha256(self.content).hexdigest(), len(self.content)
+
+    def test_stream_is_hashed_in_chunks(self):
+        assert hash_stream(io.BytesIO(self.content), chunk_size=1024) == self.expected
+        assert hash_stream(io.BytesIO(b"")) == (hashlib.sha256(b"").hexdigest(), 0)
+
+    def test_file_on_disk_is_memory_mapped(self):
+        with TemporaryFile("w+b") as file:
+            file.write(self.content)
+            file.flush()
+            assert hash_file(file, chunk_size=1000) == self.expected
+
+    def test_spooled_file_stays_in_memory(self):
+        with SpooledTemporaryFile(max_size=1024 * 1024) as file:
+            file.write(self.content)
+            assert hash_file(file, chunk_size=1000) == self.expected
+            assert isinstance(file._file, io.BytesIO)
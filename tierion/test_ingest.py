@@ -0,0 +1,50 @@
+import io
+import json
+from unittest import TestCase
+
+from tierion.ingest import iter_ndjson, ingest_ndjson
+
+
+class TestIngest(TestCase):
+    def test_lines_are_parsed(self):
+        body = b'{"a": 1}\n\n' + b'{"b": "' + b"x" * 100 + b'"}\n' + b'not json\n"last"'
+        lines = list(iter_ndjson(io.BytesIO(body), max_line_length=50))
+
+        assert [(n, item) for n, item, _ in lines] == [(1, {"a": 1}), (3, None), (4, None), (5, "last")]
+        assert lines[1][2] == "Line exceeds 50 bytes"
+        assert lines[2][2].startswith("Invalid JSON")
+
+    def test_items_are_inserted_in_chunks(self):
+        chunks = []
+
+        def insert_fn(items):
+            chunks.append(items)
+            start = 10 * len(chunks)
+            return [start + i if item >= 0 else None for i, item in enumerate(items)], \
+                   [{"index": i, "error": "negative"} for i, item in enumerate(items) if item < 0]
+
+        body = "\n".join(json.dumps(i) for i in [0, 1, -1, 3, 4]).encode("utf-8") + b"\n{"
+        summary = ingest_ndjson(iter_ndjson(io.BytesIO(body)), insert_fn, chunk_size=2)
+
+        assert chunks == [[0, 1], [-1, 3], [4]]
+        assert summary["complete"] is True
+        assert (summary["lineCount"], summary["committedLines"], summary["createdCount"]) == (6, 6, 4)
+        assert [error["line"] for error in summary["errors"]] == [3, 6]
+        assert summary["idRanges"] == [[10, 11], [21, 21], [30, 30]]
+        assert "ids" not in summary
+
+    def test_non_integer_ids_are_listed(self):
+        body = b"1\n-1\n3\n"
+        summary = ingest_ndjson(iter_ndjson(io.BytesIO(body)),
+                                lambda items: (["id{}".format(i) if i > 0 else None for i in items], []),
+                                include_ids=True)
+
+        assert (summary["createdCount"], summary["idRanges"], summary["ids"]) == (2, [], ["id1", "id3"])
+
+    def test_upload_is_aborted_while_anchoring_is_behind(self):
+        body = b"1\n2\n3\n"
+        summary = ingest_ndjson(iter_ndjson(io.BytesIO(body)), lambda items: ([1] * len(items), []), chunk_size=2,
+                                max_pending=0, pending_timeout=0.01)
+
+        assert summary["complete"] is False
+        assert (summary["committedLines"], summary["createdCount"]) == (0, 0)
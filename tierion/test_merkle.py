@@ -0,0 +1,123 @@
+import hashlib
+from unittest import TestCase
+from uuid import uuid4
+
+import merkletools
+
+from tierion.merkle import MerkleTree, validate_proof, encode_proof, decode_proof, TreeCache, join_proofs
+
+
+def _random_leaves(count):
+    return [hashlib.sha256(uuid4().bytes).hexdigest() for _ in range(count)]
+
+
+def _merkletools_tree(leaves):
+    mt = merkletools.MerkleTools()
+    for leaf in leaves:
+        mt.add_leaf(leaf)
+    mt.make_tree()
+    return mt
+
+
+class TestMerkleTree(TestCase):
+    def test_root_and_proofs_match_merkletools(self):
+        for count in list(range(1, 34)) + [100, 257]:
+            leaves = _random_leaves(count)
+            mt = _merkletools_tree(leaves)
+            tree = MerkleTree.from_hex(leaves)
+
+            assert tree.get_merkle_root() == mt.get_merkle_root()
+            proofs = tree.get_proofs()
+            assert len(proofs) == count
+            for i in range(count):
+                assert proofs[i] == mt.get_proof(i)
+                assert tree.get_proof(i) == mt.get_proof(i)
+
+    def test_empty_tree(self):
+        tree = MerkleTree.from_hex([])
+        assert tree.get_merkle_root() is None
+        assert tree.get_proofs() == []
+        assert tree.get_proof(0) is None
+
+    def test_single_leaf_is_root(self):
+        leaves = _random_leaves(1)
+        tree = MerkleTree.from_hex(leaves)
+        assert tree.get_merkle_root() == leaves[0]
+        assert tree.get_proofs() == [[]]
+
+    def test_proofs_validate(self):
+        leaves = _random_leaves(11)
+        tree = MerkleTree.from_hex(leaves)
+        for i, proof in enumerate(tree.get_proofs()):
+            assert validate_proof(proof, leaves[i], tree.get_merkle_root())
+        assert not validate_proof(tree.get_proof(0), leaves[1], tree.get_merkle_root())
+
+    def test_invalid_leaf_rejected(self):
+        with self.assertRaises(ValueError):
+            MerkleTree.from_hex(["abcd"])
+        with self.assertRaises(ValueError):
+            MerkleTree(b"\x00" * 33)
+
+
+class TestPackedProofs(TestCase):
+    def test_packed_proofs_decode_to_chainpoint_proofs(self):
+        for count in list(range(1, 20)) + [100]:
+            tree = MerkleTree.from_hex(_random_leaves(count))
+            packed = [tree.get_packed_proof(i) for i in range(count)]
+            assert [decode_proof(p) for p in packed] == tree.get_proofs()
+            assert [encode_proof(p) for p in tree.get_proofs()] == packed
+
+    def test_packed_proof_size(self):
+        tree = MerkleTree.from_hex(_random_leaves(1024))
+        packed = tree.get_packed_proof(0)
+        assert len(packed) == 1 + 2 + 10 * 32
+
+    def test_empty_proof_round_trip(self):
+        assert encode_proof([]) == b"\x00"
+        assert decode_proof(b"\x00") == []
+
+    def test_truncated_proof_rejected(self):
+        packed = MerkleTree.from_hex(_random_leaves(4)).get_packed_proof(0)
+        with self.assertRaises(ValueError):
+            decode_proof(packed[:-1])
+
+    def test_packed_proof_out_of_range(self):
+        tree = MerkleTree.from_hex(_random_leaves(13))
+        assert tree.get_packed_proof(13) is None
+        assert tree.get_packed_proof(-1) is None
+
+    def test_joined_proof_leads_to_upper_root(self):
+        lower = MerkleTree.from_hex(_random_leaves(9))
+        upper = MerkleTree.from_hex(_random_leaves(4) + [lower.get_merkle_root()] + _random_leaves(6))
+        upper_proof = upper.get_packed_proof(4)
+
+        for i in range(lower.get_leaf_count()):
+            proof = lower.get_packed_proof(i)
+            joined = decode_proof(join_proofs(proof, upper_proof))
+            assert joined == decode_proof(proof) + decode_proof(upper_proof)
+            assert validate_proof(joined, lower.get_leaf(i), upper.get_merkle_root())
+
+
+class TestTreeStorage(TestCase):
+    def test_levels_round_trip(self):
+        for count in range(1, 20):
+            tree = MerkleTree.from_hex(_random_leaves(count))
+            restored = MerkleTree.from_levels(tree.get_levels_buffer(), count)
+            assert restored.levels == tree.levels
+            assert restored.get_merkle_root() == tree.get_merkle_root()
+
+    def test_levels_with_wrong_leaf_count_rejected(self):
+        tree = MerkleTree.from_hex(_random_leaves(5))
+        with self.assertRaises(ValueError):
+            MerkleTree.from_levels(tree.get_levels_buffer(), 4)
+
+    def test_tree_cache_evicts_least_recently_used(self):
+        cache = TreeCache(2)
+        trees = [MerkleTree.from_hex(_random_leaves(2)) for _ in range(3)]
+        cache.put(0, trees[0])
+        cache.put(1, trees[1])
+        cache.get(0, lambda: None)
+        cache.put(2, trees[2])
+
+        assert cache.get(0, lambda: None) is trees[0]
+        assert cache.get(1, lambda: "loaded") == "loaded"
@@ -0,0 +1,118 @@
+import json
+import pickle
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from tierion import db, migrations, accounts, hashitem, record
+
+# the hashitem table as created before anchor batches were introduced
+BASELINE_HASHITEM = '''
+CREATE TABLE hashitem (
+    id INTEGER NOT NULL,
+    "accountId" INTEGER NOT NULL,
+    sha256 VARCHAR NOT NULL,
+    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    proof BLOB,
+    PRIMARY KEY (id),
+    FOREIGN KEY("accountId") REFERENCES account (id)
+)'''
+
+# the record table as created before payloads were stored once
+BASELINE_RECORD = '''
+CREATE TABLE record (
+    id VARCHAR NOT NULL,
+    "accountId" INTEGER NOT NULL,
+    "datastoreId" INTEGER NOT NULL,
+    status VARCHAR NOT NULL,
+    data BLOB,
+    json VARCHAR,
+    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    insights VARCHAR,
+    "hashitemId" INTEGER NOT NULL,
+    PRIMARY KEY (id)
+)'''
+
+
+class TestMigrations(TestCase):
+    def setUp(self):
+        self.engine = db.init("sqlite:///:memory:", False)
+        db.Base.metadata.drop_all(bind=self.engine)
+
+    def test_baseline_database_is_migrated(self):
+        self.engine.execute(BASELINE_HASHITEM)
+
+        assert migrations.migrate(self.engine) == len(migrations.MIGRATIONS)
+        inspector = inspect(self.engine)
+        assert {"batchId", "leafIndex"} <= {c["name"] for c in inspector.get_columns("hashitem")}
+        assert {"ix_hashitem_timestamp", "ix_hashitem_batchId_leafIndex"} <= \
+            {i["name"] for i in inspector.get_indexes("hashitem")}
+
+        session = db.create_session()
+        user = accounts.create_account(session, "tester", "test@test.com", "tester user", "secret")
+        assert hashitem.create_hashitem(session, user.id, "00" * 32).batchId is None
+
+    def test_record_payloads_are_converted(self):
+        self.engine.execute(BASELINE_RECORD)
+        large = {"text": "x" * 5000}
+        legacy = [("a", pickle.dumps({"n": 1}), json.dumps({"n": 1})), ("b", pickle.dumps({"n": 2}), None),
+                  ("c", pickle.dumps(large), json.dumps(large))]
+        for record_id, data, _json in legacy:
+            self.engine.execute('INSERT INTO record (id, "accountId", "datastoreId", status, data, json, "hashitemId") '
+                                'VALUES (?, 1, 1, \'queued\', ?, ?, ?)', record_id, data, _json, ord(record_id))
+
+        migrations.migrate(self.engine)
+
+        session = db.create_session()
+        records = {r.id: r for r in session.query(db.Record)}
+        assert [records[x].data for x in "abc"] == [{"n": 1}, {"n": 2}, large]
+        assert records["c"].json == json.dumps(large)
+        rows = self.engine.execute("SELECT data, json, length(payload) FROM record ORDER BY id").fetchall()
+        assert [(data, _json) for data, _json, _ in rows] == [(None, None)] * 3
+        assert rows[2][2] < 1000  # compressed
+
+    def test_server_default_timestamps_are_paged(self):
+        self.engine.execute(BASELINE_RECORD)
+        for i in range(3):
+            self.engine.execute('INSERT INTO record (id, "accountId", "datastoreId", status, json, "hashitemId") '
+                                'VALUES (?, 1, 1, \'queued\', \'{}\', ?)', "id{}".format(i), i)
+        self.engine.execute("UPDATE record SET timestamp = '2020-01-01 10:00:00'")
+
+        migrations.migrate(self.engine)
+
+        session = db.create_session()
+        listed = []
+        after = None
+        while True:
+            page = list(record.iter_records(session, 1, datastoreId=1, pageSize=1, after=after))
+            if len(page) == 0:
+                break
+            listed += [r.id for r in page]
+            after = record.decode_cursor(record.encode_cursor(page[-1]))
+        assert listed == ["id0", "id1", "id2"]
+
+    def test_trees_of_failed_batches_are_dropped(self):
+        db.Base.metadata.create_all(self.engine)
+        for state in ["failed", "notified"]:
+            self.engine.execute(db.AnchorBatch.__table__.insert().values(state=state, leaf_count=1, levels=b"\0" * 32))
+
+        migrations.migrate(self.engine)
+
+        rows = self.engine.execute("SELECT state, levels FROM anchor_batch ORDER BY id").fetchall()
+        assert [(state, levels) for state, levels in rows] == [("failed", None), ("notified", b"\0" * 32)]
+
+    def test_migrations_are_applied_once(self):
+        migrations.migrate(self.engine)
+        assert migrations.migrate(self.engine) == len(migrations.MIGRATIONS)
+
+        session = db.create_session()
+        assert migrations.get_schema_version(session) == len(migrations.MIGRATIONS)
+        assert session.query(db.SchemaVersion).count() == len(migrations.MIGRATIONS)
+
+    def test_hot_queries_use_indexes(self):
+        migrations.migrate(self.engine)
+        plans = migrations.explain_hot_queries(db.create_session())
+
+        assert len(plans) > 0
+        for name, plan in plans.items():
+            assert not any(migrations._is_full_scan(line) for line in plan), (name, plan)